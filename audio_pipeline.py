@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Нормализация аудио для транскрибации: любой формат, который понимает ffmpeg, -> PCM 16 кГц моно
+
+Декодирование выполняется один раз на файл через канал ffmpeg; полученный массив используется
+и для распознавания, и для диаризации. Сжатую запись сервис декодирует сам и передает PCM
+транскрибатору через stdin, по пути оценивая долю речи (SpeechMeter) на тех же блоках,
+поэтому ни повторного декодирования, ни временных файлов нет.
+"""
+
+import os
+import struct
+import logging
+import subprocess
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Частота дискретизации, с которой работают Whisper и pyannote
+SAMPLE_RATE = 16000
+
+# Форматы аудио, которые принимает конвейер (webm - звуковые дорожки из браузерных записей)
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.m4a', '.ogg', '.opus', '.webm', '.flac', '.aac', '.wma')
+
+# Размер блока чтения из канала ffmpeg
+PIPE_CHUNK_SIZE = 1024 * 1024
+
+# Проверка тишины: длина кадра и пороги энергии
+VAD_FRAME_MS = 30
+# Кадр считается речью, если его уровень выше уровня шума записи (10-й перцентиль кадров)
+# на VAD_NOISE_MARGIN_DB. Абсолютный порог лишь отсекает цифровую тишину и шум квантования:
+# тихая запись с дальнего микрофона может идти на -55..-60 dBFS и не должна считаться тишиной
+VAD_MIN_SPEECH_DB = -70.0
+VAD_NOISE_MARGIN_DB = 10.0
+# Порог не поднимается выше этого уровня: громкая запись без пауз не должна считаться тишиной
+VAD_MAX_THRESHOLD_DB = -30.0
+# Кадры обрабатываются блоками, чтобы не поднимать в память всю отображенную запись
+VAD_BLOCK_FRAMES = 4096
+
+def build_ffmpeg_command(audio_path, sample_rate=SAMPLE_RATE):
+    """Command that decodes audio_path to signed 16-bit mono PCM on stdout"""
+    return [
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+        '-threads', '0',
+        '-i', str(audio_path),
+        '-vn',
+        '-f', 's16le', '-acodec', 'pcm_s16le',
+        '-ac', '1', '-ar', str(sample_rate),
+        '-'
+    ]
+
+def iter_pcm_chunks(audio_path, sample_rate=SAMPLE_RATE, chunk_size=PIPE_CHUNK_SIZE):
+    """
+    Потоково декодирует файл и отдает блоки PCM s16le по мере чтения из ffmpeg
+
+    Raises:
+        RuntimeError: если ffmpeg завершился с ошибкой
+    """
+    process = subprocess.Popen(
+        build_ffmpeg_command(audio_path, sample_rate),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode('utf-8', errors='replace')
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg не смог декодировать {audio_path}: {stderr.strip()}")
+
+def pcm16_from_chunks(chunks):
+    """Собирает блоки PCM s16le в массив int16"""
+    pcm = bytearray()
+    for chunk in chunks:
+        pcm += chunk
+    # Нечетный хвост возможен только при обрыве канала
+    if len(pcm) % 2:
+        del pcm[-1]
+    return np.frombuffer(pcm, dtype=np.int16)
+
+def load_pcm16(audio_path, sample_rate=SAMPLE_RATE):
+    """Декодирует файл в массив int16 (16 кГц моно)"""
+    return pcm16_from_chunks(iter_pcm_chunks(audio_path, sample_rate))
+
+def read_pcm_stream(stream, sample_rate=SAMPLE_RATE):
+    """
+    Читает PCM s16le 16 кГц моно из потока (stdin транскрибатора) в массив float32 [-1, 1]
+
+    Args:
+        stream: Двоичный поток, например sys.stdin.buffer
+        sample_rate (int): Частота дискретизации потока
+
+    Returns:
+        numpy.ndarray: Моно сигнал float32
+    """
+    pcm = pcm16_from_chunks(iter(lambda: stream.read(PIPE_CHUNK_SIZE), b''))
+    audio = pcm.astype(np.float32) / 32768.0
+    logger.info(f"Из потока прочитано {len(audio) / sample_rate:.1f} с аудио ({sample_rate} Гц, моно)")
+    return audio
+
+def load_audio(audio_path, sample_rate=SAMPLE_RATE):
+    """
+    Декодирует файл в массив float32 в диапазоне [-1, 1], как ожидает whisperx
+
+    Args:
+        audio_path (str или Path): Путь к аудиофайлу любого поддерживаемого ffmpeg формата
+        sample_rate (int): Частота дискретизации результата
+
+    Returns:
+        numpy.ndarray: Моно сигнал float32
+    """
+    # WAV 16 кГц моно читается отображением в память, без запуска ffmpeg
+    wav = open_wav_pcm16(audio_path)
+    if wav is not None and wav[0].shape[1] == 1 and wav[1] == sample_rate:
+        pcm = wav[0][:, 0]
+    else:
+        pcm = load_pcm16(audio_path, sample_rate)
+    audio = pcm.astype(np.float32) / 32768.0
+    logger.info(f"{audio_path}: декодировано {len(audio) / sample_rate:.1f} с аудио ({sample_rate} Гц, моно)")
+    return audio
+
+def open_wav_pcm16(audio_path):
+    """
+    Отображает в память данные несжатого 16-битного WAV без декодирования
+
+    Returns:
+        tuple: (numpy.memmap int16 формы (кадры, каналы), частота дискретизации)
+               или None, если файл не PCM16 WAV
+    """
+    with open(audio_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        channels = sample_rate = bits = format_tag = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                format_tag, channels, sample_rate = struct.unpack('<HHI', fmt[:8])
+                bits = struct.unpack('<H', fmt[14:16])[0]
+                # WAVE_FORMAT_EXTENSIBLE: настоящий формат в SubFormat
+                if format_tag == 0xFFFE and len(fmt) >= 26:
+                    format_tag = struct.unpack('<H', fmt[24:26])[0]
+            elif chunk_id == b'data':
+                if format_tag != 1 or bits != 16 or not channels:
+                    return None
+                offset = f.tell()
+                # Размер data может быть неверным у записей, оборванных на середине
+                available = os.fstat(f.fileno()).st_size - offset
+                frames = min(chunk_size, available) // (2 * channels)
+                if frames == 0:
+                    return None
+                samples = np.memmap(audio_path, dtype='<i2', mode='r', offset=offset, shape=(frames, channels))
+                return samples, sample_rate
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+def wav_duration(audio_path):
+    """Duration of a PCM16 WAV in seconds from its header, or None for other files"""
+    try:
+        wav = open_wav_pcm16(audio_path)
+    except OSError:
+        return None
+    if wav is None:
+        return None
+    samples, sample_rate = wav
+    return samples.shape[0] / sample_rate
+
+def frame_levels_db(samples, sample_rate, frame_ms=VAD_FRAME_MS):
+    """Уровень каждого кадра в dBFS (по самому громкому каналу), векторно и поблочно"""
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+    frame_len = max(1, int(sample_rate * frame_ms / 1000))
+    n_frames = samples.shape[0] // frame_len
+    levels = np.empty(n_frames, dtype=np.float32)
+    for start in range(0, n_frames, VAD_BLOCK_FRAMES):
+        stop = min(start + VAD_BLOCK_FRAMES, n_frames)
+        block = np.asarray(samples[start * frame_len:stop * frame_len], dtype=np.float32)
+        block = block.reshape(stop - start, frame_len, -1) / 32768.0
+        rms = np.sqrt(np.mean(block * block, axis=1)).max(axis=1)
+        levels[start:stop] = 20.0 * np.log10(np.maximum(rms, 1e-10))
+    return levels
+
+def speech_ratio_from_levels(levels):
+    """Доля кадров выше порога речи; порог зависит от уровня шума самой записи"""
+    if len(levels) == 0:
+        return 0.0
+    noise_floor = np.percentile(levels, 10)
+    threshold = max(VAD_MIN_SPEECH_DB, min(noise_floor + VAD_NOISE_MARGIN_DB, VAD_MAX_THRESHOLD_DB))
+    return float(np.count_nonzero(levels > threshold)) / len(levels)
+
+class SpeechMeter:
+    """Уровни кадров потока PCM s16le моно, накапливаемые по мере декодирования"""
+    def __init__(self, sample_rate=SAMPLE_RATE, frame_ms=VAD_FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_bytes = 2 * max(1, int(sample_rate * frame_ms / 1000))
+        self.pending = b''
+        self.levels = []
+
+    def add(self, chunk):
+        """Учитывает очередной блок PCM; неполный кадр ждет следующего блока"""
+        data = self.pending + chunk
+        usable = len(data) - len(data) % self.frame_bytes
+        if usable:
+            samples = np.frombuffer(data, dtype='<i2', count=usable // 2)
+            self.levels.append(frame_levels_db(samples, self.sample_rate, self.frame_ms))
+        self.pending = data[usable:]
+
+    def speech_ratio(self):
+        levels = np.concatenate(self.levels) if self.levels else np.empty(0, dtype=np.float32)
+        return speech_ratio_from_levels(levels)
+
+def estimate_speech_ratio(audio_path):
+    """
+    Доля кадров с речью по энергии сигнала (грубая VAD-проверка перед GPU)
+
+    Несжатые 16-битные WAV отображаются в память напрямую; остальные форматы
+    потоково декодируются через ffmpeg в 16 кГц моно без сборки всей записи в памяти.
+
+    Returns:
+        float: Доля кадров выше порога речи (0..1) или None, если оценить не удалось
+    """
+    try:
+        wav = open_wav_pcm16(audio_path)
+        if wav is not None:
+            samples, sample_rate = wav
+            return speech_ratio_from_levels(frame_levels_db(samples, sample_rate))
+        meter = SpeechMeter()
+        for chunk in iter_pcm_chunks(audio_path):
+            meter.add(chunk)
+        return meter.speech_ratio()
+    except Exception as e:
+        logger.warning(f"Не удалось оценить долю речи в {audio_path}: {e}")
+        return None
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Хранение обработанных аудиозаписей в output_dir
+
+После транскрибации оригинал записи остается в output_dir как {prefix}_transcript.{ext};
+время изменения файла - момент обработки, от него отсчитывается возраст записи.
+Записи, заметка которых еще черновик (transcript_status: draft), не трогаются: черновик
+уточняется по исходному аудио. Фоновое задание (по умолчанию отключено):
+- перекодирует записи старше transcode_after_days в Opus (речь, моно) и обновляет ссылки
+  [[{prefix}_transcript.wav|...]] в заметках на новое имя;
+- удаляет записи старше max_age_days;
+- удаляет самые старые записи, пока общий объем аудио больше max_total_bytes.
+
+Использование:
+    python audio_retention.py [каталог_вывода]
+"""
+
+import os
+import re
+import time
+import logging
+import subprocess
+from contextlib import nullcontext
+from pathlib import Path
+
+import audio_pipeline
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = '.opus'
+DEFAULT_OPUS_BITRATE = '24k'
+
+def find_archived_audio(output_dir):
+    """Return processed recordings ({prefix}_transcript.{audio ext}) in output_dir"""
+    return [
+        file_path for file_path in Path(output_dir).glob('*_transcript.*')
+        if file_path.is_file() and file_path.suffix.lower() in audio_pipeline.AUDIO_EXTENSIONS
+    ]
+
+def is_draft_audio(audio_file):
+    """True if the note of a recording is a draft still waiting for refinement"""
+    note = audio_file.with_suffix('.md')
+    try:
+        with open(note, 'r', encoding='utf-8') as f:
+            head = f.read(2048)
+    except OSError:
+        return False
+    return re.search(r'^transcript_status:\s*draft\s*$', head, re.MULTILINE) is not None
+
+def transcode_to_opus(src_path, dst_path, bitrate=DEFAULT_OPUS_BITRATE):
+    """Transcode a recording to mono Opus; the result is written via a temporary file"""
+    tmp_path = dst_path.with_name(f"{dst_path.name}.part")
+    command = [
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-i', str(src_path),
+        '-vn', '-ac', '1',
+        '-c:a', 'libopus', '-b:a', bitrate, '-application', 'voip',
+        '-f', 'ogg', str(tmp_path)
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 or not tmp_path.exists() or tmp_path.stat().st_size == 0:
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError(f"ffmpeg не смог перекодировать {src_path.name}: {result.stderr.strip()}")
+    os.replace(tmp_path, dst_path)
+
+def update_note_links(output_dir, old_name, new_name):
+    """
+    Заменяет ссылки [[old_name|...]] / [[old_name]] и processed_filename в заметках записи
+
+    Заметки записи имеют тот же префикс, что и аудиофайл ({prefix}_transcript.md,
+    {prefix}_transcript_error.md), поэтому весь каталог не просматривается.
+
+    Returns:
+        int: Количество обновленных заметок
+    """
+    stem = Path(old_name).stem
+    link_pattern = re.compile(r'\[\[' + re.escape(old_name) + r'(?=[|\]])')
+    field_pattern = re.compile(r'^(processed_filename:\s*)' + re.escape(old_name) + r'\s*$', re.MULTILINE)
+
+    updated = 0
+    for note in Path(output_dir).glob(f"{glob_escape(stem)}*.md"):
+        try:
+            content = note.read_text(encoding='utf-8')
+            new_content = link_pattern.sub(f"[[{new_name}", content)
+            new_content = field_pattern.sub(lambda m: f"{m.group(1)}{new_name}", new_content)
+            if new_content == content:
+                continue
+            tmp_note = note.with_name(f"{note.name}.tmp")
+            tmp_note.write_text(new_content, encoding='utf-8')
+            os.replace(tmp_note, note)
+            updated += 1
+        except Exception as e:
+            logger.error(f"Не удалось обновить ссылки в заметке {note.name}: {e}")
+    return updated
+
+def glob_escape(name):
+    """Escape glob metacharacters in a file name"""
+    return re.sub(r'([\[\]*?])', r'[\1]', name)
+
+def archive_old_audio(output_dir, transcode_after_days, bitrate=DEFAULT_OPUS_BITRATE, notes_lock=None):
+    """Transcode recordings older than transcode_after_days to Opus and relink their notes.
+       Notes are rewritten under notes_lock, so that other writers of the same notes are not overwritten.
+    """
+    cutoff = time.time() - transcode_after_days * 86400
+    archived = 0
+    for audio_file in find_archived_audio(output_dir):
+        if audio_file.suffix.lower() == ARCHIVE_SUFFIX:
+            continue
+        stat = audio_file.stat()
+        if stat.st_mtime > cutoff or is_draft_audio(audio_file):
+            continue
+
+        opus_file = audio_file.with_suffix(ARCHIVE_SUFFIX)
+        try:
+            transcode_to_opus(audio_file, opus_file, bitrate)
+            # Сохраняем время обработки, чтобы квоты считали возраст от него
+            os.utime(opus_file, (stat.st_atime, stat.st_mtime))
+            with notes_lock or nullcontext():
+                notes = update_note_links(output_dir, audio_file.name, opus_file.name)
+                audio_file.unlink()
+            archived += 1
+            logger.info(f"{audio_file.name} -> {opus_file.name}: {stat.st_size/1024/1024:.1f} MB -> "
+                        f"{opus_file.stat().st_size/1024/1024:.1f} MB, обновлено заметок: {notes}")
+        except Exception as e:
+            logger.error(f"Ошибка архивации {audio_file.name}: {e}")
+    return archived
+
+def enforce_quotas(output_dir, max_age_days=0, max_total_bytes=0):
+    """Delete recordings older than max_age_days, then the oldest ones above max_total_bytes (0 disables a quota)"""
+    files = []
+    for audio_file in find_archived_audio(output_dir):
+        try:
+            stat = audio_file.stat()
+        except FileNotFoundError:
+            continue
+        if is_draft_audio(audio_file):
+            continue
+        files.append((stat.st_mtime, stat.st_size, audio_file))
+    files.sort(key=lambda item: item[0])
+
+    removed = 0
+    total_size = sum(size for _, size, _ in files)
+    age_cutoff = time.time() - max_age_days * 86400
+    for mtime, size, audio_file in files:
+        too_old = max_age_days and mtime < age_cutoff
+        over_quota = max_total_bytes and total_size > max_total_bytes
+        if not (too_old or over_quota):
+            break
+        try:
+            audio_file.unlink()
+            total_size -= size
+            removed += 1
+            reason = "старше срока хранения" if too_old else "превышен объем хранения"
+            logger.info(f"Удалена запись {audio_file.name} ({reason})")
+        except Exception as e:
+            logger.error(f"Не удалось удалить запись {audio_file.name}: {e}")
+    return removed
+
+def run_retention(output_dir, transcode_after_days=0, bitrate=DEFAULT_OPUS_BITRATE, max_age_days=0, max_total_bytes=0,
+                  notes_lock=None):
+    """Run one retention pass: archive to Opus, then enforce age and size quotas"""
+    archived = 0
+    if transcode_after_days > 0:
+        archived = archive_old_audio(output_dir, transcode_after_days, bitrate, notes_lock)
+    removed = enforce_quotas(output_dir, max_age_days, max_total_bytes)
+    logger.info(f"Хранение аудио: перекодировано в Opus {archived}, удалено {removed}")
+    return archived, removed
+
+if __name__ == "__main__":
+    import sys
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    run_retention(
+        sys.argv[1] if len(sys.argv) > 1 else os.getenv('OUTPUT_DIR', 'output'),
+        transcode_after_days=float(os.getenv('AUDIO_TRANSCODE_AFTER_DAYS', '0')),
+        bitrate=os.getenv('AUDIO_OPUS_BITRATE', DEFAULT_OPUS_BITRATE),
+        max_age_days=float(os.getenv('AUDIO_MAX_AGE_DAYS', '0')),
+        max_total_bytes=int(float(os.getenv('AUDIO_MAX_TOTAL_GB', '0')) * 1024 ** 3)
+    )
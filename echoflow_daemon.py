@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Единый демон EchoFlow: наблюдение за исходными каталогами и обработка файлов в одном процессе.
+
+Заменяет связку file_monitor.py + file_processor_service.py: вместо копирования WAV в INPUT_DIR
+и опроса этого каталога файлы передаются в конвейер file_processor_service сразу после того,
+как перестали изменяться. PDF обрабатываются один раз, тем же конвейером (с пакетированием marker).
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from datetime import timedelta
+from pathlib import Path
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+import file_processor_service as service
+import pdf_engine
+import transcript_export
+from file_watch import ProcessedFiles, StabilityScheduler, wav_sibling_exists
+from job_scheduler import ShortestJobFirstQueue
+
+# Обработка файлов и периодические задачи выполняются под блокировкой конвейера сервиса
+pipeline_lock = service.pipeline_lock
+
+def load_daemon_config(config):
+    """Add daemon settings to the service configuration"""
+    # Исходные каталоги (через os.pathsep) и INPUT_DIR, куда файлы могут класть другие инструменты
+    watch_dirs = [d for d in os.getenv('MONITORED_DIR', '').split(os.pathsep) if d]
+    watch_dirs.append(config['input_dir'])
+
+    unique_dirs = []
+    for watch_dir in watch_dirs:
+        resolved = str(Path(watch_dir).resolve())
+        if resolved not in unique_dirs:
+            unique_dirs.append(resolved)
+
+    config['watch_dirs'] = unique_dirs
+    config['stability_seconds'] = float(os.getenv('STABILITY_SECONDS', '2'))
+    # Сжатые записи дольше ждут стабильности: рекордер может еще конвертировать их в WAV
+    config['compressed_stability_seconds'] = float(os.getenv('COMPRESSED_STABILITY_SECONDS', '30'))
+    config['event_queue_size'] = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
+    config['processed_files_max'] = int(os.getenv('PROCESSED_FILES_MAX', '10000'))
+    config['processed_files_ttl'] = float(os.getenv('PROCESSED_FILES_TTL_HOURS', '168')) * 3600
+    return config
+
+def is_candidate_file(file_path):
+    """Check if the file should be handed to the processing pipeline"""
+    return (file_path.suffix.lower() in service.SUPPORTED_EXTENSIONS
+            and not service.is_syncthing_temp_file(file_path))
+
+class SourceDirHandler(FileSystemEventHandler):
+    """Only enqueues paths; stability checks and processing happen in StabilityScheduler"""
+    def __init__(self, events, processed_files):
+        super().__init__()
+        self.events = events
+        self.processed_files = processed_files
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.submit(Path(event.src_path))
+
+    def on_moved(self, event):
+        # syncthing и многие редакторы создают файл под временным именем и затем переименовывают
+        if not event.is_directory:
+            self.submit(Path(event.dest_path))
+
+    def submit(self, file_path):
+        if not is_candidate_file(file_path):
+            return
+        # Обработанные файлы уходят из каталога, поэтому повторное событие означает новый файл;
+        # повторы файлов, уже стоящих в очереди, отсекает очередь заданий
+        if self.processed_files.get(str(file_path)) == "processing":
+            return
+        self.events.put(file_path)
+
+def queue_stable_file(job_queue, file_path):
+    """Queue a file whose size has stopped changing, ordered by estimated processing cost"""
+    try:
+        file_size = file_path.stat().st_size
+    except FileNotFoundError:
+        return
+
+    if file_size < service.config['min_file_size']:
+        print(f"[INFO] File {file_path.name} is too small ({file_size/1024:.2f} KB < {service.config['min_file_size']/1024} KB), skipping.")
+        return
+
+    if str(file_path) in service.pending_retries:
+        # Файл ждет повторной попытки транскрибации и вернется в очередь сам
+        return
+
+    cost = service.estimate_job_cost(file_path)
+    if job_queue.add(str(file_path), file_path, cost):
+        print(f"New file detected: {file_path.name} ({file_size/1024:.2f} KB, estimated cost {timedelta(seconds=round(cost))}), queued: {len(job_queue)}")
+
+def run_pipeline(job_queue, stop_event):
+    """Process queued files one at a time, shortest job first"""
+    while not stop_event.is_set():
+        # Файлы после неудачной транскрибации возвращаются в очередь по истечении паузы
+        service.requeue_due_retries(job_queue)
+        file_path = job_queue.pop(timeout=1)
+        if file_path is None:
+            # Очередь пуста - уточняем один черновик полной моделью; транскрибация идет без
+            # блокировки конвейера и прерывается новым файлом в очереди или остановкой демона
+            if service.config['draft_min_duration'] > 0:
+                service.refine_next_draft(
+                    should_stop=lambda: stop_event.is_set() or service.has_waiting_jobs(job_queue))
+            continue
+        if not file_path.exists():
+            continue
+        if wav_sibling_exists(file_path):
+            # WAV появился, пока запись ждала в очереди: обрабатывается он, а не исходник
+            print(f"[INFO] {file_path.name} пропущен: рядом создан WAV с тем же именем")
+            continue
+        with pipeline_lock:
+            service.process_file(file_path, backlog_seconds=job_queue.total_cost())
+
+def enqueue_existing_files(events, watch_dirs):
+    """Queue files that appeared while the daemon was not running"""
+    for watch_dir in watch_dirs:
+        for file_path in Path(watch_dir).glob('*'):
+            if file_path.is_file() and is_candidate_file(file_path):
+                events.put(file_path)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Функции сервиса читают глобальный config модуля
+    config = service.configure(load_daemon_config(service.load_config()))
+    # PDF прерванного пакета marker (сбой или остановка процесса)
+    service.restore_pdf_batch()
+
+    print("=" * 80)
+    print("EchoFlow Daemon")
+    print("Directory monitoring, audio and PDF processing with Metadata Enrichment")
+    print("=" * 80)
+
+    for watch_dir in config['watch_dirs']:
+        if not os.path.isdir(watch_dir):
+            print(f"[ERROR] Каталог для мониторинга не существует: {watch_dir}")
+            return
+        print(f"[CONFIG] Каталог для мониторинга: {watch_dir}")
+    print(f"[CONFIG] Каталог для выходных файлов: {config['output_dir']}")
+    print(f"[CONFIG] Минимальный размер файла: {config['min_file_size']/1024:.1f} KB")
+    print(f"[CONFIG] Поддерживаемые форматы: {', '.join(ext[1:].upper() for ext in service.SUPPORTED_EXTENSIONS)}")
+    if pdf_engine.get_gemini_api_key():
+        print("[CONFIG] PDF файлы будут обрабатываться с использованием LLM (Gemini)")
+    else:
+        print("[CONFIG] Ключ Gemini API не найден. PDF файлы будут обрабатываться без LLM.")
+    print("=" * 80)
+
+    events = queue.Queue(maxsize=config['event_queue_size'])
+    processed_files = ProcessedFiles(config['processed_files_max'], config['processed_files_ttl'])
+    job_queue = ShortestJobFirstQueue(config['job_aging_rate'])
+    # Стабильные файлы только оцениваются и ставятся в очередь; обрабатывает их один поток,
+    # так как транскрибация занимает GPU целиком, а конвейер сервиса не потокобезопасен
+    scheduler = StabilityScheduler(
+        events,
+        processed_files,
+        lambda file_path: queue_stable_file(job_queue, file_path),
+        workers=1,
+        stability_seconds=config['stability_seconds'],
+        compressed_stability_seconds=config['compressed_stability_seconds']
+    )
+    stop_event = threading.Event()
+    pipeline_thread = threading.Thread(target=run_pipeline, args=(job_queue, stop_event), name="pipeline")
+    event_handler = SourceDirHandler(events, processed_files)
+    observer = Observer()
+    for watch_dir in config['watch_dirs']:
+        observer.schedule(event_handler, watch_dir, recursive=False)
+
+    scheduler.start()
+    pipeline_thread.start()
+    observer.start()
+    enqueue_existing_files(events, config['watch_dirs'])
+
+    print("\n--- Запуск первичной проверки метаданных --- ")
+    with pipeline_lock:
+        service.check_and_process_metadata(config['output_dir'], config)
+    print("--- Первичная проверка метаданных завершена --- ")
+    last_metadata_check_time = time.time()
+
+    try:
+        while True:
+            time.sleep(config['check_interval'])
+            with pipeline_lock:
+                # Запускаем накопленный пакет PDF, если истекло окно пакетирования
+                service.flush_pdf_batch()
+
+                # Перекодирование старых записей в Opus и квоты хранения (в фоне)
+                service.maybe_start_retention()
+
+                # Периодическая проверка метаданных
+                current_time = time.time()
+                if current_time - last_metadata_check_time >= config['metadata_check_interval']:
+                    service.check_and_process_metadata(config['output_dir'], config)
+                    # Субтитры для заметок с флагом subtitles во frontmatter
+                    transcript_export.export_requested(config['output_dir'])
+                    last_metadata_check_time = current_time
+    except KeyboardInterrupt:
+        print("\n[INFO] Остановка демона...")
+
+    observer.stop()
+    observer.join()
+    scheduler.stop()
+    scheduler.join()
+    # Дожидаемся файла, который уже обрабатывается; остальные останутся в каталоге до следующего запуска.
+    # Накопленный пакет PDF сохранен и будет обработан после следующего запуска (restore_pdf_batch)
+    stop_event.set()
+    pipeline_thread.join()
+    print("[INFO] Демон остановлен.")
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,16 @@
 import os
 import time
 import shutil
+import queue
 import logging
-import subprocess
 from pathlib import Path
 from dotenv import load_dotenv
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import pdf_engine
+import audio_pipeline
+from file_transfer import transfer_file
+from file_watch import ProcessedFiles, StabilityScheduler
 
 # Logging configuration
 logging.basicConfig(
@@ -30,20 +34,26 @@ monitored_dir = os.getenv("MONITORED_DIR")
 min_file_size = int(os.getenv("MIN_FILE_SIZE_KB", "100")) * 1024  # Size in KB
 check_interval = int(os.getenv("CHECK_INTERVAL", "5"))  # Check interval in seconds
 output_dir = os.getenv("OUTPUT_DIR")  # Directory for output data (transcripts)
-
-def safe_copy_file(src, dst):
-    """Safe file copying using cp to bypass access restrictions"""
-    try:
-        # Use cp command to bypass access restrictions in macOS
-        result = subprocess.run(['cp', src, dst], capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            logging.error(f"Error copying file with cp: {result.stderr}")
-            return False
-        return True
-    except Exception as e:
-        logging.error(f"Error running cp command: {str(e)}")
-        return False
+# Seconds a file size must stay unchanged before the file is processed
+stability_seconds = float(os.getenv("STABILITY_SECONDS", "2"))
+# Same for compressed audio (m4a, mp3, ...), which recorders may still be converting to WAV
+compressed_stability_seconds = float(os.getenv("COMPRESSED_STABILITY_SECONDS", "30"))
+monitor_workers = int(os.getenv("MONITOR_WORKERS", "2"))  # Worker threads for copies and PDF conversion
+event_queue_size = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))  # Pending watchdog events before backpressure
+# Bounds for the table of already seen files
+processed_files_max = int(os.getenv("PROCESSED_FILES_MAX", "10000"))
+processed_files_ttl = float(os.getenv("PROCESSED_FILES_TTL_HOURS", "168")) * 3600
+# JSON file that keeps processed files across restarts (disabled when empty)
+processed_files_state = os.getenv("PROCESSED_FILES_STATE", "") or None
+# Files at least this large are copied across devices with resume and checksum verification
+transfer_verify_min_size = int(os.getenv("TRANSFER_VERIFY_MIN_MB", "100")) * 1024 * 1024
+transfer_retries = int(os.getenv("TRANSFER_RETRIES", "3"))
+# Pages scoring below the threshold are sent to marker_single
+pdf_quality_threshold = float(os.getenv("PDF_QUALITY_THRESHOLD", str(pdf_engine.DEFAULT_QUALITY_THRESHOLD)))
+# Share of low-quality pages above which the whole document goes to marker_single
+pdf_escalate_ratio = float(os.getenv("PDF_ESCALATE_RATIO", str(pdf_engine.DEFAULT_ESCALATE_RATIO)))
+# Cache of converted PDF pages, reused for unchanged pages of revised documents
+pdf_page_cache_dir = os.getenv("PDF_PAGE_CACHE_DIR", os.path.join(output_dir, ".pdf_page_cache") if output_dir else "") or None
 
 def safe_delete_file(file_path):
     """Safe file deletion"""
@@ -60,77 +70,50 @@ def safe_delete_file(file_path):
         return False
 
 def process_pdf_file(file_path):
-    """Process PDF file using marker_single"""
+    """Process PDF file: fast PyMuPDF extraction first, marker_single only for low-quality pages"""
     try:
         logging.info(f"Starting PDF file processing: {file_path}")
         
         # Get Gemini API key from .env file
-        gemini_api_key = os.getenv("GEMENI_API_KEY")
+        gemini_api_key = pdf_engine.get_gemini_api_key()
         
         if not gemini_api_key:
             logging.warning("Gemini API key not found in .env file. Processing will be done without using LLM.")
         
-        # Optimized parameters for marker_single
-        command = [
-            'marker_single',
-            str(file_path),
-            '--output_dir', output_dir,
-            '--output_format', 'markdown',
-            '--disable_tqdm',               # Disable progress bars for background process
-            '--max_concurrency', '3'        # Optimal number of parallel requests
-        ]
-        
-        # If Gemini API key is available, add parameters for using LLM
-        if gemini_api_key:
-            command.extend([
-                '--use_llm',                  # Enable LLM for better quality
-                '--gemini_api_key', gemini_api_key,
-                '--model_name', 'gemini-2.0-flash'  # Fast model with good quality
-            ])
-        
-        logging.info(f"Executing command: {' '.join(command)}")
-        
-        result = subprocess.run(
-            command,
-            capture_output=True, 
-            text=True
+        success, _, processor = pdf_engine.convert_pdf(
+            file_path,
+            output_dir,
+            gemini_api_key=gemini_api_key,
+            quality_threshold=pdf_quality_threshold,
+            escalate_ratio=pdf_escalate_ratio,
+            cache_dir=pdf_page_cache_dir
         )
         
-        if result.returncode != 0:
-            logging.error(f"Error processing PDF: {result.stderr}")
+        if not success:
+            logging.error(f"Error processing PDF with {processor}: {file_path}")
             return False
         
-        logging.info(f"PDF file successfully processed: {file_path}")
+        logging.info(f"PDF file successfully processed with {processor}: {file_path}")
         return True
     except Exception as e:
-        logging.error(f"Error running marker_single: {str(e)}")
+        logging.error(f"Error processing PDF: {str(e)}")
         return False
 
 def get_file_size(file_path):
     """Get file size"""
     try:
-        # Use ls -l command to check file size
-        result = subprocess.run(['ls', '-l', str(file_path)], capture_output=True, text=True)
-        if result.returncode != 0:
-            logging.error(f"Failed to get file information: {result.stderr}")
-            return -1
-        
-        # Parse file size from ls -l output
-        try:
-            file_size = int(result.stdout.split()[4])
-            return file_size
-        except (IndexError, ValueError):
-            logging.error(f"Failed to determine file size: {result.stdout}")
-            return -1
+        return os.stat(file_path).st_size
     except Exception as e:
         logging.error(f"Error getting file size for {file_path}: {str(e)}")
         return -1
 
 class FileMonitorHandler(FileSystemEventHandler):
-    def __init__(self):
+    def __init__(self, events):
         super().__init__()
-        # Dictionary to track already processed files
-        self.processed_files = {}
+        # Queue consumed by StabilityScheduler; put() blocks when it is full
+        self.events = events
+        # Bounded table of already seen files
+        self.processed_files = ProcessedFiles(processed_files_max, processed_files_ttl, processed_files_state)
     
     def on_created(self, event):
         if event.is_directory:
@@ -142,17 +125,11 @@ class FileMonitorHandler(FileSystemEventHandler):
         if str(file_path) in self.processed_files:
             return
         
-        # Small delay to allow the file to be fully written
-        time.sleep(1)
-        
         file_suffix = file_path.suffix.lower()
         
-        # Processing WAV files
-        if file_suffix == '.wav':
-            self.handle_wav_file(file_path)
-        # Processing PDF files
-        elif file_suffix == '.pdf':
-            self.handle_pdf_file(file_path)
+        # Audio and PDF files are processed once they are fully written
+        if file_suffix in audio_pipeline.AUDIO_EXTENSIONS or file_suffix == '.pdf':
+            self.events.put(file_path)
         # Processing TXT files - do through on_modified,
         # as text files may be appended after creation
         elif file_suffix == '.txt' and file_path.name.endswith('_formatted.txt'):
@@ -169,44 +146,40 @@ class FileMonitorHandler(FileSystemEventHandler):
         # Process only TXT files with specific format
         if file_suffix == '.txt' and file_path.name.endswith('_formatted.txt'):
             # Check file status (if it was created earlier)
-            if str(file_path) in self.processed_files and self.processed_files[str(file_path)] == "pending":
-                logging.info(f"File modified and ready for processing: {file_path}")
-                
-                # Wait to ensure the file is no longer being modified
-                time.sleep(3)
-                
-                # Process the file
-                self.handle_txt_file(file_path)
-                
-                # Mark file as processed
-                self.processed_files[str(file_path)] = "processed"
+            if self.processed_files.get(str(file_path)) == "pending":
+                logging.info(f"File modified, waiting until it is no longer written: {file_path}")
+                self.events.put(file_path)
     
-    def handle_wav_file(self, file_path):
-        """Process WAV file"""
+    def process_stable_file(self, file_path):
+        """Called from the worker pool once the file size is stable"""
+        file_suffix = file_path.suffix.lower()
+        if file_suffix in audio_pipeline.AUDIO_EXTENSIONS:
+            self.handle_audio_file(file_path)
+        elif file_suffix == '.pdf':
+            self.handle_pdf_file(file_path)
+        elif file_suffix == '.txt':
+            self.handle_txt_file(file_path)
+    
+    def handle_audio_file(self, file_path):
+        """Process audio file (WAV, MP3, M4A, OGG, etc.)"""
         try:
             file_size = get_file_size(file_path)
             if file_size < 0:
                 return
             
             if file_size >= min_file_size:
-                # Copy file to INPUT_DIR
+                # Move file to INPUT_DIR (rename, zero-copy or verified copy)
                 dest_path = os.path.join(input_dir, file_path.name)
-                logging.info(f"Copying {file_path} (size: {file_size/1024:.2f} KB) to {dest_path}")
+                logging.info(f"Moving {file_path} (size: {file_size/1024:.2f} KB) to {dest_path}")
                 
-                if safe_copy_file(str(file_path), dest_path):
-                    logging.info(f"WAV file successfully copied: {file_path.name}")
-                    
-                    # Delete original file after successful copy
-                    if safe_delete_file(str(file_path)):
-                        logging.info(f"Original WAV file deleted: {file_path}")
-                    else:
-                        logging.error(f"Failed to delete original WAV file: {file_path}")
+                if transfer_file(str(file_path), dest_path, transfer_verify_min_size, transfer_retries):
+                    logging.info(f"Audio file successfully moved: {file_path.name}")
                 else:
-                    logging.error(f"Failed to copy WAV file: {file_path}")
+                    logging.error(f"Failed to move audio file: {file_path}")
             else:
                 logging.info(f"File {file_path} is too small ({file_size/1024:.2f} KB < {min_file_size/1024} KB)")
         except Exception as e:
-            logging.error(f"Error processing WAV file {file_path}: {str(e)}")
+            logging.error(f"Error processing audio file {file_path}: {str(e)}")
     
     def handle_pdf_file(self, file_path):
         """Process PDF file"""
@@ -242,9 +215,6 @@ class FileMonitorHandler(FileSystemEventHandler):
             if file_path.name.endswith('_formatted.txt'):
                 logging.info(f"Detected TXT file {file_path}, will be deleted")
                 
-                # Small delay to allow time for file operations to complete
-                time.sleep(2)
-                
                 # Delete TXT file
                 if safe_delete_file(str(file_path)):
                     logging.info(f"TXT file successfully deleted: {file_path}")
@@ -255,7 +225,7 @@ class FileMonitorHandler(FileSystemEventHandler):
 
 def start_monitoring():
     logging.info(f"Starting directory monitoring: {monitored_dir}")
-    logging.info(f"WAV files will be copied to: {input_dir}")
+    logging.info(f"Audio files will be moved to: {input_dir}")
     logging.info(f"PDF files will be processed with output to: {output_dir}")
     logging.info(f"Minimum file size: {min_file_size/1024} KB")
     
@@ -265,19 +235,29 @@ def start_monitoring():
         return
         
     if not os.path.exists(input_dir):
-        logging.error(f"Target directory for WAV does not exist: {input_dir}")
+        logging.error(f"Target directory for audio does not exist: {input_dir}")
         return
     
     if not os.path.exists(output_dir):
         logging.error(f"Output directory for PDF does not exist: {output_dir}")
         return
     
-    # Create event handler and observer
-    event_handler = FileMonitorHandler()
+    # Create event handler, scheduler and observer
+    events = queue.Queue(maxsize=event_queue_size)
+    event_handler = FileMonitorHandler(events)
+    scheduler = StabilityScheduler(
+        events,
+        event_handler.processed_files,
+        event_handler.process_stable_file,
+        workers=monitor_workers,
+        stability_seconds=stability_seconds,
+        compressed_stability_seconds=compressed_stability_seconds
+    )
     observer = Observer()
     observer.schedule(event_handler, monitored_dir, recursive=False)
     
-    # Start observer in separate thread
+    # Start scheduler and observer in separate threads
+    scheduler.start()
     observer.start()
     
     try:
@@ -288,6 +268,9 @@ def start_monitoring():
         observer.stop()
     
     observer.join()
+    # Let the workers finish files that are already being processed
+    scheduler.stop()
+    scheduler.join()
     logging.info("Monitoring stopped.")
 
 if __name__ == "__main__":
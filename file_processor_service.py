@@ -3,6 +3,7 @@ import time
 import shutil
 import re
 import json
+import hashlib
 from datetime import datetime, timedelta
 from pathlib import Path
 from dotenv import load_dotenv
@@ -11,7 +12,94 @@ import os.path
 import calendar
 import yaml
 from yaml.scanner import ScannerError
+import threading
+import sys
+import fitz  # PyMuPDF
 import metadata_processor
+import pdf_engine
+import audio_pipeline
+import audio_retention
+import process_runner
+import segment_store
+import transcript_export
+from transcript_model import Transcript, render_dialog_markdown
+from job_scheduler import ShortestJobFirstQueue, DEFAULT_AGING_RATE
+
+# Расширения файлов, которые принимает сервис
+SUPPORTED_EXTENSIONS = audio_pipeline.AUDIO_EXTENSIONS + ('.pdf',)
+
+# Оценка стоимости заданий в секундах аудио для очереди "сначала короткие"
+PDF_COST_PER_PAGE = 5.0
+# Сжатые форматы дополнительно декодируются ffmpeg
+COMPRESSED_AUDIO_COST_FACTOR = 1.1
+# Средний битрейт (байт/с) для оценки длительности, если ffprobe не ответил
+FALLBACK_AUDIO_BYTES_PER_SECOND = 16000
+
+# Примерное время обработки секунды аудио (WhisperX + диаризация на GPU) для разных моделей
+WHISPER_MODEL_RTF = {
+    'large-v3': 0.15,
+    'large-v2': 0.15,
+    'medium': 0.08,
+    'small': 0.04,
+    'base': 0.025,
+    'tiny': 0.02,
+}
+
+# Таймаут ffprobe при определении длительности записи, сек
+FFPROBE_TIMEOUT = 60
+
+# Строки вывода транскрибации, после которых процесс останавливается, не дожидаясь завершения
+NO_SPEECH = 'no_speech'
+# Запись отброшена проверкой тишины по энергии, до WhisperX: заметка помечается для ручной проверки
+SILENCE_PRECHECK = 'silence_precheck'
+TRANSCRIBE_ABORT_PATTERNS = dict(process_runner.FAILURE_PATTERNS, **{
+    NO_SPEECH: re.compile(re.escape("No active speech found in audio")),
+})
+
+# Конфигурация сервиса; загружается configure() при запуске или при первом вызове process_file()
+config = None
+
+# PDF, ожидающие пакетной обработки marker, и PDF пакета, который обрабатывается сейчас.
+# К этому моменту PDF уже перемещены в output_dir, поэтому оба списка сохраняются в
+# OUTPUT_DIR/PDF_BATCH_STATE_NAME и восстанавливаются при запуске (restore_pdf_batch)
+pending_pdf_batch = []
+running_pdf_batch = []
+pdf_batch_opened_at = 0.0
+pdf_batch_lock = threading.Lock()
+PDF_BATCH_STATE_NAME = '.pdf_batch.json'
+
+# Конвейер использует общее состояние (config, пакет PDF, счетчики попыток, WHISPER_TIMESTAMP
+# в окружении) и пишет заметки, поэтому обработка файлов, периодические задачи и изменение
+# заметок фоновыми заданиями выполняются под этой блокировкой
+pipeline_lock = threading.Lock()
+
+# Фоновое задание хранения аудио (перекодирование в Opus, квоты)
+retention_thread = None
+last_retention_time = 0.0
+
+# Неудачные попытки уточнения черновиков: путь заметки -> (попытки, время, не раньше которого повторять)
+refine_attempts = {}
+MAX_REFINE_ATTEMPTS = 3
+# Есть ли черновики для уточнения; при запуске неизвестно, поэтому каталог просматривается
+drafts_pending = True
+
+# Неудачные попытки транскрибации (по пути файла) и файлы, ожидающие повторной попытки:
+# путь -> (Path, время, не раньше которого файл возвращается в очередь)
+job_attempts = {}
+pending_retries = {}
+retry_lock = threading.Lock()
+# Переменные окружения прокси для marker задаются из нескольких потоков reprocess.py
+proxy_env_lock = threading.Lock()
+
+# Журнал попыток обогащения метаданных; загружается get_metadata_ledger() при первой проверке
+metadata_ledger = None
+# Отметка во frontmatter заметки, для которой попытки обогащения исчерпаны
+METADATA_STATUS_KEY = 'metadata_status'
+METADATA_FAILED = 'failed'
+
+# Последняя выданная метка времени сеанса обработки
+last_session_time = None
+session_time_lock = threading.Lock()
 
 def load_config():
     """Load configuration from .env file"""
@@ -52,9 +140,74 @@ def load_config():
         'openrouter_api_key': os.getenv('OPENROUTER_API_KEY'),
         'openrouter_model': os.getenv('OPENROUTER_MODEL', 'gemini-2.5-pro-exp-03-25'), 
         'prompt_file_path': str(prompt_file_abs), 
-        'metadata_check_interval': int(os.getenv('METADATA_CHECK_INTERVAL', '300')) 
+        'metadata_check_interval': int(os.getenv('METADATA_CHECK_INTERVAL', '300')),
+        # На сколько секунд аудио снижается стоимость задания за каждую секунду ожидания
+        'job_aging_rate': float(os.getenv('JOB_AGING_RATE', str(DEFAULT_AGING_RATE))),
+        # run.bat - скрипт для Windows (по умолчанию); worker - transcribe_worker.py (любая ОС), включается явно
+        'transcriber': os.getenv('TRANSCRIBER', 'run.bat'),
+        # Модель WhisperX по умолчанию и более быстрые модели для работы под нагрузкой (по убыванию качества)
+        'whisper_model': os.getenv('WHISPER_MODEL', 'large-v2'),
+        'whisper_fast_models': [m.strip() for m in os.getenv('WHISPER_FAST_MODELS', 'medium,small').split(',') if m.strip()],
+        'whisper_device': os.getenv('WHISPER_DEVICE', 'cuda'),
+        # Желаемое время от появления файла до заметки, сек; 0 - всегда модель по умолчанию
+        'whisper_latency_sla': float(os.getenv('WHISPER_LATENCY_SLA', '0')),
+        # Записи не короче этой длительности (сек) сначала распознаются быстрым черновиком,
+        # а затем в фоне уточняются полной моделью с диаризацией; 0 отключает
+        'draft_min_duration': float(os.getenv('DRAFT_MIN_DURATION', '0')),
+        'draft_model': os.getenv('WHISPER_DRAFT_MODEL', 'small'),
+        # Записи с долей речи ниже порога не отправляются на GPU (0 отключает проверку)
+        'min_speech_ratio': float(os.getenv('MIN_SPEECH_RATIO', '0.01')),
+        # Жесткий таймаут транскрибации: база + коэффициент * длительность записи (сек);
+        # по истечении процесс и его дочерние процессы завершаются
+        'transcribe_timeout_base': float(os.getenv('TRANSCRIBE_TIMEOUT_BASE', '600')),
+        'transcribe_timeout_factor': float(os.getenv('TRANSCRIBE_TIMEOUT_FACTOR', '1.0')),
+        # Попытки транскрибации одного файла; между попытками пауза, удваивающаяся с каждой попыткой
+        'job_max_attempts': int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+        'job_retry_delay': float(os.getenv('JOB_RETRY_DELAY', '60')),
+        # Журналы вывода WhisperX и marker по заданиям; пустое значение отключает журналы
+        'job_log_dir': os.getenv('JOB_LOG_DIR', str(output_dir_abs / '.job_logs')) or None,
+        # Сохранять сегменты рядом с заметкой ({prefix}_transcript.segments) для повторного рендеринга
+        'retain_segments': os.getenv('RETAIN_SEGMENTS', 'true').lower() in ('1', 'true', 'yes'),
+        # Попытки обогащения метаданных одной заметки; между попытками пауза, удваивающаяся с каждой попыткой.
+        # После последней заметка помечается metadata_status: failed и пропускается до изменения текста
+        'metadata_max_attempts': int(os.getenv('METADATA_MAX_ATTEMPTS', '5')),
+        'metadata_retry_delay': float(os.getenv('METADATA_RETRY_DELAY', '600')),
+        'metadata_ledger_path': os.getenv('METADATA_LEDGER_PATH', str(output_dir_abs / '.metadata_ledger.json')),
+        # Локальный классификатор проекта по размеченным заметкам; LLM вызывается только для неоднозначных
+        'local_classifier': os.getenv('LOCAL_CLASSIFIER', 'true').lower() in ('1', 'true', 'yes'),
+        'classifier_min_confidence': float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', str(metadata_processor.DEFAULT_MIN_CONFIDENCE))),
+        'classifier_min_similarity': float(os.getenv('CLASSIFIER_MIN_SIMILARITY', str(metadata_processor.DEFAULT_MIN_SIMILARITY))),
+        'classifier_cache_path': os.getenv('CLASSIFIER_CACHE_PATH', str(output_dir_abs / metadata_processor.CLASSIFIER_CACHE_NAME)),
+        # Запрашивать у LLM клиента и событие/назначение для заметок с локально определенным проектом
+        'classifier_fetch_details': os.getenv('CLASSIFIER_FETCH_DETAILS', 'false').lower() in ('1', 'true', 'yes'),
+        # В запрос к LLM попадают только записи файлов контекста, релевантные заметке (0 - без ограничения)
+        'context_top_k': int(os.getenv('CONTEXT_TOP_K', str(metadata_processor.DEFAULT_CONTEXT_TOP_K))),
+        'context_token_budget': int(os.getenv('CONTEXT_TOKEN_BUDGET', str(metadata_processor.DEFAULT_CONTEXT_TOKEN_BUDGET))),
+        'pdf_quality_threshold': float(os.getenv('PDF_QUALITY_THRESHOLD', str(pdf_engine.DEFAULT_QUALITY_THRESHOLD))),
+        'pdf_escalate_ratio': float(os.getenv('PDF_ESCALATE_RATIO', str(pdf_engine.DEFAULT_ESCALATE_RATIO))),
+        'pdf_batch_window': int(os.getenv('PDF_BATCH_WINDOW', '30')),  # seconds, 0 disables batching
+        'pdf_batch_max_size': int(os.getenv('PDF_BATCH_MAX_SIZE', '20')),
+        'pdf_batch_workers': int(os.getenv('PDF_BATCH_WORKERS', '1')),
+        # Кэш распознанных страниц PDF; пустое значение отключает кэш
+        'pdf_page_cache_dir': os.getenv('PDF_PAGE_CACHE_DIR', str(output_dir_abs / '.pdf_page_cache')) or None,
+        # Хранение обработанных записей: перекодирование в Opus и квоты (0 отключает)
+        'audio_transcode_after_days': float(os.getenv('AUDIO_TRANSCODE_AFTER_DAYS', '0')),
+        'audio_opus_bitrate': os.getenv('AUDIO_OPUS_BITRATE', audio_retention.DEFAULT_OPUS_BITRATE),
+        'audio_max_age_days': float(os.getenv('AUDIO_MAX_AGE_DAYS', '0')),
+        'audio_max_total_bytes': int(float(os.getenv('AUDIO_MAX_TOTAL_GB', '0')) * 1024 ** 3),
+        'retention_check_interval': int(os.getenv('RETENTION_CHECK_INTERVAL', '3600'))
     }
 
+def configure(new_config=None):
+    """Set the module configuration used by the pipeline functions (loads it from .env by default)"""
+    global config
+    config = new_config if new_config is not None else load_config()
+    if config['draft_min_duration'] > 0 and config['transcriber'] == 'run.bat':
+        # run.bat всегда запускает диаризацию, черновик без нее делает только transcribe_worker.py
+        print(f"[WARNING] DRAFT_MIN_DURATION={config['draft_min_duration']:g} не действует с TRANSCRIBER=run.bat: "
+              "двухпроходный режим черновика требует TRANSCRIBER=worker")
+    return config
+
 def ensure_directories():
     """Create required directories if they don't exist"""
     # Теперь создание каталогов происходит в load_config
@@ -84,48 +237,9 @@ def log_files_in_dir(directory):
         print(f"No files found in directory {directory}.")
     print("==========================================\n")
 
-def format_timestamp(seconds):
-    """Format time in MM:SS format or HH:MM:SS if over an hour"""
-    total_seconds = round(seconds)
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    seconds = total_seconds % 60
-    
-    if hours > 0:
-        return f"{hours}:{minutes:02d}:{seconds:02d}"
-    else:
-        return f"{minutes}:{seconds:02d}"
-
-def extract_segments_to_txt(json_file, txt_file):
-    """Extract segments from JSON and save to TXT"""
-    print(f"Extracting segments from {json_file.name}...")
-    
-    if not json_file.exists():
-        print(f"[ERROR] JSON file not found: {json_file}")
-        return False
-    
-    try:
-        with open(json_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        segments = data.get("segments", [])
-        if not segments:
-            print("[INFO] No segments found in JSON file.")
-            return False
-        
-        with open(txt_file, "w", encoding="utf-8") as out:
-            for seg in segments:
-                start = format_timestamp(seg["start"])
-                end = format_timestamp(seg["end"])
-                speaker = seg.get("speaker", "SPEAKER_??")
-                text = seg.get("text", "").strip()
-                out.write(f"[{start} - {end}] {speaker}: {text}\n")
-        
-        print(f"[INFO] Segments with timestamps saved to file: {txt_file.name}")
-        return True
-    except Exception as e:
-        print(f"[ERROR] Error processing JSON: {str(e)}")
-        return False
+def is_syncthing_temp_file(file_path):
+    """Check if the file is a syncthing temporary file that is still being synced"""
+    return file_path.name.startswith("~syncthing~") and file_path.name.endswith(".tmp")
 
 def format_duration_for_filename(seconds):
     """Format duration in MMSS format for filename"""
@@ -139,13 +253,45 @@ def get_audio_duration(file_path):
     try:
         cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
                '-of', 'default=noprint_wrappers=1:nokey=1', str(file_path)]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=FFPROBE_TIMEOUT)
         duration = float(result.stdout.strip())
         return duration
     except Exception as e:
         print(f"Error getting audio duration: {str(e)}")
         return 0
 
+def estimate_job_cost(file_path):
+    """Estimate processing cost of a file in seconds of audio, for shortest-job-first ordering"""
+    file_ext = file_path.suffix.lower()
+    if file_ext == '.pdf':
+        try:
+            with fitz.open(file_path) as doc:
+                pages = doc.page_count
+        except Exception:
+            pages = max(1, file_path.stat().st_size // (100 * 1024))
+        return pages * PDF_COST_PER_PAGE
+    
+    # Длительность WAV берется из заголовка, для остальных форматов - через ffprobe
+    duration = audio_pipeline.wav_duration(file_path) or get_audio_duration(file_path)
+    if not duration:
+        duration = file_path.stat().st_size / FALLBACK_AUDIO_BYTES_PER_SECOND
+    if file_ext != '.wav':
+        duration *= COMPRESSED_AUDIO_COST_FACTOR
+    return duration
+
+def allocate_session_timestamp():
+    """Return a processing timestamp that is unique within this service run.
+       Several files processed within the same second would otherwise get the
+       same filename prefix and overwrite each other in output_dir.
+    """
+    global last_session_time
+    with session_time_lock:
+        now = datetime.now().replace(microsecond=0)
+        if last_session_time is not None and now <= last_session_time:
+            now = last_session_time + timedelta(seconds=1)
+        last_session_time = now
+    return now.strftime('%Y%m%d_%H%M%S')
+
 def generate_filename_prefix(timestamp, duration):
     """Generate filename prefix based on date, time and duration"""
     dt = datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
@@ -160,52 +306,121 @@ def generate_filename_prefix(timestamp, duration):
     
     return f"{month_day}_{day_of_week}_{time_str}_{duration_str}"
 
-def update_bat_file_with_timestamp(timestamp):
-    """Update run.bat with timestamp for output filenames"""
-    try:
-        run_bat_path = Path("run.bat")
-        if not run_bat_path.exists():
-            print("[ERROR] run.bat file not found")
+def select_whisper_model(duration, backlog_seconds=0.0):
+    """Pick the WhisperX model and compute type for a job.
+       The default model is used unless the job plus the queued backlog would miss
+       the latency SLA; then the best faster model that fits is chosen (the fastest
+       one if none fits). Returns (model, compute_type).
+    """
+    default_model = config['whisper_model']
+    device = config['whisper_device']
+    model = default_model
+    
+    sla = config['whisper_latency_sla']
+    if sla > 0:
+        # Очередь оценивается по скорости модели по умолчанию
+        default_rtf = WHISPER_MODEL_RTF.get(default_model, 0.15)
+        backlog_time = backlog_seconds * default_rtf
+        candidates = [default_model] + [m for m in config['whisper_fast_models'] if m != default_model]
+        model = candidates[-1]
+        for candidate in candidates:
+            if backlog_time + duration * WHISPER_MODEL_RTF.get(candidate, default_rtf) <= sla:
+                model = candidate
+                break
+    
+    if device == 'cuda':
+        compute_type = 'float16' if model == default_model else 'int8_float16'
+    else:
+        compute_type = 'int8'
+    return model, compute_type
+
+def transcribe_timeout(duration):
+    """Hard timeout for transcribing a recording of the given duration, in seconds"""
+    return config['transcribe_timeout_base'] + config['transcribe_timeout_factor'] * duration
+
+def job_log_path(name):
+    """Path of the per-job log for subprocess output, or None if job logs are disabled"""
+    if not config['job_log_dir']:
+        return None
+    return Path(config['job_log_dir']) / f"{name}.log"
+
+def next_faster_model(model):
+    """The next faster model after model in the configured chain, or None"""
+    chain = [config['whisper_model']] + config['whisper_fast_models']
+    if model not in chain or chain.index(model) + 1 >= len(chain):
+        return None
+    return chain[chain.index(model) + 1]
+
+def schedule_job_retry(file_path):
+    """
+    Записывает неудачную попытку транскрибации и откладывает повтор
+
+    Returns:
+        bool: True, если файл будет обработан повторно; False, если попытки исчерпаны
+    """
+    key = str(file_path)
+    with retry_lock:
+        attempts = job_attempts.get(key, 0) + 1
+        if attempts >= config['job_max_attempts']:
+            job_attempts.pop(key, None)
+            print(f"[ERROR] {file_path.name}: попытки транскрибации исчерпаны ({attempts})")
             return False
-        
-        # Read the original content
-        with open(run_bat_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        # Create a backup
-        backup_path = run_bat_path.with_suffix(".bak")
-        with open(backup_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        
-        # Set environment variable for timestamp
-        os.environ["WHISPER_TIMESTAMP"] = timestamp
-        
-        print(f"[INFO] Set timestamp for WhisperX output files: {timestamp}")
-        
-        # Удаляем backup файл после использования
-        if backup_path.exists():
-            backup_path.unlink()
-            print("[INFO] Удален временный файл run.bak")
-            
-        return True
-    except Exception as e:
-        print(f"[ERROR] Failed to update run.bat: {str(e)}")
-        return False
+        job_attempts[key] = attempts
+        delay = config['job_retry_delay'] * 2 ** (attempts - 1)
+        pending_retries[key] = (file_path, time.time() + delay)
+    print(f"[INFO] {file_path.name}: попытка {attempts} из {config['job_max_attempts']} не удалась, повтор через {delay:.0f} с")
+    return True
+
+def pop_due_retries():
+    """Remove and return (key, Path) of files whose retry delay has passed and that still exist"""
+    now = time.time()
+    due = []
+    with retry_lock:
+        for key, (file_path, due_time) in list(pending_retries.items()):
+            if due_time > now:
+                continue
+            del pending_retries[key]
+            if file_path.exists():
+                due.append((key, file_path))
+            else:
+                job_attempts.pop(key, None)
+    return due
+
+def requeue_due_retries(job_queue):
+    """Return files whose retry delay has passed to the job queue"""
+    for key, file_path in pop_due_retries():
+        job_queue.add(key, file_path, estimate_job_cost(file_path))
+
+def is_draft_job(duration):
+    """Check if the recording is long enough for the two-pass draft-then-refine mode"""
+    # Черновик без диаризации умеет делать только transcribe_worker.py
+    return (config['transcriber'] != 'run.bat'
+            and config['draft_min_duration'] > 0
+            and duration >= config['draft_min_duration'])
+
+def build_transcribe_command(audio_path, output_dir, model, compute_type, diarize=True, pcm_stdin=False):
+    """Build the transcription command for the configured transcriber.
+       With pcm_stdin the worker reads decoded PCM from stdin; audio_path only names the result.
+    """
+    if config['transcriber'] == 'run.bat':
+        # run.bat берет модель и тип вычислений из окружения
+        return ['run.bat', str(audio_path), output_dir]
+    worker_script = Path(__file__).resolve().parent / 'transcribe_worker.py'
+    command = [sys.executable, str(worker_script), str(audio_path), output_dir,
+               '--model', model, '--device', config['whisper_device'], '--compute_type', compute_type]
+    if not diarize:
+        command.append('--no_diarize')
+    if pcm_stdin:
+        command += ['--pcm', '-']
+    return command
 
 def find_whisperx_outputs(output_dir, file_name, timestamp):
     """Find all files created by WhisperX for the given input file"""
-    # List of possible intermediate file extensions
-    extensions = [".json", ".txt", ".srt", ".vtt", ".tsv"]
-    
-    # List of patterns to search for files
+    # Транскрибатор пишет только JSON (run.bat: --output_format json); субтитры
+    # создаются по запросу из сохраненных сегментов (transcript_export.py)
     patterns = [
         f"{file_name}.json",  # Standard JSON file
         f"{file_name}_*.json",  # JSON files with any suffix
-        f"{file_name}*.txt",   # TXT files
-        f"{file_name}*.srt",   # SRT files 
-        f"{file_name}*.vtt",   # VTT files
-        f"{file_name}*.tsv",   # TSV files
-        f"{file_name}_{timestamp}*.txt"  # Formatted TXT file
     ]
     
     result = set()  # Use a set instead of a list to avoid duplicates
@@ -214,7 +429,7 @@ def find_whisperx_outputs(output_dir, file_name, timestamp):
             if file_path.is_file():
                 # Exclude MD file and original audio file
                 if not (file_path.suffix == '.md' or 
-                        (file_path.suffix in ['.wav', '.mp3', '.ogg'] and timestamp in file_path.stem)):
+                        (file_path.suffix in audio_pipeline.AUDIO_EXTENSIONS and timestamp in file_path.stem)):
                     result.add(file_path)
     
     return list(result)  # Return a list for compatibility
@@ -223,43 +438,84 @@ def check_no_speech(output):
     """Check if the output contains 'No active speech found in audio'"""
     return "No active speech found in audio" in output
 
-def group_and_format_dialog(input_file, output_md, original_filename, processed_filename, timestamp, duration):
-    """Group and format dialog in Markdown format"""
-    print(f"Formatting dialog to Markdown...")
+def streams_pcm_to_transcriber(audio_path):
+    """Check if the service decodes the recording itself and feeds PCM to the transcriber's stdin.
+       Only transcribe_worker.py reads PCM from stdin; run.bat gets the original file.
+       A PCM16 WAV is not streamed: the silence check and the worker map it into memory.
+    """
+    if config['transcriber'] == 'run.bat':
+        return False
+    try:
+        return audio_pipeline.open_wav_pcm16(audio_path) is None
+    except OSError:
+        return False
+
+def stream_pcm_for_transcription(audio_path):
+    """Decode the recording once and yield PCM chunks for the transcriber's stdin.
+       The silence check runs over the same chunks; for a silent recording the
+       transcriber is stopped before its input is complete, so no model is loaded.
+    """
+    meter = audio_pipeline.SpeechMeter() if config['min_speech_ratio'] > 0 else None
+    for chunk in audio_pipeline.iter_pcm_chunks(audio_path):
+        if meter is not None:
+            meter.add(chunk)
+        yield chunk
+    if meter is not None and is_below_speech_ratio(meter.speech_ratio()):
+        raise process_runner.InputAborted(SILENCE_PRECHECK, "запись почти без речи")
+
+def is_silent_audio(file_path):
+    """Check with a cheap energy-based VAD whether the recording has (almost) no speech"""
+    if config['min_speech_ratio'] <= 0:
+        return False
+    speech_ratio = audio_pipeline.estimate_speech_ratio(file_path)
+    if speech_ratio is None:
+        # Не удалось оценить - решение остается за WhisperX
+        return False
+    return is_below_speech_ratio(speech_ratio)
+
+def is_below_speech_ratio(speech_ratio):
+    """Report the speech ratio of a recording and check it against min_speech_ratio"""
+    print(f"[INFO] Доля кадров с речью: {speech_ratio:.1%}")
+    if speech_ratio < config['min_speech_ratio']:
+        print(f"[INFO] Запись почти без речи (< {config['min_speech_ratio']:.1%}), транскрибация пропущена")
+        return True
+    return False
+
+def load_transcript(json_file):
+    """Load WhisperX JSON into a Transcript; None if it cannot be read or has no segments"""
+    print(f"Extracting segments from {json_file.name}...")
+    
+    if not json_file.exists():
+        print(f"[ERROR] JSON file not found: {json_file}")
+        return None
+    
+    try:
+        transcript = Transcript.load(json_file)
+    except Exception as e:
+        print(f"[ERROR] Error processing JSON: {str(e)}")
+        return None
     
-    if not input_file.exists():
-        print(f"[ERROR] File not found: {input_file}")
+    if not len(transcript):
+        print("[INFO] No segments found in JSON file.")
+        return None
+    return transcript
+
+def retain_segments(transcript, segments_file):
+    """Save the transcript next to its note ({prefix}_transcript.segments) for re-rendering and analytics"""
+    try:
+        transcript.save(segments_file)
+        return True
+    except Exception as e:
+        print(f"[WARNING] Не удалось сохранить сегменты {segments_file.name}: {str(e)}")
         return False
+
+def group_and_format_dialog(transcript, output_md, original_filename, processed_filename, timestamp, duration,
+                            whisper_model=None, compute_type=None, transcript_status=None):
+    """Group and format dialog in Markdown format"""
+    print(f"Formatting dialog to Markdown...")
     
     try:
-        with input_file.open("r", encoding="utf-8") as f:
-            lines = f.readlines()
-        
-        dialog = []
-        current_speaker = None
-        current_block = []
-        
-        for idx, line in enumerate(lines):
-            line = line.strip()
-            match = re.match(r"\[(.+?) - (.+?)\] (SPEAKER_\d{2}|Speaker \d+): (.+)", line)
-            if not match:
-                print(f"[WARNING] Line {idx + 1} does not match format: {line}")
-                continue
-            
-            start, end, speaker, text = match.groups()
-            if speaker != current_speaker:
-                if current_block:
-                    dialog.append((current_speaker, current_block))
-                current_speaker = speaker
-                current_block = [(start, end, text)]
-            else:
-                current_block.append((start, end, text))
-        
-        if current_block:
-            dialog.append((current_speaker, current_block))
-        
-        speaker_map = {}
-        speaker_counter = 1
+        dialog_markdown = render_dialog_markdown(transcript)
         
         # Форматированная дата и время для метаданных
         formatted_date = datetime.strptime(timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
@@ -269,25 +525,15 @@ def group_and_format_dialog(input_file, output_md, original_filename, processed_
             out.write("---\n")
             out.write(f"created: {formatted_date}\n")
             # Используем новый формат ссылки (исправлено)
-            out.write(f'original_filename: "[[{processed_filename}|{original_filename}]]"\\n') 
-            out.write(f"duration: {timedelta(seconds=duration)}\\n")
+            out.write(f'original_filename: "[[{processed_filename}|{original_filename}]]"\n') 
+            out.write(f"duration: {timedelta(seconds=duration)}\n")
+            if whisper_model:
+                out.write(f"whisper_model: {whisper_model}\n")
+                out.write(f"compute_type: {compute_type}\n")
+            if transcript_status:
+                out.write(f"transcript_status: {transcript_status}\n")
             out.write("---\n\n")
-            
-            for raw_speaker, blocks in dialog:
-                if raw_speaker not in speaker_map:
-                    speaker_map[raw_speaker] = f"Speaker {speaker_counter}"
-                    speaker_counter += 1
-                name = speaker_map[raw_speaker]
-                
-                # Получаем время начала и окончания всего блока
-                block_start = blocks[0][0]
-                block_end = blocks[-1][1]
-                
-                out.write(f"### {name} *[{block_start} - {block_end}]*\n\n")
-                for start, end, text in blocks:
-                    # Убираем время из каждой строки
-                    out.write(f"- {text}\n")
-                out.write("\n")
+            out.write(dialog_markdown)
         
         print(f"[DONE] Markdown file saved: {output_md.name}")
         return True
@@ -295,13 +541,33 @@ def group_and_format_dialog(input_file, output_md, original_filename, processed_
         print(f"[ERROR] Error creating Markdown: {str(e)}")
         return False
 
-def process_pdf_file(file_path, output_dir):
-    """Process PDF file using marker_single"""
+def apply_proxy_env():
+    """Set proxy environment variables for marker and return the proxy URL"""
+    # Устанавливаем переменные окружения для прокси
+    proxy_host = config['proxy_host']
+    proxy_port = config['proxy_port']
+    proxy_user = config['proxy_user']
+    proxy_pass = config['proxy_pass']
+    
+    # Формируем URL прокси
+    proxy_url = f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}"
+    
+    # Устанавливаем переменные окружения
+    with proxy_env_lock:
+        os.environ['HTTPS_PROXY'] = proxy_url
+        os.environ['HTTP_PROXY'] = proxy_url
+    return proxy_url
+
+def process_pdf_file(file_path, output_dir, defer_marker=False):
+    """Process PDF file: fast PyMuPDF extraction, marker_single for low-quality pages.
+       With defer_marker=True documents that need full marker conversion are not
+       converted here: (False, "", pdf_engine.MARKER_DEFERRED) is returned instead.
+    """
     try:
         print(f"Starting PDF file processing: {file_path}")
         
         # Get Gemini API key from .env file
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
+        gemini_api_key = pdf_engine.get_gemini_api_key()
         
         if not gemini_api_key:
             print("[WARNING] Gemini API key not found in .env file. Processing will be done without using LLM.")
@@ -309,64 +575,29 @@ def process_pdf_file(file_path, output_dir):
         else:
             print(f"[INFO] Найден API ключ Gemini. Будем использовать LLM для улучшения качества обработки PDF.")
         
-        # Устанавливаем переменные окружения для прокси
-        proxy_host = config['proxy_host']
-        proxy_port = config['proxy_port']
-        proxy_user = config['proxy_user']
-        proxy_pass = config['proxy_pass']
-        
-        # Формируем URL прокси
-        proxy_url = f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}"
-        
-        # Устанавливаем переменные окружения
-        os.environ['HTTPS_PROXY'] = proxy_url
-        os.environ['HTTP_PROXY'] = proxy_url
-        
-        # Базовые параметры для marker_single
-        command = [
-            'marker_single',
-            str(file_path),
-            '--output_dir', output_dir,
-            '--output_format', 'markdown',
-            '--disable_tqdm',               # Отключаем прогресс-бары для фонового процесса
-            '--max_concurrency', '3'        # Извлекать таблицы из PDF
-        ]
-        
-        # Если доступен API ключ Gemini, добавляем параметры для использования LLM
-        if gemini_api_key:
-            command.extend([
-                '--use_llm',                  # Включаем LLM для лучшего качества
-                '--gemini_api_key', gemini_api_key,
-                '--model_name', config['gemini_model']
-            ])
-        
-        print(f"[EXECUTING] Команда: {' '.join(command)}")
+        proxy_url = apply_proxy_env()
         print(f"[INFO] Используется прокси: {proxy_url}")
         
-        # Запускаем процесс с поддержкой разных кодировок
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            errors='replace'  # Заменяем нечитаемые символы на специальный символ
+        # Сначала быстрый путь PyMuPDF, marker_single только для страниц низкого качества
+        success, command_output, processor = pdf_engine.convert_pdf(
+            file_path,
+            output_dir,
+            gemini_api_key=gemini_api_key,
+            gemini_model=config['gemini_model'],
+            quality_threshold=config['pdf_quality_threshold'],
+            escalate_ratio=config['pdf_escalate_ratio'],
+            defer_marker=defer_marker,
+            cache_dir=config['pdf_page_cache_dir'],
+            log_path=job_log_path(file_path.stem)
         )
         
-        stdout, stderr = process.communicate()
+        if processor == pdf_engine.MARKER_DEFERRED:
+            print(f"[INFO] PDF требует полной обработки marker, будет обработан пакетом")
+            return False, command_output, processor
         
-        # Подготавливаем вывод команды для логирования и возможного использования в отчете об ошибке
-        command_output = ""
-        if stdout:
-            command_output += "STDOUT:\n" + stdout + "\n\n"
-        if stderr:
-            command_output += "STDERR:\n" + stderr
-        
-        # Добавляем небольшую паузу перед проверкой файла
-        time.sleep(1) 
-            
-        if process.returncode != 0:
-            print(f"[ERROR] Ошибка обработки PDF: {stderr}")
-            return False, command_output
+        if not success:
+            print(f"[ERROR] Ошибка обработки PDF ({processor})")
+            return False, command_output, processor
         
         # Проверяем создание файла в выходном каталоге
         output_dir_path = Path(output_dir)
@@ -376,16 +607,16 @@ def process_pdf_file(file_path, output_dir):
         output_file = output_dir_path / f"{base_name}" / f"{base_name}.md"
         
         if output_file.exists():
-            print(f"[SUCCESS] Создан файл маркдаун: {output_file.name}")
-            return True, command_output
+            print(f"[SUCCESS] Создан файл маркдаун ({processor}): {output_file.name}")
+            return True, command_output, processor
         else:
             print(f"[WARNING] Маркдаун файл не был создан, хотя команда завершилась успешно")
-            return False, command_output
+            return False, command_output, processor
         
     except Exception as e:
-        error_msg = f"[ERROR] Ошибка запуска marker_single: {str(e)}"
+        error_msg = f"[ERROR] Ошибка обработки PDF: {str(e)}"
         print(error_msg)
-        return False, error_msg
+        return False, error_msg, None
 
 def parse_frontmatter(file_path):
     """Parse YAML frontmatter from a Markdown file."""
@@ -418,6 +649,102 @@ def parse_frontmatter(file_path):
         print(f"[ERROR] Не удалось прочитать файл {file_path.name} для парсинга frontmatter: {e}")
         return None, None # Возвращаем None, если файл не прочитался
 
+class MetadataLedger:
+    """Per-note attempts of metadata enrichment, persisted so that backoff survives restarts.
+       Entries are keyed by note path and tied to a hash of the note body: once the body
+       changes, the note gets a fresh set of attempts.
+    """
+    def __init__(self, ledger_path):
+        self.ledger_path = Path(ledger_path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.ledger_path.exists():
+            try:
+                self.entries = json.loads(self.ledger_path.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as e:
+                print(f"[WARNING] Не удалось прочитать журнал обогащения метаданных {self.ledger_path}: {e}")
+
+    @staticmethod
+    def key(md_file):
+        return str(Path(md_file).resolve())
+
+    def save(self):
+        tmp_path = self.ledger_path.with_name(f"{self.ledger_path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.entries, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp_path, self.ledger_path)
+
+    def skip_reason(self, md_file, content_hash, marked_failed):
+        """None if the note may be sent to the LLM now, otherwise 'failed' or 'backoff'"""
+        key = self.key(md_file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if not marked_failed:
+                    return None
+                # Журнал утерян, но отметка во frontmatter остается в силе для текущего текста
+                self.entries[key] = {'hash': content_hash, 'attempts': 0, 'next_attempt': 0, 'failed': True}
+                self.save()
+                return 'failed'
+            if entry['hash'] != content_hash or (entry['failed'] and not marked_failed):
+                # Текст изменился или пользователь снял отметку - попытки начинаются заново
+                self.entries[key] = {'hash': content_hash, 'attempts': 0, 'next_attempt': 0, 'failed': False}
+                self.save()
+                return None
+            if entry['failed']:
+                return 'failed'
+            if entry['next_attempt'] > time.time():
+                return 'backoff'
+            return None
+
+    def record_failure(self, md_file, content_hash, max_attempts, retry_delay):
+        """
+        Записывает неудачную попытку обогащения
+
+        Returns:
+            float: Пауза до следующей попытки (сек) или None, если попытки исчерпаны
+        """
+        key = self.key(md_file)
+        with self.lock:
+            entry = self.entries.get(key)
+            attempts = (entry['attempts'] if entry and entry['hash'] == content_hash else 0) + 1
+            failed = attempts >= max_attempts
+            delay = None if failed else retry_delay * 2 ** (attempts - 1)
+            self.entries[key] = {
+                'hash': content_hash,
+                'attempts': attempts,
+                'next_attempt': 0 if failed else time.time() + delay,
+                'failed': failed,
+            }
+            self.save()
+            return delay
+
+    def record_success(self, md_file):
+        with self.lock:
+            if self.entries.pop(self.key(md_file), None) is not None:
+                self.save()
+
+    def prune(self, existing_files):
+        """Forget notes that no longer exist (deleted or moved out of the output directory)"""
+        existing = {self.key(md_file) for md_file in existing_files}
+        with self.lock:
+            stale = [key for key in self.entries if key not in existing]
+            for key in stale:
+                del self.entries[key]
+            if stale:
+                self.save()
+
+def get_metadata_ledger():
+    """The metadata enrichment ledger, loaded from METADATA_LEDGER_PATH on first use"""
+    global metadata_ledger
+    if metadata_ledger is None:
+        metadata_ledger = MetadataLedger(config['metadata_ledger_path'])
+    return metadata_ledger
+
+def note_content_hash(content):
+    """Hash of a note body; frontmatter edits (including the failure marker) do not change it"""
+    # Без frontmatter тело начинается сразу, после добавления отметки - с перевода строки
+    return hashlib.sha1(content.strip().encode('utf-8')).hexdigest()
+
 def check_single_md_metadata(md_file: Path, config: dict):
     """Checks a single MD file for required metadata and triggers LLM if needed.
        Returns True if LLM was triggered and completed successfully,
@@ -429,16 +756,30 @@ def check_single_md_metadata(md_file: Path, config: dict):
         return False # Не триггерили LLM
 
     print(f"Проверка метаданных файла: {md_file.name}")
-    metadata, _ = parse_frontmatter(md_file)
+    metadata, content = parse_frontmatter(md_file)
 
     if metadata is None: # Ошибка чтения или парсинга файла
         print(f"[SKIPPING] Пропуск файла {md_file.name} из-за ошибки чтения/парсинга.")
         return False
     
     required_keys = {'группа', 'проект', 'событие/назначение'} 
+    if metadata.get(metadata_processor.SOURCE_KEY) == 'local':
+        # Локальный классификатор определяет только группу и проект
+        required_keys -= set(metadata_processor.DETAIL_KEYS)
     missing_keys = required_keys - set(metadata.keys())
 
     if 'проект' in missing_keys:
+        ledger = get_metadata_ledger()
+        content_hash = note_content_hash(content)
+        marked_failed = str(metadata.get(METADATA_STATUS_KEY)) == METADATA_FAILED
+        skip_reason = ledger.skip_reason(md_file, content_hash, marked_failed)
+        if skip_reason == 'failed':
+            print(f"[SKIPPING] {md_file.name}: попытки обогащения метаданных исчерпаны, ожидается изменение текста заметки.")
+            return False
+        if skip_reason == 'backoff':
+            print(f"[SKIPPING] {md_file.name}: повторная попытка обогащения метаданных отложена.")
+            return False
+
         print(f"[INFO] В файле {md_file.name} отсутствует 'проект'. Запуск обработки LLM...")
         try:
             # Проверяем наличие API ключа перед вызовом
@@ -457,10 +798,14 @@ def check_single_md_metadata(md_file: Path, config: dict):
             
             # Проверяем результат
             if llm_result == "RATE_LIMIT_ERROR":
-                return "RATE_LIMIT_ERROR" # Возвращаем маркер
+                return "RATE_LIMIT_ERROR" # Возвращаем маркер; лимит API не считается попыткой
             elif llm_result is True: # Успешный вызов и обновление файла
+                 ledger.record_success(md_file)
+                 if marked_failed:
+                     replace_note_body(md_file, None, {METADATA_STATUS_KEY: None})
                  return True
             else: # Ошибка или файл не обновлен
+                 record_metadata_failure(md_file, content_hash, marked_failed)
                  return False
                  
         except ImportError:
@@ -470,6 +815,7 @@ def check_single_md_metadata(md_file: Path, config: dict):
             print(f"[ERROR] Непредвиденная ошибка при вызове обработчика LLM для файла {md_file.name}: {e}")
             import traceback
             traceback.print_exc()
+            record_metadata_failure(md_file, content_hash, marked_failed)
             return False
     elif missing_keys:
          print(f"[WARNING] В файле {md_file.name} отсутствуют метаданные: {', '.join(missing_keys)} (кроме 'проект')")
@@ -478,6 +824,21 @@ def check_single_md_metadata(md_file: Path, config: dict):
         print(f"[OK] Все необходимые метаданные присутствуют в файле: {md_file.name}")
         return False # LLM не запускался
         
+def record_metadata_failure(md_file, content_hash, marked_failed):
+    """Record a failed enrichment attempt; marks the note once the attempts are exhausted"""
+    delay = get_metadata_ledger().record_failure(
+        md_file, content_hash, config['metadata_max_attempts'], config['metadata_retry_delay'])
+    if delay is not None:
+        print(f"[INFO] {md_file.name}: обогащение метаданных не удалось, повтор не раньше чем через {delay:.0f} с")
+        return
+    print(f"[ERROR] {md_file.name}: попытки обогащения метаданных исчерпаны ({config['metadata_max_attempts']}), "
+          f"заметка помечена {METADATA_STATUS_KEY}: {METADATA_FAILED}")
+    if not marked_failed:
+        try:
+            replace_note_body(md_file, None, {METADATA_STATUS_KEY: METADATA_FAILED})
+        except OSError as e:
+            print(f"[ERROR] Не удалось записать отметку в {md_file.name}: {e}")
+
 def check_and_process_metadata(output_dir, config):
     """Periodically check all .md files in output_dir for required metadata."""
     print(f"--- Запуск периодической проверки метаданных в каталоге {output_dir} ---")
@@ -486,7 +847,8 @@ def check_and_process_metadata(output_dir, config):
     llm_triggered_count = 0
     rate_limit_hit = False # Флаг для отслеживания ошибки лимита
 
-    for md_file in output_path.glob('*.md'):
+    md_files = [md_file for md_file in output_path.glob('*.md') if md_file.is_file()]
+    for md_file in md_files:
         if md_file.is_file():
             processed_count += 1
             result = check_single_md_metadata(md_file, config)
@@ -497,17 +859,27 @@ def check_and_process_metadata(output_dir, config):
             elif result is True:
                  llm_triggered_count += 1
 
+    get_metadata_ledger().prune(md_files)
+
     status = "Завершено" if not rate_limit_hit else "Прервано из-за лимита API"
-    print(f"--- Периодическая проверка метаданных завершена ({status}). Проверено файлов: {processed_count}. Запущено LLM: {llm_triggered_count} ---")
+    print(f"--- Периодическая проверка метаданных завершена ({status}). Проверено файлов: {processed_count}. Обогащено (LLM или локально): {llm_triggered_count} ---")
+    if config.get('local_classifier', True):
+        print(f"[INFO] {metadata_processor.classifier_summary()}")
 
-def process_file(file_path):
-    """Process a single file (audio or PDF)"""
+def process_file(file_path, backlog_seconds=0.0):
+    """Process a single file (audio or PDF).
+       backlog_seconds is the estimated cost of jobs still queued behind this one,
+       used to pick a faster Whisper model when the latency SLA is at risk.
+    """
+    global drafts_pending
+    if config is None:
+        configure()
     try:
         # Get absolute path to the file
         abs_file_path = file_path.resolve()
         file_name = file_path.stem
         file_ext = file_path.suffix.lower()
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        timestamp = allocate_session_timestamp()
         print(f"\n>>> Starting to process file: {abs_file_path} [Session: {timestamp}]")
         
         output_dir = Path(config['output_dir'])
@@ -530,93 +902,94 @@ def process_file(file_path):
             
             # Process PDF directly
             print(f"[PROCESSING] Обработка PDF файла: {output_path.name}")
-            pdf_processed, command_output = process_pdf_file(output_path, str(Path(config['output_dir'])))
+            pdf_processed, command_output, processor = process_pdf_file(
+                output_path, str(Path(config['output_dir'])), defer_marker=config['pdf_batch_window'] > 0)
             
-            # Проверяем созданные файлы маркдаун в правильном месте
-            output_md_files = list(Path(config['output_dir']).glob(f"{filename_prefix}_document/{filename_prefix}_document.md"))
-            
-            if not pdf_processed or not output_md_files:
-                # Создаем файл с информацией об ошибке
-                error_message = "PDF файл был обработан без ошибок, но маркдаун файл не был создан. Возможно, PDF документ пустой или содержит только изображения без текста."
-                error_md_file = create_pdf_error_markdown(file_path, output_path, timestamp, error_message, command_output)
-            else:
-                print(f"\n>>> [SUCCESS] PDF файл {output_path.name} успешно обработан")
-                for md_file in output_md_files:
-                    # Добавляем метаданные в markdown файл
-                    try:
-                        with md_file.open("r", encoding="utf-8") as f:
-                            content = f.read()
-                        
-                        # Форматированная дата и время для метаданных
-                        formatted_date = datetime.strptime(timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
-                        
-                        # Создаем метаданные
-                        metadata = (
-                            "---\n"
-                            f"created: {formatted_date}\n"
-                            # Используем новый формат ссылки (исправлено)
-                            f'original_filename: "[[{output_path.name}|{file_path.name}]]"\\n'
-                            f"processed_filename: {output_path.name}\n"
-                            f"processor: marker_single\n"
-                            "---\n\n"
-                        )
-                        
-                        # Записываем обновленное содержимое
-                        with md_file.open("w", encoding="utf-8") as f:
-                            f.write(metadata + content)
-                        
-                        print(f"[INFO] Добавлены метаданные в файл: {md_file.name}")
-                    except Exception as e:
-                        print(f"[WARNING] Не удалось добавить метаданные в файл {md_file.name}: {str(e)}")
-                
-                # Удаляем только временный JSON файл из правильного места
-                temp_json = Path(config['output_dir']) / f"{filename_prefix}_document" / f"{filename_prefix}_document_meta.json"
-                if temp_json.exists():
-                    try:
-                        temp_json.unlink()
-                        print(f"[INFO] Удален временный файл: {temp_json.name}")
-                    except Exception as e:
-                        print(f"[WARNING] Не удалось удалить временный файл {temp_json.name}: {str(e)}")
-                
+            if processor == pdf_engine.MARKER_DEFERRED:
+                # Документ целиком уйдет в marker вместе с другими PDF пакета
+                queue_pdf_for_batch(file_path, output_path, filename_prefix, timestamp)
                 return True
             
-            if error_md_file:
-                print(f"\n>>> [WARNING] PDF файл {output_path.name} обработан, но маркдаун не создан")
-                print(f"[INFO] Создан файл с информацией об ошибке: {error_md_file.name}")
-            else:
-                print(f"\n>>> [ERROR] Ошибка обработки PDF файла {output_path.name}")
-            
-            return False
+            return finalize_pdf_file(file_path, output_path, filename_prefix, timestamp,
+                                     pdf_processed, command_output, processor)
         
-        # Process audio files (WAV, MP3, etc.)
+        # Process audio files (WAV, MP3, M4A, OGG, etc.)
         duration = get_audio_duration(abs_file_path)
         print(f"Audio duration: {timedelta(seconds=duration)}")
         
         # Generate new filename prefix
         filename_prefix = generate_filename_prefix(timestamp, duration)
         
-        # Update run.bat with the timestamp
-        update_bat_file_with_timestamp(timestamp)
-        
         # Check files in the output directory before processing
         print("Files in output directory before processing:")
         log_files_in_dir(config['output_dir'])
         
-        # Run processing through run.bat
-        print(f"Running script: run.bat {abs_file_path}")
-        output_dir_abs = config['output_dir'] # Получаем абсолютный путь из конфига
-        subprocess_result = subprocess.run(
-            ['run.bat', str(abs_file_path), output_dir_abs], # Передаем output_dir_abs как аргумент
-            check=True, 
-            capture_output=True, 
-            text=True
-        )
-        print(f"run.bat output:\n{subprocess_result.stdout}")
-        if subprocess_result.stderr:
-            print(f"run.bat errors:\n{subprocess_result.stderr}")
+        draft_job = is_draft_job(duration)
+        if draft_job:
+            # Быстрый черновик без диаризации; полная модель отработает позже в фоне
+            whisper_model = config['draft_model']
+            compute_type = 'int8_float16' if config['whisper_device'] == 'cuda' else 'int8'
+            print(f"[INFO] Длинная запись: сначала черновик моделью {whisper_model}")
+        else:
+            whisper_model, compute_type = select_whisper_model(duration, backlog_seconds)
+        # Сжатую запись для transcribe_worker.py сервис декодирует сам: тот же поток PCM идет
+        # в stdin воркера и в проверку тишины, поэтому запись декодируется один раз
+        stream_pcm = streams_pcm_to_transcriber(abs_file_path)
+        # Быстрая проверка тишины по энергии сигнала, до запуска WhisperX на GPU
+        silence_precheck = not stream_pcm and is_silent_audio(abs_file_path)
+        if silence_precheck:
+            subprocess_result = None
+            no_speech_detected = True
+        else:
+            # Run transcription (transcribe_worker.py or run.bat)
+            output_dir_abs = config['output_dir'] # Получаем абсолютный путь из конфига
+            transcribe_command = build_transcribe_command(abs_file_path, output_dir_abs, whisper_model, compute_type,
+                                                          diarize=not draft_job, pcm_stdin=stream_pcm) # Передаем output_dir_abs как аргумент
+            log_path = job_log_path(f"{filename_prefix}_transcript")
+            while True:
+                print(f"Running transcription: {' '.join(transcribe_command)} (model: {whisper_model}, compute type: {compute_type})")
+                if log_path:
+                    print(f"Transcription log: {log_path}")
+                with process_runner.gpu_lock:
+                    subprocess_result = process_runner.run_command(
+                        transcribe_command,
+                        timeout=transcribe_timeout(duration),
+                        env=dict(os.environ, WHISPER_TIMESTAMP=timestamp,
+                                 WHISPER_JOB_MODEL=whisper_model, WHISPER_JOB_COMPUTE_TYPE=compute_type),
+                        log_path=log_path,
+                        abort_patterns=TRANSCRIBE_ABORT_PATTERNS,
+                        stdin_chunks=stream_pcm_for_transcription(abs_file_path) if stream_pcm else None
+                    )
+                if subprocess_result.aborted != process_runner.CUDA_OOM:
+                    break
+                # Не хватило памяти GPU - сразу повторяем моделью поменьше
+                fallback_model = next_faster_model(whisper_model)
+                if fallback_model is None:
+                    break
+                print(f"[WARNING] Не хватило памяти GPU для модели {whisper_model}, повтор моделью {fallback_model}")
+                whisper_model = fallback_model
+                compute_type = 'int8_float16' if config['whisper_device'] == 'cuda' else 'int8'
+                transcribe_command = build_transcribe_command(abs_file_path, output_dir_abs, whisper_model, compute_type,
+                                                              diarize=not draft_job, pcm_stdin=stream_pcm)
+            print(f"Transcription output (tail):\n{subprocess_result.stdout}")
+            if subprocess_result.stderr:
+                print(f"Transcription errors (tail):\n{subprocess_result.stderr}")
         
-        # Check for "No active speech" message
-        no_speech_detected = check_no_speech(subprocess_result.stdout)
+            if subprocess_result.aborted in (NO_SPEECH, SILENCE_PRECHECK):
+                # Речи нет - выравнивание и диаризацию не ждем
+                job_attempts.pop(str(file_path), None)
+                no_speech_detected = True
+                silence_precheck = subprocess_result.aborted == SILENCE_PRECHECK
+            elif subprocess_result.timed_out or subprocess_result.aborted or subprocess_result.returncode != 0:
+                # Файл остается во входном каталоге и вернется в очередь после паузы;
+                # после последней попытки создается заметка об ошибке
+                if schedule_job_retry(file_path):
+                    return False
+                no_speech_detected = False
+            else:
+                job_attempts.pop(str(file_path), None)
+                # Check for "No active speech" message
+                no_speech_detected = check_no_speech(subprocess_result.stdout)
         
         # Check files in the output directory after processing
         # print("Files in output directory after processing:")
@@ -659,7 +1032,6 @@ def process_file(file_path):
         # --- КОНЕЦ ФОЛБЭК ПОИСКА ---
         
         # Create names for output files with new naming scheme
-        txt_file = output_dir / f"{filename_prefix}_formatted.txt"
         md_file = output_dir / f"{filename_prefix}_transcript.md"
         # Define the output path for the original audio file *before* using it
         new_name = f"{filename_prefix}_transcript{file_ext}"
@@ -668,14 +1040,16 @@ def process_file(file_path):
         # Create MD file based on JSON, if found
         if json_file and not no_speech_detected:
             print("Found JSON file, starting conversion to Markdown...")
-            if extract_segments_to_txt(json_file, txt_file):
+            transcript = load_transcript(json_file)
+            if transcript is not None:
                 # Передаем output_path.name как processed_filename (теперь output_path определен)
-                if group_and_format_dialog(txt_file, md_file, file_path.name, output_path.name, timestamp, duration):
-                    # Удаляем formatted.txt после успешного создания markdown
-                    if txt_file.exists():
-                        txt_file.unlink()
-                        print(f"[INFO] Удален временный файл {txt_file.name}")
+                if group_and_format_dialog(transcript, md_file, file_path.name, output_path.name, timestamp, duration,
+                                           whisper_model, compute_type, 'draft' if draft_job else None):
                     md_file_to_check = md_file # Указываем файл для проверки
+                    if draft_job:
+                        drafts_pending = True
+                    if config['retain_segments']:
+                        retain_segments(transcript, md_file.with_suffix(segment_store.SEGMENTS_SUFFIX))
         else:
             if no_speech_detected:
                 print(f"[INFO] No active speech detected in the audio file")
@@ -685,6 +1059,8 @@ def process_file(file_path):
         # Move the original file to the output directory
         print(f"\n>>> Moving original file to output directory: {file_path.name} -> {output_path.name}")
         shutil.move(str(file_path), str(output_path))
+        # Возраст записи для хранения аудио отсчитывается от обработки, а не от исходной даты файла
+        os.utime(output_path, None)
         print(f"File moved successfully.")
         
         # Delete intermediate files in the output directory
@@ -724,61 +1100,77 @@ def process_file(file_path):
                 with error_md_file.open("w", encoding="utf-8") as f:
                     # Добавляем метаданные в формате Obsidian
                     f.write("---\n")
-                    f.write(f"created: {datetime.strptime(timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')}\\n")
+                    f.write(f"created: {datetime.strptime(timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')}\n")
                     # Используем новый формат ссылки (исправлено)
-                    f.write(f'original_filename: "[[{output_path.name}|{file_path.name}]]"\\n') 
-                    f.write(f"duration: {timedelta(seconds=duration)}\\n")
-                    f.write(f"error: {'No speech detected' if no_speech_detected else 'Processing error'}\\n")
+                    f.write(f'original_filename: "[[{output_path.name}|{file_path.name}]]"\n') 
+                    f.write(f"duration: {timedelta(seconds=duration)}\n")
+                    f.write(f"error: {'No speech detected' if no_speech_detected else 'Processing error'}\n")
+                    if silence_precheck:
+                        # Решение принято грубой проверкой по энергии, WhisperX запись не слушал
+                        f.write("speech_check: energy\n")
+                        f.write("review: needed\n")
                     f.write("---\n\n")
                     
                     if no_speech_detected:
-                        f.write(f"# No speech detected in file {file_path.name}\\n\\n")
-                        f.write(f"Processing date and time: {timestamp.replace('_', ' ')}\\n\\n")
-                        f.write("## File Information\\n\\n")
+                        f.write(f"# No speech detected in file {file_path.name}\n\n")
+                        f.write(f"Processing date and time: {timestamp.replace('_', ' ')}\n\n")
+                        f.write("## File Information\n\n")
                         # Используем новый формат ссылки (исправлено)
-                        f.write(f'- Filename: "[[{output_path.name}|{file_path.name}]]"\\n') 
-                        f.write(f"- Size: {file_path.stat().st_size} bytes\\n")
-                        f.write(f"- Moved to: {output_path.name}\\n\\n")
-                        f.write("The audio file was processed, but no speech was detected. This could be due to:\\n\\n")
+                        f.write(f'- Filename: "[[{output_path.name}|{file_path.name}]]"\n') 
+                        f.write(f"- Size: {output_path.stat().st_size} bytes\n")
+                        f.write(f"- Moved to: {output_path.name}\n\n")
+                        f.write("The audio file was processed, but no speech was detected. This could be due to:\n\n")
                         f.write("- Silent audio file\n")
                         f.write("- Very low volume speech\n")
                         f.write("- Non-speech audio content\n")
                         f.write("- Format not compatible with speech recognition\n")
+                        if silence_precheck:
+                            f.write("\n## Manual Review Needed\n\n")
+                            f.write("The recording was skipped by the energy-based silence check "
+                                    f"(MIN_SPEECH_RATIO={config['min_speech_ratio']}) and was not sent to WhisperX. "
+                                    "Quiet or far-field speech can fall below this check. Listen to the recording; "
+                                    "to transcribe it anyway, run:\n\n")
+                            f.write(f'    MIN_SPEECH_RATIO=0 python reprocess.py "{output_path}"\n')
                     else:
-                        f.write(f"# Error processing file {file_path.name}\\n\\n")
-                        f.write(f"Processing date and time: {timestamp.replace('_', ' ')}\\n\\n")
+                        f.write(f"# Error processing file {file_path.name}\n\n")
+                        f.write(f"Processing date and time: {timestamp.replace('_', ' ')}\n\n")
                         
                         # Add information about JSON file if found
                         if json_file and json_file.exists():
-                            f.write(f"JSON file preserved for debugging: `{json_file.name}`\\n\\n")
+                            f.write(f"JSON file preserved for debugging: `{json_file.name}`\n\n")
                         
-                        f.write("## Processing Output\\n\\n")
-                        f.write("```\\n")
-                        if 'subprocess_result' in locals() and subprocess_result:
+                        if subprocess_result is not None and subprocess_result.log_path:
+                            f.write(f"Full processing log: `{subprocess_result.log_path}`\n\n")
+                        
+                        f.write("## Processing Output\n\n")
+                        f.write("```\n")
+                        if subprocess_result is not None:
                             f.write(subprocess_result.stdout)
                             if subprocess_result.stderr:
-                                f.write("\\n\\n### Errors:\\n")
+                                f.write("\n\n### Errors:\n")
                                 f.write(subprocess_result.stderr)
                         else:
                             f.write("No processing output available.")
-                        f.write("\\n```\\n\\n")
+                        f.write("\n```\n\n")
                         
-                        f.write("## Possible Error Causes\\n\\n")
-                        f.write("- File format not supported\\n")
-                        f.write("- File does not contain speech\\n")
-                        f.write("- Error in speech recognition\\n")
-                        f.write("- Error in speaker identification\\n")
+                        f.write("## Possible Error Causes\n\n")
+                        f.write("- File format not supported\n")
+                        f.write("- File does not contain speech\n")
+                        f.write("- Error in speech recognition\n")
+                        f.write("- Error in speaker identification\n")
                         
-                        f.write("\\n## File Information\\n\\n")
+                        f.write("\n## File Information\n\n")
                         # Используем новый формат ссылки (исправлено)
-                        f.write(f'- Filename: "[[{output_path.name}|{file_path.name}]]"\\n') 
-                        f.write(f"- Size: {file_path.stat().st_size} bytes\\n")
-                        f.write(f"- Moved to: {output_path.name}\\n")
+                        f.write(f'- Filename: "[[{output_path.name}|{file_path.name}]]"\n') 
+                        f.write(f"- Size: {output_path.stat().st_size} bytes\n")
+                        f.write(f"- Moved to: {output_path.name}\n")
                     
-                if no_speech_detected:
-                    print(f"\\n>>> File {file_path.name} contains no speech. Created information Markdown: {error_md_file.name}")
+                if silence_precheck:
+                    print(f"\n>>> File {file_path.name} skipped by the silence check. Created Markdown for manual review: {error_md_file.name}")
+                elif no_speech_detected:
+                    print(f"\n>>> File {file_path.name} contains no speech. Created information Markdown: {error_md_file.name}")
                 else:
-                    print(f"\\n>>> File {file_path.name} processed with errors. Created error information Markdown: {error_md_file.name}")
+                    print(f"\n>>> File {file_path.name} processed with errors. Created error information Markdown: {error_md_file.name}")
                 
                 if json_file and json_file.exists() and not no_speech_detected:
                     print(f"JSON file preserved for debugging: {json_file.name}")
@@ -804,6 +1196,382 @@ def process_file(file_path):
         traceback.print_exc()
         return False
 
+def find_draft_notes(output_dir):
+    """Return transcript notes marked as draft, oldest first"""
+    drafts = []
+    for md_file in Path(output_dir).glob('*_transcript.md'):
+        try:
+            with md_file.open('r', encoding='utf-8') as f:
+                head = f.read(2048)
+        except Exception:
+            continue
+        if re.search(r'^transcript_status:\s*draft\s*$', head, re.MULTILINE):
+            drafts.append(md_file)
+    drafts.sort(key=lambda p: p.name)
+    return drafts
+
+def replace_note_body(md_file, new_body, frontmatter_updates):
+    """Atomically replace the body of a note, keeping its current frontmatter.
+       The frontmatter is re-read right before the write, so fields added by metadata
+       enrichment or by the user are preserved; only keys in frontmatter_updates change.
+       With new_body=None only the frontmatter is updated; keys set to None are removed.
+    """
+    content = md_file.read_text(encoding='utf-8')
+    frontmatter = ""
+    body = content
+    has_frontmatter = False
+    if content.startswith('---'):
+        parts = content.split('---', 2)
+        if len(parts) >= 3:
+            frontmatter = parts[1]
+            body = parts[2]
+            has_frontmatter = True
+    if new_body is None:
+        # Тело заметки без frontmatter отделяется от новой закрывающей черты переводом строки
+        new_body = body if has_frontmatter else "\n" + body
+    if not frontmatter.endswith('\n'):
+        frontmatter += '\n'
+    
+    for key, value in frontmatter_updates.items():
+        if value is None:
+            frontmatter = re.sub(rf'^{re.escape(key)}:.*\n', '', frontmatter, flags=re.MULTILINE)
+            continue
+        line = f"{key}: {value}"
+        pattern = re.compile(rf'^{re.escape(key)}:.*$', re.MULTILINE)
+        if pattern.search(frontmatter):
+            frontmatter = pattern.sub(lambda m: line, frontmatter, count=1)
+        else:
+            frontmatter += line + '\n'
+    
+    if frontmatter.strip():
+        new_content = f"---{frontmatter}---{new_body}"
+    else:
+        # Пустой frontmatter (например, после снятия единственной отметки) не записывается
+        new_content = new_body[1:] if new_body.startswith("\n") else new_body
+
+    tmp_file = md_file.with_name(f".{md_file.name}.tmp")
+    tmp_file.write_text(new_content, encoding='utf-8')
+    os.replace(tmp_file, md_file)
+
+def refine_draft_note(md_file, should_stop=None):
+    """Re-transcribe a draft note with the full model and diarization and replace its body.
+       Only reading and replacing the note hold pipeline_lock; the transcription itself runs
+       without it and is stopped as soon as should_stop() returns True.
+       Returns True on success, False on failure and None if the refinement was preempted.
+    """
+    output_dir = Path(config['output_dir'])
+    with pipeline_lock:
+        metadata, _ = parse_frontmatter(md_file)
+        if not metadata:
+            return False
+        
+        link = re.match(r'\[\[([^|\]]+)', str(metadata.get('original_filename', '')))
+        audio_path = output_dir / link.group(1) if link else None
+        if audio_path is not None and not audio_path.exists():
+            # Запись могла быть перекодирована заданием хранения
+            audio_path = audio_path.with_suffix(audio_retention.ARCHIVE_SUFFIX)
+        if audio_path is None or not audio_path.exists():
+            print(f"[WARNING] Аудио для черновика {md_file.name} не найдено, уточнение невозможно")
+            replace_note_body(md_file, None, {'transcript_status': 'draft_no_audio'})
+            return False
+    
+    print(f"\n>>> Уточнение черновика {md_file.name} полной моделью {config['whisper_model']}")
+    timestamp = allocate_session_timestamp()
+    compute_type = 'float16' if config['whisper_device'] == 'cuda' else 'int8'
+    json_file = output_dir / f"{audio_path.stem}_{timestamp}.json"
+    refined_md = output_dir / f".{md_file.stem}_{timestamp}_refine.md"
+    try:
+        command = build_transcribe_command(audio_path, str(output_dir), config['whisper_model'], compute_type)
+        timeout = transcribe_timeout(get_audio_duration(audio_path))
+        with process_runner.gpu_lock:
+            result = process_runner.run_command(command, timeout=timeout,
+                                                env=dict(os.environ, WHISPER_TIMESTAMP=timestamp,
+                                                         WHISPER_JOB_MODEL=config['whisper_model'],
+                                                         WHISPER_JOB_COMPUTE_TYPE=compute_type),
+                                                log_path=job_log_path(f"{md_file.stem}_refine"),
+                                                abort_patterns=TRANSCRIBE_ABORT_PATTERNS,
+                                                should_stop=should_stop)
+        if result.aborted == process_runner.PREEMPTED:
+            # Черновик остается черновиком и будет уточнен, когда очередь снова опустеет
+            print(f"[INFO] Уточнение {md_file.name} прервано: появились новые файлы")
+            return None
+        if result.aborted == NO_SPEECH or (result.returncode == 0 and check_no_speech(result.stdout)):
+            # Полная модель не нашла речи - оставляем черновик как итоговый текст
+            with pipeline_lock:
+                if md_file.exists():
+                    replace_note_body(md_file, None, {'transcript_status': 'final'})
+            return True
+        if result.timed_out or result.aborted or result.returncode != 0 or not json_file.exists():
+            print(f"[ERROR] Ошибка уточнения {md_file.name}:\n{result.stderr}")
+            return False
+        transcript = load_transcript(json_file)
+        if transcript is None or not group_and_format_dialog(transcript, refined_md, "", audio_path.name, timestamp, 0):
+            return False
+        
+        _, new_body = parse_frontmatter(refined_md)
+        with pipeline_lock:
+            if not md_file.exists():
+                # Заметку удалили или переместили, пока шла транскрибация
+                print(f"[WARNING] Черновик {md_file.name} исчез во время уточнения")
+                return False
+            if config['retain_segments']:
+                retain_segments(transcript, md_file.with_suffix(segment_store.SEGMENTS_SUFFIX))
+            replace_note_body(md_file, new_body, {
+                'whisper_model': config['whisper_model'],
+                'compute_type': compute_type,
+                'transcript_status': 'final',
+            })
+        print(f"[SUCCESS] Черновик {md_file.name} заменен итоговой транскрипцией")
+        return True
+    finally:
+        for temp_file in (json_file, refined_md):
+            if temp_file.exists():
+                temp_file.unlink()
+
+def refine_next_draft(should_stop=None):
+    """Refine one draft transcript; called only when there are no new files to process,
+       without pipeline_lock held. should_stop() is polled during the transcription and
+       preempts it (the draft stays queued, no attempt is counted).
+       Returns True if a draft was refined.
+    """
+    global drafts_pending
+    if not drafts_pending:
+        return False
+    
+    drafts = [md_file for md_file in find_draft_notes(config['output_dir'])
+              if refine_attempts.get(str(md_file), (0, 0.0))[0] < MAX_REFINE_ATTEMPTS]
+    if not drafts:
+        drafts_pending = False
+        return False
+    
+    # Черновики после неудачной попытки ждут паузы, как и файлы в pending_retries
+    now = time.time()
+    drafts = [md_file for md_file in drafts if refine_attempts.get(str(md_file), (0, 0.0))[1] <= now]
+    if not drafts:
+        return False
+    
+    md_file = drafts[0]
+    key = str(md_file)
+    try:
+        refined = refine_draft_note(md_file, should_stop)
+        if refined is None:
+            return False
+        if refined:
+            refine_attempts.pop(key, None)
+            return True
+    except Exception as e:
+        print(f"[ERROR] Ошибка уточнения черновика {md_file.name}: {str(e)}")
+    attempts = refine_attempts.get(key, (0, 0.0))[0] + 1
+    delay = config['job_retry_delay'] * 2 ** (attempts - 1)
+    refine_attempts[key] = (attempts, time.time() + delay)
+    if attempts < MAX_REFINE_ATTEMPTS:
+        print(f"[INFO] {md_file.name}: уточнение не удалось (попытка {attempts} из {MAX_REFINE_ATTEMPTS}), повтор через {delay:.0f} с")
+    return False
+
+def has_waiting_jobs(job_queue, scan_input_dir=False):
+    """Check if files are waiting to be processed; preempts draft refinement.
+       With scan_input_dir the input directory is scanned too (the polling service
+       does not find new files otherwise while a draft is being refined).
+    """
+    requeue_due_retries(job_queue)
+    if scan_input_dir:
+        enqueue_input_files(job_queue)
+    return len(job_queue) > 0
+
+def finalize_pdf_file(file_path, output_path, filename_prefix, timestamp, pdf_processed, command_output, processor):
+    """Add frontmatter to the converted PDF markdown or create an error note"""
+    # Проверяем созданные файлы маркдаун в правильном месте
+    output_md_files = list(Path(config['output_dir']).glob(f"{filename_prefix}_document/{filename_prefix}_document.md"))
+    
+    if not pdf_processed or not output_md_files:
+        # Создаем файл с информацией об ошибке
+        error_message = "PDF файл был обработан без ошибок, но маркдаун файл не был создан. Возможно, PDF документ пустой или содержит только изображения без текста."
+        error_md_file = create_pdf_error_markdown(file_path, output_path, timestamp, error_message, command_output)
+    else:
+        print(f"\n>>> [SUCCESS] PDF файл {output_path.name} успешно обработан")
+        for md_file in output_md_files:
+            # Добавляем метаданные в markdown файл
+            try:
+                with md_file.open("r", encoding="utf-8") as f:
+                    content = f.read()
+                
+                # Форматированная дата и время для метаданных
+                formatted_date = datetime.strptime(timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+                
+                # Создаем метаданные
+                metadata = (
+                    "---\n"
+                    f"created: {formatted_date}\n"
+                    # Используем новый формат ссылки (исправлено)
+                    f'original_filename: "[[{output_path.name}|{file_path.name}]]"\\n'
+                    f"processed_filename: {output_path.name}\n"
+                    f"processor: {processor}\n"
+                    "---\n\n"
+                )
+                
+                # Записываем обновленное содержимое
+                with md_file.open("w", encoding="utf-8") as f:
+                    f.write(metadata + content)
+                
+                print(f"[INFO] Добавлены метаданные в файл: {md_file.name}")
+            except Exception as e:
+                print(f"[WARNING] Не удалось добавить метаданные в файл {md_file.name}: {str(e)}")
+        
+        # Удаляем только временный JSON файл из правильного места
+        temp_json = Path(config['output_dir']) / f"{filename_prefix}_document" / f"{filename_prefix}_document_meta.json"
+        if temp_json.exists():
+            try:
+                temp_json.unlink()
+                print(f"[INFO] Удален временный файл: {temp_json.name}")
+            except Exception as e:
+                print(f"[WARNING] Не удалось удалить временный файл {temp_json.name}: {str(e)}")
+        
+        return True
+    
+    if error_md_file:
+        print(f"\n>>> [WARNING] PDF файл {output_path.name} обработан, но маркдаун не создан")
+        print(f"[INFO] Создан файл с информацией об ошибке: {error_md_file.name}")
+    else:
+        print(f"\n>>> [ERROR] Ошибка обработки PDF файла {output_path.name}")
+    
+    return False
+
+def save_pdf_batch_state():
+    """Persist queued and running batch jobs; called with pdf_batch_lock held"""
+    state_path = Path(config['output_dir']) / PDF_BATCH_STATE_NAME
+    jobs = [
+        dict(job, file_path=str(job['file_path']), output_path=str(job['output_path']))
+        for job in running_pdf_batch + pending_pdf_batch
+    ]
+    try:
+        if not jobs:
+            state_path.unlink(missing_ok=True)
+            return
+        tmp_path = state_path.with_name(f"{state_path.name}.tmp")
+        tmp_path.write_text(json.dumps(jobs, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp_path, state_path)
+    except OSError as e:
+        print(f"[WARNING] Не удалось сохранить пакет PDF {state_path}: {e}")
+
+def pdf_job_finalized(job):
+    """True if the note of a batch job already has its frontmatter, i.e. finalize_pdf_file() has run"""
+    prefix = job['filename_prefix']
+    md_file = Path(config['output_dir']) / f"{prefix}_document" / f"{prefix}_document.md"
+    try:
+        with open(md_file, 'r', encoding='utf-8') as f:
+            head = f.read(4096)
+    except OSError:
+        return False
+    # Сырой результат тоже может начинаться с '---' (разделитель пустой страницы),
+    # поэтому проверяется поле, которое пишет только finalize_pdf_file()
+    parts = head.split('---', 2)
+    return (head.startswith('---') and len(parts) >= 3
+            and re.search(r'^processor:', parts[1], re.MULTILINE) is not None)
+
+def restore_pdf_batch():
+    """Requeue PDFs of a batch that was interrupted (crash or kill) before their notes were created"""
+    global pdf_batch_opened_at
+    state_path = Path(config['output_dir']) / PDF_BATCH_STATE_NAME
+    if not state_path.exists():
+        return 0
+    try:
+        jobs = json.loads(state_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Не удалось прочитать пакет PDF {state_path}: {e}")
+        return 0
+    with pdf_batch_lock:
+        for job in jobs:
+            job = dict(job, file_path=Path(job['file_path']), output_path=Path(job['output_path']))
+            if not job['output_path'].exists() or pdf_job_finalized(job):
+                continue
+            pending_pdf_batch.append(job)
+        # Восстановленный пакет запускается при первой же проверке
+        pdf_batch_opened_at = 0.0
+        save_pdf_batch_state()
+        restored = len(pending_pdf_batch)
+    if restored:
+        print(f"[INFO] Восстановлен прерванный пакет marker: {restored} PDF")
+    return restored
+
+def queue_pdf_for_batch(file_path, output_path, filename_prefix, timestamp):
+    """Queue a PDF that needs full marker conversion for the next batch"""
+    global pdf_batch_opened_at
+    with pdf_batch_lock:
+        if not pending_pdf_batch:
+            # Окно пакетирования отсчитывается от первого документа в очереди
+            pdf_batch_opened_at = time.time()
+        pending_pdf_batch.append({
+            'file_path': file_path,
+            'output_path': output_path,
+            'filename_prefix': filename_prefix,
+            'timestamp': timestamp,
+        })
+        queued = len(pending_pdf_batch)
+        save_pdf_batch_state()
+    print(f"[INFO] PDF {output_path.name} добавлен в пакет marker ({queued} в очереди)")
+
+def flush_pdf_batch(force=False):
+    """Run queued PDFs through a single marker batch once the batching window has elapsed"""
+    with pdf_batch_lock:
+        if not pending_pdf_batch:
+            return
+        
+        batch_full = len(pending_pdf_batch) >= config['pdf_batch_max_size']
+        window_elapsed = time.time() - pdf_batch_opened_at >= config['pdf_batch_window']
+        if not (force or batch_full or window_elapsed):
+            return
+        
+        batch = pending_pdf_batch[:config['pdf_batch_max_size']]
+        del pending_pdf_batch[:len(batch)]
+        # Документы пакета остаются в сохраненном состоянии, пока для них не созданы заметки
+        running_pdf_batch.extend(batch)
+        save_pdf_batch_state()
+    
+    print(f"\n>>> Пакетная обработка {len(batch)} PDF файлов в marker")
+    apply_proxy_env()
+    results, command_output = pdf_engine.run_marker_batch(
+        [job['output_path'] for job in batch],
+        config['output_dir'],
+        gemini_api_key=pdf_engine.get_gemini_api_key(),
+        gemini_model=config['gemini_model'],
+        workers=config['pdf_batch_workers'],
+        cache_dir=config['pdf_page_cache_dir'],
+        log_path=job_log_path(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_marker_batch")
+    )
+    
+    for job in batch:
+        finalize_pdf_file(job['file_path'], job['output_path'], job['filename_prefix'], job['timestamp'],
+                          results.get(job['output_path'], False), command_output, 'marker_single')
+        with pdf_batch_lock:
+            running_pdf_batch.remove(job)
+            save_pdf_batch_state()
+
+def maybe_start_retention():
+    """Start the audio retention job in a background thread once per retention_check_interval"""
+    global retention_thread, last_retention_time
+    if retention_thread is not None and retention_thread.is_alive():
+        return
+    if time.time() - last_retention_time < config['retention_check_interval']:
+        return
+    
+    last_retention_time = time.time()
+    retention_thread = threading.Thread(
+        target=audio_retention.run_retention,
+        args=(config['output_dir'],),
+        kwargs={
+            'transcode_after_days': config['audio_transcode_after_days'],
+            'bitrate': config['audio_opus_bitrate'],
+            'max_age_days': config['audio_max_age_days'],
+            'max_total_bytes': config['audio_max_total_bytes'],
+            # Ссылки в заметках переписываются под блокировкой конвейера, чтобы не затереть
+            # одновременную запись обогащения метаданных или уточнения черновика
+            'notes_lock': pipeline_lock,
+        },
+        name="audio-retention",
+        daemon=True
+    )
+    retention_thread.start()
+
 def create_pdf_error_markdown(file_path, output_path, timestamp, error_message, command_output=None):
     """Create markdown file with error information for PDF processing"""
     try:
@@ -862,16 +1630,52 @@ def create_pdf_error_markdown(file_path, output_path, timestamp, error_message,
         print(f"[ERROR] Ошибка создания файла с информацией об ошибке PDF: {str(e)}")
         return None
 
+def enqueue_input_files(job_queue):
+    """Add new supported files from input_dir to the job queue and drop queued files that disappeared"""
+    input_dir = Path(config['input_dir'])
+    for file_path in input_dir.glob('*'):
+        if file_path.is_file():
+            # Ignore syncthing temporary files
+            if is_syncthing_temp_file(file_path):
+                # print(f"Ignoring syncthing temporary file: {file_path.name}") # Слишком много логов
+                continue
+            
+            if str(file_path) in job_queue or str(file_path) in pending_retries:
+                continue
+            
+            # Check file size
+            file_size = file_path.stat().st_size
+            if file_size < config['min_file_size']:
+                # print(f"File {file_path.name} is too small ({file_size/1024:.2f} KB < {config['min_file_size']/1024} KB), skipping.")
+                continue
+            
+            # Check file extension
+            file_ext = file_path.suffix.lower()
+            if file_ext not in SUPPORTED_EXTENSIONS:
+                # print(f"Unsupported file type: {file_ext}, skipping file: {file_path.name}")
+                continue
+            
+            cost = estimate_job_cost(file_path)
+            job_queue.add(str(file_path), file_path, cost)
+            print(f"New file detected: {file_path.name} ({file_size/1024:.2f} KB, estimated cost {timedelta(seconds=round(cost))}), queued: {len(job_queue)}")
+    
+    for key in job_queue.keys():
+        if not os.path.exists(key):
+            job_queue.discard(key)
+
 def main():
     """Main service loop"""
     print(f"Service started. Monitoring directory: {config['input_dir']}")
     print(f"Files will be processed and saved to: {config['output_dir']}")
     print(f"Minimum file size: {config['min_file_size']/1024} KB")
-    print(f"Supported formats: WAV, MP3, PDF")
+    print(f"Supported formats: {', '.join(ext[1:].upper() for ext in SUPPORTED_EXTENSIONS)}")
     print(f"Metadata check interval: {config['metadata_check_interval']} seconds")
+    print(f"PDF batching window: {config['pdf_batch_window']} seconds (max {config['pdf_batch_max_size']} files)")
     
     # Create necessary directories at startup
     ensure_directories()
+    # PDF прерванного пакета marker (сбой или остановка процесса)
+    restore_pdf_batch()
     
     # --- Первичная проверка метаданных при запуске ---    
     print("\n--- Запуск первичной проверки метаданных --- ")
@@ -880,41 +1684,47 @@ def main():
     # --- Конец первичной проверки --- 
     
     last_metadata_check_time = time.time() 
+    job_queue = ShortestJobFirstQueue(config['job_aging_rate'])
 
     while True:
         try:
-            # Check for new files
-            input_dir = Path(config['input_dir'])
-            for file_path in input_dir.glob('*'):
-                if file_path.is_file():
-                    # Ignore syncthing temporary files
-                    if file_path.name.startswith("~syncthing~") and file_path.name.endswith(".tmp"):
-                        # print(f"Ignoring syncthing temporary file: {file_path.name}") # Слишком много логов
-                        continue
-                    
-                    # Check file size
-                    file_size = file_path.stat().st_size
-                    if file_size < config['min_file_size']:
-                        # print(f"File {file_path.name} is too small ({file_size/1024:.2f} KB < {config['min_file_size']/1024} KB), skipping.")
-                        continue
-                    
-                    # Check file extension
-                    file_ext = file_path.suffix.lower()
-                    if file_ext not in ['.wav', '.mp3', '.pdf']:
-                        # print(f"Unsupported file type: {file_ext}, skipping file: {file_path.name}")
-                        continue
-                        
-                    print(f"New file detected: {file_path.name} ({file_size/1024:.2f} KB)")
-                    process_file(file_path) # Обрабатываем новый файл немедленно
-            
-            # Периодическая проверка метаданных
-            current_time = time.time()
-            if current_time - last_metadata_check_time >= config['metadata_check_interval']:
-                check_and_process_metadata(config['output_dir'], config)
-                last_metadata_check_time = current_time
+            with pipeline_lock:
+                # Check for new files
+                requeue_due_retries(job_queue)
+                enqueue_input_files(job_queue)
+                
+                # Обрабатываем одно самое короткое задание и снова смотрим каталог,
+                # чтобы новые короткие записи не ждали за длинными
+                file_path = job_queue.pop()
+                if file_path is not None and file_path.exists():
+                    process_file(file_path, backlog_seconds=job_queue.total_cost())
+                
+                # Запускаем накопленный пакет PDF, если истекло окно пакетирования
+                flush_pdf_batch()
+                
+                # Перекодирование старых записей в Opus и квоты хранения (в фоне)
+                maybe_start_retention()
+                
+                # Периодическая проверка метаданных
+                current_time = time.time()
+                if current_time - last_metadata_check_time >= config['metadata_check_interval']:
+                    check_and_process_metadata(config['output_dir'], config)
+                    # Субтитры для заметок с флагом subtitles во frontmatter
+                    transcript_export.export_requested(config['output_dir'])
+                    last_metadata_check_time = current_time
+
+            # Черновики уточняются только когда новых файлов нет, без блокировки конвейера;
+            # появление файла во входном каталоге прерывает уточнение
+            refined = not len(job_queue) and config['draft_min_duration'] > 0 and refine_next_draft(
+                should_stop=lambda: has_waiting_jobs(job_queue, scan_input_dir=True))
 
-            time.sleep(config['check_interval'])
+            if not len(job_queue) and not refined:
+                time.sleep(config['check_interval'])
             
+        except KeyboardInterrupt:
+            # Пакет PDF не обрабатывается при остановке: он сохранен в PDF_BATCH_STATE_NAME
+            # и будет восстановлен при следующем запуске (restore_pdf_batch)
+            raise
         except Exception as e:
             print(f"[ERROR] Ошибка в главном цикле: {str(e)}")
             # Добавим traceback для лучшей диагностики
@@ -924,7 +1734,7 @@ def main():
 
 if __name__ == "__main__":
     # Configuration loaded at startup
-    config = load_config()
+    configure()
     
     # Print startup banner
     print("=" * 80)
@@ -933,7 +1743,7 @@ if __name__ == "__main__":
     print("=" * 80)
     
     # Проверка наличия ключа Gemini API
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
+    gemini_api_key = pdf_engine.get_gemini_api_key()
     if gemini_api_key:
         print(f"[CONFIG] Найден ключ Gemini API: ...{gemini_api_key[-5:]}")
         print("[CONFIG] PDF файлы будут обрабатываться с использованием LLM (Gemini)")
@@ -962,6 +1772,4 @@ if __name__ == "__main__":
     main() 
 
 
-    # TODO: удалять аудио файлы старше недели из processed
-    # TODO: добавить обработку других форматов аудио
     # TODO: Реализовать вызов metadata_processor.py из check_and_process_metadata --- DONE
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Building blocks for watchdog-based directory monitors (file_monitor, echoflow_daemon)"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import audio_pipeline
+
+def is_compressed_audio(file_path):
+    """Audio in a format other than WAV (usually an export that a recorder may still convert)"""
+    suffix = file_path.suffix.lower()
+    return suffix in audio_pipeline.AUDIO_EXTENSIONS and suffix != '.wav'
+
+def wav_sibling_exists(file_path):
+    """True if a compressed recording has a same-stem .wav next to it.
+
+    Recorders such as macos/QuickAudioRecorder.app export an .m4a and then convert
+    it to .wav beside it and delete the .m4a: the .wav is the recording to process,
+    and the .m4a must not be moved or transcribed while ffmpeg is still reading it.
+    """
+    if not is_compressed_audio(file_path):
+        return False
+    return any(file_path.with_suffix(suffix).exists() for suffix in ('.wav', '.WAV'))
+
+class ProcessedFiles:
+    """Bounded table of seen files with time-based expiry.
+
+    Entries are kept in insertion/update order; the oldest are dropped once
+    max_entries is exceeded or when they are older than ttl seconds, except files
+    that are still "processing", which are never dropped. If state_path
+    is given, entries marked "processed" are saved there (atomically) and loaded on
+    startup, so duplicate suppression survives restarts. Transient statuses
+    ("pending", "processing") are never persisted.
+    """
+    def __init__(self, max_entries=10000, ttl=7 * 24 * 3600, state_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.state_path = state_path
+        # path -> (status, time of last update)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.load()
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] != "processing" and time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                return default
+            return entry[0]
+    
+    def __setitem__(self, key, status):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (status, time.time())
+            self.evict()
+        if status == "processed":
+            self.save()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def evict(self):
+        """Drop expired entries and the oldest ones above the size limit (lock must be held)"""
+        cutoff = time.time() - self.ttl
+        excess = len(self.entries) - self.max_entries
+        stale = []
+        for key, (status, updated_at) in self.entries.items():
+            if updated_at >= cutoff and excess <= 0:
+                break
+            # Files still being processed stay, or a repeated event would start them a second time
+            if status != "processing":
+                stale.append(key)
+                excess -= 1
+        for key in stale:
+            del self.entries[key]
+    
+    def load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            for key, updated_at in sorted(state.items(), key=lambda item: item[1]):
+                self.entries[key] = ("processed", float(updated_at))
+            with self.lock:
+                self.evict()
+            logging.info(f"Loaded {len(self.entries)} processed files from {self.state_path}")
+        except Exception as e:
+            logging.error(f"Error loading processed files state {self.state_path}: {str(e)}")
+    
+    def save(self):
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        # Snapshot, write and replace under one lock: two threads never write the shared .tmp
+        # at once, and an older snapshot never replaces a newer one
+        with self.lock:
+            state = {key: updated_at for key, (status, updated_at) in self.entries.items() if status == "processed"}
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.replace(tmp_path, self.state_path)
+            except Exception as e:
+                logging.error(f"Error saving processed files state {self.state_path}: {str(e)}")
+
+class StabilityScheduler(threading.Thread):
+    """Tracks queued files until their size stops changing and dispatches them to a worker pool.
+
+    Watchdog delivers events from a single observer thread, so no work is done there:
+    the handler only puts paths into the bounded event queue. This thread polls each
+    tracked file with os.stat, and once its size has been unchanged for
+    stability_seconds, submits dispatch(file_path) to the pool. At most two jobs per
+    worker may be queued in the pool; the rest stay tracked until a slot frees up.
+    Compressed audio waits compressed_stability_seconds instead and is dropped once a
+    same-stem .wav appears next to it (see wav_sibling_exists).
+    """
+    def __init__(self, events, processed_files, dispatch, workers, stability_seconds, poll_interval=0.5,
+                 compressed_stability_seconds=None):
+        super().__init__(name="stability-scheduler", daemon=True)
+        self.events = events
+        self.processed_files = processed_files
+        self.dispatch = dispatch
+        self.stability_seconds = stability_seconds
+        self.compressed_stability_seconds = (stability_seconds if compressed_stability_seconds is None
+                                             else compressed_stability_seconds)
+        self.poll_interval = poll_interval
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="monitor-worker")
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        # path -> [Path, last seen size, time of last size change]
+        self.tracked = {}
+        self.stop_event = threading.Event()
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            self.drain_events()
+            self.dispatch_stable_files()
+        self.pool.shutdown(wait=True)
+    
+    def drain_events(self):
+        """Move all queued paths into the tracking table"""
+        try:
+            file_path = self.events.get(timeout=self.poll_interval)
+        except queue.Empty:
+            return
+        while True:
+            key = str(file_path)
+            if key not in self.tracked:
+                self.tracked[key] = [file_path, -1, time.monotonic()]
+            try:
+                file_path = self.events.get_nowait()
+            except queue.Empty:
+                return
+    
+    def dispatch_stable_files(self):
+        """Submit files whose size has been stable long enough, while pool slots are free"""
+        now = time.monotonic()
+        for key, entry in list(self.tracked.items()):
+            file_path, last_size, changed_at = entry
+            try:
+                size = os.stat(file_path).st_size
+            except OSError:
+                # File disappeared before it became stable
+                del self.tracked[key]
+                continue
+            
+            if wav_sibling_exists(file_path):
+                # The recorder is converting this file to WAV; the WAV is processed instead
+                logging.info(f"Skipping {file_path.name}: a WAV with the same name is being written next to it")
+                del self.tracked[key]
+                continue
+            
+            if size != last_size:
+                entry[1] = size
+                entry[2] = now
+                continue
+            stability_seconds = (self.compressed_stability_seconds if is_compressed_audio(file_path)
+                                 else self.stability_seconds)
+            if now - changed_at < stability_seconds:
+                continue
+            
+            if not self.slots.acquire(blocking=False):
+                # Pool is saturated: keep the file tracked and try again on the next pass
+                return
+            del self.tracked[key]
+            self.processed_files[key] = "processing"
+            self.pool.submit(self.run_job, key, file_path)
+    
+    def run_job(self, key, file_path):
+        try:
+            self.dispatch(file_path)
+        except Exception as e:
+            logging.error(f"Error processing {file_path}: {str(e)}")
+        finally:
+            self.processed_files[key] = "processed"
+            self.slots.release()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Очередь заданий "сначала короткие" (shortest job first) со старением
+
+Приоритет задания - оценка стоимости (например, длительность записи в секундах) минус
+aging_rate * время ожидания. Чем дольше задание ждет, тем выше его приоритет, поэтому
+длинные записи не голодают. Эффективный приоритет cost - aging_rate * (now - enqueued_at)
+отличается от cost + aging_rate * enqueued_at на одинаковую для всех заданий величину,
+поэтому порядок не меняется со временем и хранится в куче.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+# Сколько единиц стоимости (секунд аудио) списывается за секунду ожидания
+DEFAULT_AGING_RATE = 2.0
+
+class ShortestJobFirstQueue:
+    """Thread-safe priority queue of jobs keyed by path, ordered by aged cost"""
+    def __init__(self, aging_rate=DEFAULT_AGING_RATE):
+        self.aging_rate = aging_rate
+        self.heap = []
+        # key -> (priority, sequence, cost); записи кучи, которых нет в entries, устарели
+        self.entries = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.condition:
+            return key in self.entries
+
+    def add(self, key, item, cost):
+        """Queue item under key; returns False if the key is already queued"""
+        with self.condition:
+            if key in self.entries:
+                return False
+            priority = cost + self.aging_rate * time.monotonic()
+            sequence = next(self.counter)
+            self.entries[key] = (priority, sequence, cost)
+            heapq.heappush(self.heap, (priority, sequence, key, item))
+            self.condition.notify()
+            return True
+
+    def discard(self, key):
+        """Remove a queued job (e.g. the file disappeared)"""
+        with self.condition:
+            self.entries.pop(key, None)
+
+    def total_cost(self):
+        """Sum of estimated costs of queued jobs (the backlog, in cost units)"""
+        with self.condition:
+            return sum(entry[2] for entry in self.entries.values())
+
+    def keys(self):
+        with self.condition:
+            return list(self.entries)
+
+    def pop(self, timeout=0):
+        """
+        Возвращает задание с наименьшей стоимостью с учетом старения
+
+        Args:
+            timeout (float): 0 - не ждать, None - ждать бесконечно, иначе секунды ожидания
+
+        Returns:
+            Элемент задания или None, если очередь пуста
+        """
+        with self.condition:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                while self.heap:
+                    priority, sequence, key, item = heapq.heappop(self.heap)
+                    if self.entries.get(key, (None, None))[:2] == (priority, sequence):
+                        del self.entries[key]
+                        return item
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
@@ -1,8 +1,13 @@
 import os
+import re
 import json
+import zlib
+import time
 import argparse
 import logging
+import threading
 from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
 import yaml
 from yaml.scanner import ScannerError
@@ -12,6 +17,51 @@ from openai import OpenAI, OpenAIError, RateLimitError
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Local Classifier Settings ---
+# Поля frontmatter, которые возвращает LLM
+METADATA_KEYS = ('группа', 'проект', 'клиент', 'событие/назначение')
+# Поля, которые локальный классификатор определяет без LLM
+LABEL_KEYS = ('группа', 'проект')
+# Остальные поля при локально определенном проекте записываются пустыми; с CLASSIFIER_FETCH_DETAILS
+# они запрашиваются у LLM коротким запросом без промпта проекта и файлов контекста
+DETAIL_KEYS = ('клиент', 'событие/назначение')
+DETAILS_SYSTEM_PROMPT = ("Ты заполняешь метаданные заметок Obsidian. Группа и проект заметки уже известны, "
+                         "их не меняй. По содержимому заметки определи клиента и событие/назначение.")
+# Отметка во frontmatter, кем заполнены метаданные (llm или local); такие заметки не
+# считаются размеченными человеком и не попадают в обучающую выборку классификатора
+SOURCE_KEY = 'metadata_source'
+CLASSIFIER_CACHE_NAME = '.project_classifier.npz'
+# Отрыв лучшего проекта от второго (доля его оценки) и сходство с ближайшей заметкой,
+# начиная с которых метаданные заполняются без LLM
+DEFAULT_MIN_CONFIDENCE = 0.4
+DEFAULT_MIN_SIMILARITY = 0.2
+# Оценка проекта - среднее сходство с его ближайшими заметками
+CLASSIFIER_NEIGHBORS = 5
+# Проекты с меньшим числом похожих размеченных заметок не рассматриваются
+CLASSIFIER_MIN_SUPPORT = 3
+# Как часто (сек) хранилище просматривается в поиске новых и измененных размеченных заметок
+CLASSIFIER_REFRESH_INTERVAL = 300
+# Термы хешируются в пространство фиксированного размера; грубая основа слова -
+# первые STEM_LENGTH букв, чтобы формы одного слова совпадали
+HASH_DIM = 1 << 18
+STEM_LENGTH = 6
+TOKEN_RE = re.compile(r'[^\W\d_]{3,}')
+
+# --- Context Retrieval Settings ---
+# Сколько фрагментов файлов контекста и сколько токенов контекста попадает в запрос (0 - без ограничения)
+DEFAULT_CONTEXT_TOP_K = 20
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+# Грубая оценка длины в токенах для русского текста
+CHARS_PER_TOKEN = 3
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Разделы файла контекста длиннее этого числа символов делятся на абзацы, пункты и строки таблиц
+MAX_ENTRY_CHARS = 800
+HEADING_RE = re.compile(r'^#{1,6}\s')
+LIST_ITEM_RE = re.compile(r'^([-*+]|\d+[.)])\s')
+TABLE_SEPARATOR_RE = re.compile(r'^\|?[\s:|-]+\|?$')
+
 # --- Configuration Loading ---
 def load_config():
     """Load configuration from .env file for LLM processing."""
@@ -52,6 +102,13 @@ def load_config():
         'proxy_port': os.getenv('PROXY_PORT'),
         'proxy_user': os.getenv('PROXY_USER'),
         'proxy_pass': os.getenv('PROXY_PASS'),
+        'local_classifier': os.getenv('LOCAL_CLASSIFIER', 'true').lower() in ('1', 'true', 'yes'),
+        'classifier_min_confidence': float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', str(DEFAULT_MIN_CONFIDENCE))),
+        'classifier_min_similarity': float(os.getenv('CLASSIFIER_MIN_SIMILARITY', str(DEFAULT_MIN_SIMILARITY))),
+        'classifier_cache_path': os.getenv('CLASSIFIER_CACHE_PATH', str(output_dir_abs / CLASSIFIER_CACHE_NAME)),
+        'classifier_fetch_details': os.getenv('CLASSIFIER_FETCH_DETAILS', 'false').lower() in ('1', 'true', 'yes'),
+        'context_top_k': int(os.getenv('CONTEXT_TOP_K', str(DEFAULT_CONTEXT_TOP_K))),
+        'context_token_budget': int(os.getenv('CONTEXT_TOKEN_BUDGET', str(DEFAULT_CONTEXT_TOKEN_BUDGET))),
     }
 
 # --- Frontmatter Parsing ---
@@ -82,14 +139,18 @@ def parse_frontmatter(file_path: Path):
         return None, None # Возвращаем None, если файл не прочитался
 
 # --- Prompt and Context Reading (Обновлено) ---
-def read_prompt_and_context(prompt_file_path: Path, vault_root: Path):
-    """Reads the main prompt file and context files specified in its frontmatter (relative to vault_root)."""
+def read_prompt_and_context(prompt_file_path: Path, vault_root: Path, query: str = None,
+                            top_k: int = 0, token_budget: int = 0):
+    """Reads the main prompt file and context files specified in its frontmatter (relative to vault_root).
+       With a query (the note body) and a top_k or token_budget limit, only the context entries
+       most relevant to the query are included (BM25), see select_context_entries().
+    """
     prompt_metadata, system_prompt_content = parse_frontmatter(prompt_file_path)
 
     if system_prompt_content is None: # Ошибка чтения файла промпта
         return None, None
 
-    context_content = ""
+    context_texts = [] # (путь из context_files, содержимое)
     loaded_context_files = []
     failed_context_files = []
 
@@ -105,9 +166,7 @@ def read_prompt_and_context(prompt_file_path: Path, vault_root: Path):
             if context_file_abs_path.exists() and context_file_abs_path.is_file():
                 try:
                     logger.debug(f"Чтение файла контекста: {context_file_abs_path}")
-                    context_content += f"--- Содержимое файла {context_file_rel_path_str} ---\n"
-                    context_content += context_file_abs_path.read_text(encoding='utf-8')
-                    context_content += "\n---\n\n"
+                    context_texts.append((context_file_rel_path_str, context_file_abs_path.read_text(encoding='utf-8')))
                     loaded_context_files.append(context_file_rel_path_str)
                 except Exception as e:
                     logger.warning(f"Не удалось прочитать файл контекста {context_file_abs_path}: {e}")
@@ -127,11 +186,417 @@ def read_prompt_and_context(prompt_file_path: Path, vault_root: Path):
     if failed_context_files:
         logger.warning(f"Не удалось загрузить файлы контекста: {', '.join(failed_context_files)}")
 
+    context_content = ""
+    if query is not None and (top_k > 0 or token_budget > 0) and context_texts:
+        selected = select_context_entries(context_texts, query, top_k, token_budget)
+        for context_file_rel_path_str, entries in selected:
+            context_content += f"--- Фрагменты файла {context_file_rel_path_str}, относящиеся к заметке ---\n"
+            context_content += "\n\n".join(entries)
+            context_content += "\n---\n\n"
+    else:
+        for context_file_rel_path_str, text in context_texts:
+            context_content += f"--- Содержимое файла {context_file_rel_path_str} ---\n"
+            context_content += text
+            context_content += "\n---\n\n"
+
     return system_prompt_content.strip(), context_content.strip()
 
+# --- Context Retrieval ---
+def split_context_blocks(lines, heading):
+    """Paragraphs, top-level list items and table rows of a section, each prefixed with its heading"""
+    prefix = f"{heading}\n" if heading else ""
+    entries = []
+    table_header = []
+    current = []
+
+    def flush():
+        body = "\n".join(current).strip()
+        if body:
+            entries.append(prefix + body)
+        current.clear()
+
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            flush()
+            table_header = []
+        elif stripped.startswith('|'):
+            if not table_header or (len(table_header) == 1 and TABLE_SEPARATOR_RE.match(stripped)):
+                flush()
+                table_header.append(stripped)
+            else:
+                entries.append(prefix + "\n".join(table_header + [stripped]))
+        elif LIST_ITEM_RE.match(line):
+            flush()
+            current.append(line.rstrip())
+        else:
+            current.append(line.rstrip())
+    flush()
+    return entries
+
+def split_context_entries(text: str):
+    """
+    Делит файл контекста на записи для поиска
+
+    Раздел под заголовком остается одной записью, если он не длиннее MAX_ENTRY_CHARS
+    (обычно это описание одного проекта). Длинные разделы делятся на абзацы, пункты
+    списков верхнего уровня и строки таблиц; каждая такая запись получает строку
+    заголовка, а строка таблицы - шапку таблицы.
+    """
+    sections = [(None, [])]
+    for line in text.splitlines():
+        if HEADING_RE.match(line):
+            sections.append((line.strip(), []))
+        else:
+            sections[-1][1].append(line)
+
+    entries = []
+    for heading, lines in sections:
+        body = "\n".join(lines).strip()
+        if not body:
+            continue
+        if len(body) <= MAX_ENTRY_CHARS:
+            entries.append(f"{heading}\n{body}" if heading else body)
+        else:
+            entries.extend(split_context_blocks(lines, heading))
+    return entries
+
+class ContextIndex:
+    """BM25 index over the entries of the context files, rebuilt when any of them changes"""
+    def __init__(self, context_texts):
+        self.signature = hash(tuple(context_texts))
+        self.sources = []
+        self.entries = []
+        # Заголовки разделов каждого файла - запасной контекст, когда ни одна запись не подошла
+        self.headings = []
+        for source_index, (_, text) in enumerate(context_texts):
+            self.headings.append([line.strip() for line in text.splitlines() if HEADING_RE.match(line)])
+            for entry in split_context_entries(text):
+                self.sources.append(source_index)
+                self.entries.append(entry)
+
+        term_parts, count_parts = zip(*(note_terms(entry) for entry in self.entries)) if self.entries else ((), ())
+        lengths = np.array([len(part) for part in term_parts], dtype=np.int64)
+        self.terms = np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.uint32)
+        self.counts = np.concatenate(count_parts) if count_parts else np.zeros(0, dtype=np.float32)
+        self.entry_of = np.repeat(np.arange(len(self.entries)), lengths)
+        entry_length = np.bincount(self.entry_of, weights=self.counts, minlength=len(self.entries))
+        # Нормированная длина записи для BM25 считается один раз для всех термов
+        self.length_norm = BM25_K1 * (1 - BM25_B + BM25_B * entry_length / max(entry_length.mean(), 1.0)) \
+            if len(self.entries) else np.zeros(0)
+        df = np.bincount(self.terms, minlength=HASH_DIM)
+        self.idf = np.log(1.0 + (len(self.entries) - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def scores(self, query: str):
+        """BM25 score of every entry for the query"""
+        query_terms, _ = note_terms(query)
+        mask = np.isin(self.terms, query_terms)
+        tf = self.counts[mask]
+        entries = self.entry_of[mask]
+        contributions = self.idf[self.terms[mask]] * tf * (BM25_K1 + 1) / (tf + self.length_norm[entries])
+        return np.bincount(entries, weights=contributions, minlength=len(self.entries))
+
+context_index = None
+
+def select_context_entries(context_texts, query: str, top_k: int, token_budget: int):
+    """
+    Выбирает записи файлов контекста, наиболее релевантные заметке
+
+    Записи берутся по убыванию оценки BM25, пока не набрано top_k записей или не исчерпан
+    бюджет токенов (0 - без ограничения); записи без общих с заметкой слов не включаются.
+    Если общих слов нет ни у одной записи, передаются заголовки разделов файлов (названия
+    проектов), а для файлов без заголовков - первые записи без учета оценки.
+
+    Returns:
+        list: [(путь из context_files, [записи в исходном порядке]), ...]
+    """
+    global context_index
+    if context_index is None or context_index.signature != hash(tuple(context_texts)):
+        context_index = ContextIndex(context_texts)
+    index = context_index
+
+    scores = index.scores(query)
+    if len(scores) and not np.any(scores > 0):
+        return fallback_context_entries(index, context_texts, top_k, token_budget)
+    chosen = []
+    used_tokens = 0
+    for entry_index in np.argsort(-scores, kind='stable').tolist():
+        if scores[entry_index] <= 0 or (top_k > 0 and len(chosen) >= top_k):
+            break
+        tokens = len(index.entries[entry_index]) // CHARS_PER_TOKEN + 1
+        if token_budget > 0 and used_tokens + tokens > token_budget:
+            continue
+        chosen.append(entry_index)
+        used_tokens += tokens
+
+    total_tokens = sum(len(entry) for entry in index.entries) // CHARS_PER_TOKEN
+    logger.info(f"Контекст: выбрано записей {len(chosen)} из {len(index.entries)} "
+                f"(~{used_tokens} из ~{total_tokens} токенов)")
+    selected = []
+    for source_index, (source, _) in enumerate(context_texts):
+        entries = [index.entries[i] for i in sorted(chosen) if index.sources[i] == source_index]
+        if entries:
+            selected.append((source, entries))
+    return selected
+
+def fallback_context_entries(index, context_texts, top_k: int, token_budget: int):
+    """Registry headings (or the first top_k entries of files without headings) when nothing matched the note"""
+    selected = []
+    used_tokens = 0
+    for source_index, (source, _) in enumerate(context_texts):
+        if index.headings[source_index]:
+            entries = ["\n".join(index.headings[source_index])]
+        else:
+            entries = [entry for entry, entry_source in zip(index.entries, index.sources) if entry_source == source_index]
+            if top_k > 0:
+                entries = entries[:top_k]
+        kept = []
+        for entry in entries:
+            tokens = len(entry) // CHARS_PER_TOKEN + 1
+            if token_budget > 0 and used_tokens + tokens > token_budget:
+                break
+            kept.append(entry)
+            used_tokens += tokens
+        if kept:
+            selected.append((source, kept))
+    logger.info(f"Контекст: ни одна запись не связана с заметкой, переданы заголовки и первые записи (~{used_tokens} токенов)")
+    return selected
+
+# --- Local Project Classifier ---
+def note_terms(text: str):
+    """Hashed term counts of a text: (unique term ids, counts)"""
+    tokens = [zlib.crc32(token[:STEM_LENGTH].encode('utf-8')) % HASH_DIM for token in TOKEN_RE.findall(text.lower())]
+    if not tokens:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float32)
+    terms, counts = np.unique(np.array(tokens, dtype=np.uint32), return_counts=True)
+    return terms, counts.astype(np.float32)
+
+def read_labelled_note(file_path: Path):
+    """(label, body) of a note whose 'проект' was set by a human; label is None otherwise.
+       Unlike parse_frontmatter() it does not log every note without frontmatter.
+    """
+    try:
+        content = file_path.read_text(encoding='utf-8')
+    except (OSError, UnicodeDecodeError):
+        return None, None
+    parts = content.split('---', 2)
+    if not content.startswith('---') or len(parts) < 3:
+        return None, None
+    try:
+        metadata = yaml.safe_load(parts[1])
+    except yaml.YAMLError:
+        return None, None
+    if not isinstance(metadata, dict) or not metadata.get('проект') or SOURCE_KEY in metadata:
+        return None, None
+    return tuple(str(metadata.get(key) or '') for key in LABEL_KEYS), parts[2]
+
+class ProjectClassifier:
+    """
+    Классификатор проекта заметки по ближайшим размеченным заметкам в пространстве TF-IDF
+
+    Обучающая выборка - заметки хранилища с полем 'проект', заполненным человеком.
+    Термы каждой заметки хранятся разреженно (смещения, id термов, частоты) в кэше
+    CLASSIFIER_CACHE_NAME вместе со временем изменения файла, поэтому при обновлении
+    перечитываются только новые и измененные заметки. Веса TF-IDF и сходство с
+    заметкой считаются векторно по всем термам сразу.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = Path(cache_path)
+        self.refreshed_at = 0.0
+        self.clear()
+        self.load()
+        self.build_index()
+
+    def clear(self):
+        self.paths = []
+        self.mtimes = np.zeros(0, dtype=np.float64)
+        self.labels = np.zeros(0, dtype=np.int32)  # индекс в label_table, -1 для неразмеченных
+        self.label_table = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.terms = np.zeros(0, dtype=np.uint32)
+        self.counts = np.zeros(0, dtype=np.float32)
+
+    def load(self):
+        if not self.cache_path.exists():
+            return
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as data:
+                self.paths = data['paths'].tolist()
+                self.mtimes = data['mtimes']
+                self.labels = data['labels']
+                self.label_table = [tuple(label) for label in json.loads(str(data['label_table']))]
+                self.offsets = data['offsets']
+                self.terms = data['terms']
+                self.counts = data['counts']
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш классификатора {self.cache_path}, он будет пересобран: {e}")
+            self.clear()
+
+    def save(self):
+        tmp_path = self.cache_path.with_name(f".{self.cache_path.name}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, paths=np.array(self.paths, dtype=str), mtimes=self.mtimes, labels=self.labels,
+                     label_table=np.array(json.dumps(self.label_table, ensure_ascii=False)),
+                     offsets=self.offsets, terms=self.terms, counts=self.counts)
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh(self, vault_root: Path):
+        """Incrementally index new, changed and deleted notes of the vault; returns True if anything changed"""
+        current = {}
+        for md_file in Path(vault_root).rglob('*.md'):
+            if any(part.startswith('.') for part in md_file.relative_to(vault_root).parts):
+                continue
+            try:
+                current[str(md_file)] = md_file.stat().st_mtime
+            except OSError:
+                continue
+
+        known = {path: index for index, path in enumerate(self.paths)}
+        kept = [index for path, index in known.items() if current.get(path) == self.mtimes[index]]
+        changed = [path for path in current if path not in known or current[path] != self.mtimes[known[path]]]
+        self.refreshed_at = time.time()
+        if not changed and len(kept) == len(self.paths):
+            return False
+
+        # Неизмененные заметки переносятся без чтения файлов
+        paths = [self.paths[index] for index in kept]
+        mtimes = [self.mtimes[index] for index in kept]
+        labels = [self.label_table[code] if code >= 0 else None for code in self.labels[kept].tolist()]
+        term_parts = [self.terms[self.offsets[index]:self.offsets[index + 1]] for index in kept]
+        count_parts = [self.counts[self.offsets[index]:self.offsets[index + 1]] for index in kept]
+
+        for path in changed:
+            label, body = read_labelled_note(Path(path))
+            # Неразмеченные заметки запоминаются без термов, чтобы не перечитывать их при каждом обновлении
+            terms, counts = note_terms(body or '')
+            paths.append(path)
+            mtimes.append(current[path])
+            labels.append(label)
+            term_parts.append(terms)
+            count_parts.append(counts)
+
+        self.label_table = sorted({label for label in labels if label})
+        codes = {label: code for code, label in enumerate(self.label_table)}
+        self.paths = paths
+        self.mtimes = np.array(mtimes, dtype=np.float64)
+        self.labels = np.array([codes[label] if label else -1 for label in labels], dtype=np.int32)
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in term_parts], out=self.offsets[1:])
+        self.terms = np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.uint32)
+        self.counts = np.concatenate(count_parts) if count_parts else np.zeros(0, dtype=np.float32)
+        self.build_index()
+        self.save()
+        logger.info(f"Классификатор проектов: размеченных заметок {int((self.labels >= 0).sum())}, "
+                    f"проектов {len(self.label_table)}, переиндексировано {len(changed)}")
+        return True
+
+    def build_index(self):
+        """Normalized TF-IDF weights of all indexed terms"""
+        note_count = len(self.paths)
+        labelled = int((self.labels >= 0).sum())
+        # Термы уникальны в пределах заметки, поэтому bincount дает документную частоту
+        df = np.bincount(self.terms, minlength=HASH_DIM)
+        self.idf = (np.log((1.0 + labelled) / (1.0 + df)) + 1.0).astype(np.float32)
+        self.entry_note = np.repeat(np.arange(note_count), np.diff(self.offsets))
+        weights = (1.0 + np.log(self.counts)) * self.idf[self.terms]
+        norms = np.sqrt(np.bincount(self.entry_note, weights=weights ** 2, minlength=note_count))
+        self.weights = weights / np.maximum(norms, 1e-12)[self.entry_note]
+
+    def classify(self, text: str, min_confidence: float, min_similarity: float):
+        """
+        Определяет группу и проект по ближайшим размеченным заметкам
+
+        Returns:
+            tuple: (метаданные или None, если классификатор не уверен; уверенность от 0 до 1)
+        """
+        if not self.label_table:
+            return None, 0.0
+        terms, counts = note_terms(text)
+        if len(terms) == 0:
+            return None, 0.0
+        query = np.zeros(HASH_DIM, dtype=np.float32)
+        query[terms] = (1.0 + np.log(counts)) * self.idf[terms]
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+
+        # Косинусное сходство со всеми заметками за один проход по термам
+        similarity = np.bincount(self.entry_note, weights=self.weights * query[self.terms], minlength=len(self.paths))
+        candidates = np.flatnonzero((similarity > 0) & (self.labels >= 0))
+        if len(candidates) == 0 or similarity[candidates].max() < min_similarity:
+            return None, 0.0
+
+        # Оценка проекта - среднее сходство с его CLASSIFIER_NEIGHBORS ближайшими заметками
+        order = candidates[np.lexsort((-similarity[candidates], self.labels[candidates]))]
+        labels = self.labels[order]
+        group_starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        rank = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(order)]))
+        nearest = rank < CLASSIFIER_NEIGHBORS
+        support = np.bincount(labels[nearest], minlength=len(self.label_table))
+        scores = np.bincount(labels[nearest], weights=similarity[order][nearest], minlength=len(self.label_table))
+        scores = scores / np.maximum(support, 1)
+        scores[support < CLASSIFIER_MIN_SUPPORT] = 0.0
+
+        # Уверенность - насколько лучший проект опережает второй
+        best, second = np.argsort(scores)[::-1][:2] if len(scores) > 1 else (0, None)
+        if scores[best] <= 0:
+            return None, 0.0
+        confidence = float(1.0 - (scores[second] / scores[best] if second is not None else 0.0))
+        if confidence < min_confidence:
+            return None, confidence
+        metadata = {key: value for key, value in zip(LABEL_KEYS, self.label_table[best]) if value}
+        return metadata, confidence
+
+# Классификатор загружается при первом вызове и обновляется не чаще CLASSIFIER_REFRESH_INTERVAL
+project_classifier = None
+classifier_lock = threading.Lock()
+# Заметки, классифицированные локально без LLM, локально с коротким запросом к LLM
+# за клиентом и событием, и отправленные в LLM с полным промптом
+classifier_stats = {'local': 0, 'details': 0, 'llm': 0}
+
+def get_project_classifier(config: dict):
+    """The local project classifier, refreshed from the vault when it is due"""
+    global project_classifier
+    with classifier_lock:
+        if project_classifier is None:
+            cache_path = config.get('classifier_cache_path') or Path(config['output_dir']) / CLASSIFIER_CACHE_NAME
+            project_classifier = ProjectClassifier(cache_path)
+        if time.time() - project_classifier.refreshed_at >= CLASSIFIER_REFRESH_INTERVAL:
+            project_classifier.refresh(Path(config['vault_root']))
+        return project_classifier
+
+def classify_locally(file_content: str, config: dict):
+    """Metadata from the local classifier if it is confident, otherwise None"""
+    if not config.get('local_classifier', True):
+        return None
+    try:
+        classifier = get_project_classifier(config)
+        with classifier_lock:
+            metadata, confidence = classifier.classify(
+                file_content,
+                config.get('classifier_min_confidence', DEFAULT_MIN_CONFIDENCE),
+                config.get('classifier_min_similarity', DEFAULT_MIN_SIMILARITY))
+    except Exception as e:
+        logger.error(f"Ошибка локального классификатора проектов: {e}")
+        return None
+    if metadata is None:
+        logger.info(f"Локальный классификатор не уверен (отрыв {confidence:.2f}), требуется LLM.")
+        return None
+    logger.info(f"Локальный классификатор: {metadata} (отрыв {confidence:.2f})")
+    return metadata
+
+def classifier_summary():
+    """Local-hit rate of the classifier and LLM calls since start"""
+    local = classifier_stats['local'] + classifier_stats['details']
+    total = local + classifier_stats['llm']
+    rate = 100.0 * local / total if total else 0.0
+    llm_calls = classifier_stats['details'] + classifier_stats['llm']
+    return (f"Локальный классификатор: проект определен для {local} из {total} заметок ({rate:.0f}%), "
+            f"без LLM: {classifier_stats['local']}; запросов к LLM: {llm_calls} "
+            f"(полных: {classifier_stats['llm']}, коротких: {classifier_stats['details']})")
+
 # --- OpenRouter API Call (Обновлено для обработки 429) ---
-def call_openrouter(api_key: str, model: str, system_prompt: str, context: str, file_content: str, config: dict):
-    """Calls the OpenRouter API, handles rate limits."""
+def call_openrouter(api_key: str, model: str, system_prompt: str, context: str, file_content: str, config: dict,
+                    keys=METADATA_KEYS):
+    """Calls the OpenRouter API, handles rate limits. keys are the metadata fields requested in the JSON."""
     if not api_key:
         logger.error("Ключ OpenRouter API не предоставлен.")
         return None
@@ -141,7 +606,7 @@ def call_openrouter(api_key: str, model: str, system_prompt: str, context: str,
     # Собираем полный промпт для пользователя (исправлено)
     context_block = f"Дополнительный контекст:\n{context}\n\n" if context else ""
 
-    user_prompt = f"""{context_block}Проанализируй содержимое следующего файла и верни ТОЛЬКО JSON объект с метаданными ('группа', 'проект', 'клиент', 'событие/назначение'):
+    user_prompt = f"""{context_block}Проанализируй содержимое следующего файла и верни ТОЛЬКО JSON объект с метаданными ({', '.join(f"'{key}'" for key in keys)}):
 
 --- Начало содержимого файла ---
 {file_content}
@@ -322,7 +787,54 @@ def process_single_file(file_path_str: str, config: dict, verbose: bool = False)
 
     logger.info(f"Начало обработки файла: {file_path.name}")
 
-    # 1. Загрузка промпта и контекста
+    # 1. Чтение содержимого целевого файла (без frontmatter)
+    _, file_content = parse_frontmatter(file_path)
+    if file_content is None:
+        logger.error(f"Не удалось прочитать содержимое файла: {file_path.name}")
+        return False
+    logger.debug(f"Загружено содержимое файла {file_path.name} ({len(file_content)} симв.).")
+
+    # 2. Локальный классификатор по размеченным заметкам; полный запрос с промптом проекта
+    #    и файлами контекста уходит в LLM только для неоднозначных заметок
+    local_metadata = classify_locally(file_content, config)
+    if local_metadata is not None and not config.get('classifier_fetch_details', False):
+        # Группа и проект записываются без LLM; клиент и событие/назначение - явно пустыми,
+        # чтобы заметка считалась заполненной
+        classifier_stats['local'] += 1
+        metadata = {key: '' for key in DETAIL_KEYS}
+        metadata.update(local_metadata)
+        metadata[SOURCE_KEY] = 'local'
+        success = update_markdown_frontmatter(file_path, metadata, file_content)
+        if success:
+            logger.info(f"Проект файла {file_path.name} определен локально, LLM не вызывался")
+        return success
+    if local_metadata is not None:
+        # Клиент и событие/назначение по короткому запросу без файлов контекста
+        classifier_stats['details'] += 1
+        details = call_openrouter(
+            api_key=config['openrouter_api_key'],
+            model=config['openrouter_model'],
+            system_prompt=DETAILS_SYSTEM_PROMPT,
+            context="\n".join(f"{key}: {value}" for key, value in local_metadata.items()),
+            file_content=file_content,
+            config=config,
+            keys=DETAIL_KEYS
+        )
+        if details == "RATE_LIMIT_ERROR":
+            logger.info(f"Обработка файла {file_path.name} прервана из-за лимита API.")
+            return "RATE_LIMIT_ERROR"
+        if not isinstance(details, dict):
+            logger.error(f"Не удалось получить клиента и событие от LLM для файла {file_path.name}. Результат: {details}")
+            return False
+        metadata = {key: details.get(key) or '' for key in DETAIL_KEYS}
+        metadata.update(local_metadata)
+        metadata[SOURCE_KEY] = 'local'
+        success = update_markdown_frontmatter(file_path, metadata, file_content)
+        if success:
+            logger.info(f"Проект файла {file_path.name} определен локально, LLM дополнил клиента и событие")
+        return success
+
+    # 3. Загрузка промпта и контекста
     prompt_file = Path(config['prompt_file_path'])
     vault_root = Path(config['vault_root'])
     if not prompt_file.exists():
@@ -330,21 +842,18 @@ def process_single_file(file_path_str: str, config: dict, verbose: bool = False)
         return False
 
     # Передаем vault_root в функцию чтения промпта
-    system_prompt, context_str = read_prompt_and_context(prompt_file, vault_root)
+    # и тело заметки - из файлов контекста берутся только относящиеся к ней записи
+    system_prompt, context_str = read_prompt_and_context(
+        prompt_file, vault_root, query=file_content,
+        top_k=config.get('context_top_k', DEFAULT_CONTEXT_TOP_K),
+        token_budget=config.get('context_token_budget', DEFAULT_CONTEXT_TOKEN_BUDGET))
     if system_prompt is None:
         logger.error(f"Не удалось прочитать промпт или контекст из {prompt_file}")
         return False
     logger.debug(f"Загружен системный промпт ({len(system_prompt)} симв.) и контекст ({len(context_str)} симв.).")
 
-    # 2. Чтение содержимого целевого файла (без frontmatter)
-    _, file_content = parse_frontmatter(file_path)
-    if file_content is None:
-        logger.error(f"Не удалось прочитать содержимое файла: {file_path.name}")
-        return False
-    logger.debug(f"Загружено содержимое файла {file_path.name} ({len(file_content)} симв.).")
-
-
-    # 3. Вызов LLM
+    # 4. Вызов LLM
+    classifier_stats['llm'] += 1
     llm_result = call_openrouter(
         api_key=config['openrouter_api_key'],
         model=config['openrouter_model'],
@@ -363,7 +872,8 @@ def process_single_file(file_path_str: str, config: dict, verbose: bool = False)
         logger.error(f"Не удалось получить валидные метаданные от LLM для файла {file_path.name}. Результат: {llm_result}")
         return False # Считаем это ошибкой обработки файла
 
-    # 4. Обновление файла (только если llm_result - это dict)
+    # 5. Обновление файла (только если llm_result - это dict)
+    llm_result[SOURCE_KEY] = 'llm'
     success = update_markdown_frontmatter(file_path, llm_result, file_content)
 
     if success:
@@ -0,0 +1,456 @@
+import os
+import re
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+import pdf_to_md
+import pdf_page_cache
+import process_runner
+
+logger = logging.getLogger(__name__)
+
+# Страницы с оценкой ниже порога отправляются в marker_single
+DEFAULT_QUALITY_THRESHOLD = 0.6
+# Если таких страниц больше этой доли, marker_single обрабатывает документ целиком
+DEFAULT_ESCALATE_RATIO = 0.5
+DEFAULT_GEMINI_MODEL = 'gemini-2.0-flash'
+
+# Обработчик в результате convert_pdf(defer_marker=True): документ нужно обработать marker
+# целиком, и вызывающий код собирается сделать это пакетом вместе с другими документами.
+# Успех при этом False, поэтому код, не знающий об отложенной обработке, не примет документ за готовый
+MARKER_DEFERRED = 'marker_deferred'
+
+# Таймаут marker: время на загрузку моделей и на каждую страницу
+MARKER_TIMEOUT_BASE = 300
+MARKER_TIMEOUT_PER_PAGE = 60
+# Оценка числа страниц по размеру, если PDF не открывается PyMuPDF
+BYTES_PER_PAGE_ESTIMATE = 100 * 1024
+
+# Разделитель страниц marker при --paginate_output: "{N}" и 48 дефисов
+MARKER_PAGE_SEPARATOR = re.compile(r'^\{(\d+)\}-{48}$', re.MULTILINE)
+
+def get_gemini_api_key():
+    """
+    Возвращает ключ Gemini API из окружения
+
+    Основное имя переменной - GEMINI_API_KEY. Старое имя с опечаткой GEMENI_API_KEY,
+    которое читал file_monitor, поддерживается для совместимости с существующими .env.
+    """
+    gemini_api_key = os.getenv("GEMINI_API_KEY")
+    if gemini_api_key:
+        return gemini_api_key
+    gemini_api_key = os.getenv("GEMENI_API_KEY")
+    if gemini_api_key:
+        logger.warning("Переменная GEMENI_API_KEY устарела, переименуйте ее в GEMINI_API_KEY")
+    return gemini_api_key
+
+def marker_timeout(page_count):
+    """Timeout for a marker run over page_count pages, in seconds"""
+    return MARKER_TIMEOUT_BASE + MARKER_TIMEOUT_PER_PAGE * max(1, page_count)
+
+def count_pdf_pages(pdf_path):
+    """Number of pages in a PDF, estimated from the file size if it cannot be opened"""
+    try:
+        with fitz.open(pdf_path) as doc:
+            return len(doc)
+    except Exception:
+        return max(1, Path(pdf_path).stat().st_size // BYTES_PER_PAGE_ESTIMATE)
+
+def build_marker_command(pdf_path, output_dir, gemini_api_key=None, gemini_model=DEFAULT_GEMINI_MODEL, page_range=None,
+                         batch_workers=None, paginate=False):
+    """
+    Формирует команду marker_single с оптимизированными параметрами
+
+    Args:
+        pdf_path (str или Path): Путь к PDF файлу (или к каталогу в пакетном режиме)
+        output_dir (str или Path): Каталог для результатов marker
+        gemini_api_key (str): Ключ Gemini API, если None - LLM не используется
+        gemini_model (str): Модель Gemini для режима --use_llm
+        page_range (str): Диапазон страниц в формате marker ("0,5-10,20")
+        batch_workers (int): Если задан, используется многофайловый режим marker
+            с указанным числом процессов
+        paginate (bool): Размечать страницы в выводе (всегда включено вместе с page_range)
+
+    Returns:
+        list: Аргументы команды
+    """
+    command = [
+        'marker_single' if batch_workers is None else 'marker',
+        str(pdf_path),
+        '--output_dir', str(output_dir),
+        '--output_format', 'markdown',
+        '--disable_tqdm',               # Отключаем прогресс-бары для фонового процесса
+        '--max_concurrency', '3'        # Оптимальное количество параллельных запросов
+    ]
+
+    if batch_workers is not None:
+        command.extend(['--workers', str(batch_workers)])
+
+    if page_range is not None:
+        command.extend(['--page_range', page_range])
+
+    if paginate or page_range is not None:
+        # Разметка страниц нужна, чтобы вернуть результат на место каждой страницы
+        command.append('--paginate_output')
+
+    # Если доступен API ключ Gemini, добавляем параметры для использования LLM
+    if gemini_api_key:
+        command.extend([
+            '--use_llm',                  # Включаем LLM для лучшего качества
+            '--gemini_api_key', gemini_api_key,
+            '--model_name', gemini_model
+        ])
+
+    return command
+
+def run_marker(pdf_path, output_dir, gemini_api_key=None, gemini_model=DEFAULT_GEMINI_MODEL, page_range=None,
+               paginate=False, page_count=None, log_path=None):
+    """
+    Запускает marker_single и собирает его вывод
+
+    Args:
+        page_count (int): Число обрабатываемых страниц для расчета таймаута
+            (по умолчанию - все страницы документа)
+        log_path (str или Path): Журнал задания для полного вывода marker
+
+    Returns:
+        tuple: (успех, вывод команды)
+    """
+    command = build_marker_command(pdf_path, output_dir, gemini_api_key, gemini_model, page_range, paginate=paginate)
+    logger.info(f"Запуск marker_single для {Path(pdf_path).name}" + (f" (страницы {page_range})" if page_range else ""))
+    if page_count is None:
+        page_count = count_pdf_pages(pdf_path)
+    return run_marker_command(command, timeout=marker_timeout(page_count), log_path=log_path)
+
+def run_marker_command(command, timeout=None, log_path=None):
+    """
+    Выполняет подготовленную команду marker и собирает ее вывод
+
+    Вывод читается построчно и пишется в log_path. По истечении timeout секунд,
+    а также сразу после нехватки памяти CUDA или ошибки загрузки моделей
+    marker и все его дочерние процессы завершаются.
+
+    Returns:
+        tuple: (успех, последние строки вывода команды)
+    """
+    try:
+        # marker (surya) работает на GPU: один запуск за раз, общий с транскрибацией
+        with process_runner.gpu_lock:
+            result = process_runner.run_command(command, timeout=timeout, log_path=log_path,
+                                                abort_patterns=process_runner.FAILURE_PATTERNS)
+    except Exception as e:
+        error_msg = f"Ошибка запуска {command[0]}: {str(e)}"
+        logger.error(error_msg)
+        return False, error_msg
+
+    command_output = ""
+    if result.stdout:
+        command_output += "STDOUT:\n" + result.stdout + "\n\n"
+    if result.stderr:
+        command_output += "STDERR:\n" + result.stderr
+
+    if result.log_path:
+        command_output += f"\n\nПолный вывод: {result.log_path}"
+
+    if result.timed_out:
+        logger.error(f"{command[0]} не завершился за {timeout:.0f} с и был остановлен")
+        return False, command_output
+
+    if result.aborted:
+        logger.error(f"{command[0]} остановлен: {result.aborted}")
+        return False, command_output
+
+    if result.returncode != 0:
+        logger.error(f"Ошибка обработки PDF в {command[0]}: {result.stderr}")
+        return False, command_output
+
+    return True, command_output
+
+def run_marker_batch(pdf_paths, output_dir, gemini_api_key=None, gemini_model=DEFAULT_GEMINI_MODEL, workers=1,
+                     cache_dir=None, log_path=None):
+    """
+    Обрабатывает несколько PDF одним запуском marker в многофайловом режиме
+
+    Модели разметки и OCR загружаются один раз на весь пакет. Документы
+    собираются во временном каталоге вне хранилища (ссылками, без копирования, где это возможно),
+    а результаты, как и у marker_single, попадают в {output_dir}/{имя_файла}/{имя_файла}.md
+
+    Args:
+        pdf_paths (list): Пути к PDF файлам
+        output_dir (str или Path): Каталог для результатов
+        gemini_api_key (str): Ключ Gemini API
+        gemini_model (str): Модель Gemini
+        workers (int): Количество процессов marker
+        cache_dir (str или Path): Каталог кэша страниц для сохранения результатов
+        log_path (str или Path): Журнал задания для полного вывода marker
+
+    Returns:
+        tuple: (словарь путь к PDF -> успех, вывод команды)
+    """
+    output_dir = Path(output_dir)
+    pdf_paths = [Path(pdf_path) for pdf_path in pdf_paths]
+    # Каталог пакета создается во временном каталоге системы: после сбоя он не остается
+    # в синхронизируемом хранилище
+    batch_dir = Path(tempfile.mkdtemp(prefix='marker_batch_'))
+
+    try:
+        for pdf_path in pdf_paths:
+            batch_file = batch_dir / pdf_path.name
+            try:
+                os.link(pdf_path, batch_file)
+            except OSError:
+                # Жесткая ссылка не создается между разными дисками
+                try:
+                    os.symlink(pdf_path.resolve(), batch_file)
+                except OSError:
+                    shutil.copy2(pdf_path, batch_file)
+
+        command = build_marker_command(batch_dir, output_dir, gemini_api_key, gemini_model,
+                                       batch_workers=workers, paginate=True)
+        logger.info(f"Запуск marker для пакета из {len(pdf_paths)} PDF")
+        total_pages = sum(count_pdf_pages(pdf_path) for pdf_path in pdf_paths)
+        _, command_output = run_marker_command(command, timeout=marker_timeout(total_pages / max(1, workers)),
+                                               log_path=log_path)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+    # Код возврата относится ко всему пакету, поэтому успех каждого документа
+    # определяем по наличию его Markdown файла
+    results = {}
+    for pdf_path in pdf_paths:
+        md_path = output_dir / pdf_path.stem / f"{pdf_path.stem}.md"
+        finish_marker_document(pdf_path, md_path, gemini_api_key, cache_dir)
+        results[pdf_path] = md_path.exists()
+    return results, command_output
+
+def format_page_range(page_numbers):
+    """
+    Сворачивает список номеров страниц (с нуля) в диапазон marker: [0, 1, 2, 5] -> "0-2,5"
+    """
+    ranges = []
+    for page_num in sorted(page_numbers):
+        if ranges and ranges[-1][1] == page_num - 1:
+            ranges[-1][1] = page_num
+        else:
+            ranges.append([page_num, page_num])
+    return ",".join(f"{start}-{end}" if start != end else str(start) for start, end in ranges)
+
+def split_marker_pages(markdown):
+    """
+    Разбирает вывод marker с --paginate_output на страницы
+
+    Returns:
+        dict: Номер страницы (с нуля) -> Markdown-текст страницы
+    """
+    pages = {}
+    matches = list(MARKER_PAGE_SEPARATOR.finditer(markdown))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(markdown)
+        pages[int(match.group(1))] = markdown[match.end():end].strip("\n")
+    return pages
+
+def marker_cache_engine(gemini_api_key=None):
+    """Раздел кэша страниц для результатов marker (с LLM и без LLM хранятся отдельно)"""
+    return 'marker-llm' if gemini_api_key else 'marker'
+
+def cache_marker_pages(cache_dir, engine, page_keys, pages):
+    """
+    Сохраняет страницы, распознанные marker, в кэш
+
+    Страницы со ссылками на изображения не кэшируются: изображения извлекаются
+    marker вместе со страницей и не попадут в каталог нового документа.
+    """
+    if not cache_dir or not page_keys:
+        return
+    for page_num, content in pages.items():
+        if page_num < len(page_keys) and '![' not in content:
+            pdf_page_cache.store_page(cache_dir, engine, page_keys[page_num], content)
+
+def finish_marker_document(pdf_path, md_path, gemini_api_key=None, cache_dir=None):
+    """
+    Доводит результат marker по всему документу до общего вида и кэширует его страницы
+
+    marker запускается с --paginate_output; разметка страниц заменяется на
+    разделители "---", как у быстрого пути, а страницы сохраняются в кэш.
+    """
+    md_path = Path(md_path)
+    if not md_path.exists():
+        return
+    pages = split_marker_pages(md_path.read_text(encoding='utf-8'))
+    if not pages:
+        return
+
+    if cache_dir:
+        try:
+            with fitz.open(pdf_path) as doc:
+                xref_digests = {}
+                page_keys = [pdf_page_cache.page_cache_key(doc, doc.load_page(n), xref_digests) for n in range(len(doc))]
+            cache_marker_pages(cache_dir, marker_cache_engine(gemini_api_key), page_keys, pages)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить страницы {Path(pdf_path).name} в кэш: {e}")
+
+    with md_path.open('w', encoding='utf-8') as out:
+        pdf_to_md.write_markdown_pages((pages[page_num] for page_num in sorted(pages)), out)
+
+def convert_pdf(pdf_path, output_dir, gemini_api_key=None, gemini_model=DEFAULT_GEMINI_MODEL,
+                quality_threshold=DEFAULT_QUALITY_THRESHOLD, escalate_ratio=DEFAULT_ESCALATE_RATIO,
+                defer_marker=False, cache_dir=None, log_path=None):
+    """
+    Многоуровневая конвертация PDF в Markdown
+
+    Сначала документ обрабатывается быстрым извлечением PyMuPDF, и каждая страница
+    получает оценку качества. Страницы ниже порога распознаются marker_single, а если
+    таких страниц слишком много - marker_single обрабатывает весь документ.
+
+    С кэшем страниц неизмененные страницы (например, в новой редакции договора)
+    берутся из кэша, а распознаются только отличающиеся.
+
+    Результат записывается так же, как это делает marker_single:
+    {output_dir}/{имя_файла}/{имя_файла}.md
+
+    Args:
+        pdf_path (str или Path): Путь к PDF файлу
+        output_dir (str или Path): Каталог для результатов
+        gemini_api_key (str): Ключ Gemini API для marker_single
+        gemini_model (str): Модель Gemini для marker_single
+        quality_threshold (float): Минимальная оценка страницы для быстрого пути
+        escalate_ratio (float): Доля плохих страниц, после которой документ целиком уходит в marker_single
+        defer_marker (bool): Не запускать marker_single для документа целиком,
+            а вернуть (False, "", MARKER_DEFERRED) для последующей пакетной обработки
+        cache_dir (str или Path): Каталог кэша страниц (необязательно)
+        log_path (str или Path): Журнал задания для полного вывода marker_single (необязательно)
+
+    Returns:
+        tuple: (успех, вывод marker_single или пустая строка, использованный обработчик или MARKER_DEFERRED)
+    """
+    pdf_path = Path(pdf_path)
+    output_dir = Path(output_dir)
+    md_dir = output_dir / pdf_path.stem
+    md_path = md_dir / f"{pdf_path.stem}.md"
+    marker_engine = marker_cache_engine(gemini_api_key)
+
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        # Документ не открывается PyMuPDF - оставляем его целиком marker_single
+        logger.warning(f"PyMuPDF не смог открыть {pdf_path.name}: {e}")
+        if defer_marker:
+            return False, "", MARKER_DEFERRED
+        success, command_output = run_marker(pdf_path, output_dir, gemini_api_key, gemini_model, log_path=log_path)
+        return success, command_output, 'marker_single'
+
+    # Быстрый проход: страницы складываются во временный файл, в памяти остаются только смещения
+    with doc, tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+        page_count = len(doc)
+        page_offsets = []
+        page_keys = []
+        xref_digests = {}
+        low_quality_pages = []
+        marker_page_nums = set()
+
+        def spool_page(page_content):
+            offset = spool.seek(0, os.SEEK_END)
+            spool.write(page_content)
+            return offset, len(page_content)
+
+        for page_num in range(page_count):
+            page = doc.load_page(page_num)
+            key = pdf_page_cache.page_cache_key(doc, page, xref_digests) if cache_dir else None
+            page_keys.append(key)
+
+            # Страница уже распознавалась marker в одной из прошлых редакций документа
+            page_content = pdf_page_cache.load_page(cache_dir, marker_engine, key)
+            if page_content is not None:
+                marker_page_nums.add(page_num)
+                page_offsets.append(spool_page(page_content))
+                continue
+
+            page_content = pdf_page_cache.load_page(cache_dir, pdf_to_md.CACHE_ENGINE, key)
+            if page_content is None:
+                page_content = pdf_to_md.extract_page_markdown(page)
+                pdf_page_cache.store_page(cache_dir, pdf_to_md.CACHE_ENGINE, key, page_content)
+            score = pdf_to_md.score_page_quality(page, page_content)
+            if score < quality_threshold:
+                low_quality_pages.append(page_num)
+            page_offsets.append(spool_page(page_content))
+
+        logger.info(f"{pdf_path.name}: {page_count} стр., ниже порога качества: {len(low_quality_pages)}, "
+                    f"из кэша marker: {len(marker_page_nums)}")
+
+        pages_for_marker = low_quality_pages
+        if page_count and (len(low_quality_pages) + len(marker_page_nums)) / page_count > escalate_ratio:
+            if not marker_page_nums:
+                logger.info(f"{pdf_path.name}: документ целиком передается в marker_single")
+                if defer_marker:
+                    return False, "", MARKER_DEFERRED
+                success, command_output = run_marker(pdf_path, output_dir, gemini_api_key, gemini_model, paginate=True,
+                                                     page_count=page_count, log_path=log_path)
+                finish_marker_document(pdf_path, md_path, gemini_api_key, cache_dir)
+                return success and md_path.exists(), command_output, 'marker_single'
+            # Документ целиком обрабатывается marker, но страницы из кэша не распознаются повторно
+            pages_for_marker = [page_num for page_num in range(page_count) if page_num not in marker_page_nums]
+
+        command_output = ""
+        if pages_for_marker:
+            new_pages, command_output = convert_pages_with_marker(
+                pdf_path, md_dir, pages_for_marker, gemini_api_key, gemini_model, log_path=log_path)
+            cache_marker_pages(cache_dir, marker_engine, page_keys if cache_dir else None, new_pages)
+            for page_num, page_content in new_pages.items():
+                page_offsets[page_num] = spool_page(page_content)
+                marker_page_nums.add(page_num)
+
+        if not marker_page_nums:
+            processor = 'pymupdf'
+        elif len(marker_page_nums) == page_count:
+            processor = 'marker_single'
+        else:
+            processor = 'pymupdf+marker_single'
+
+        def iter_pages():
+            for offset, length in page_offsets:
+                spool.seek(offset)
+                yield spool.read(length)
+
+        md_dir.mkdir(parents=True, exist_ok=True)
+        with md_path.open('w', encoding='utf-8') as out:
+            pdf_to_md.write_markdown_pages(iter_pages(), out)
+
+    logger.info(f"✅ {pdf_path.name} конвертирован ({processor}) -> {md_path}")
+    return True, command_output, processor
+
+def convert_pages_with_marker(pdf_path, md_dir, page_numbers, gemini_api_key=None, gemini_model=DEFAULT_GEMINI_MODEL,
+                              log_path=None):
+    """
+    Распознает отдельные страницы PDF через marker_single
+
+    Изображения, извлеченные marker, переносятся в md_dir, чтобы ссылки на них
+    из итогового Markdown оставались рабочими.
+
+    Returns:
+        tuple: (словарь номер страницы -> Markdown, вывод команды)
+    """
+    with tempfile.TemporaryDirectory(prefix='marker_pages_') as tmp_dir:
+        success, command_output = run_marker(
+            pdf_path, tmp_dir, gemini_api_key, gemini_model, page_range=format_page_range(page_numbers),
+            page_count=len(page_numbers), log_path=log_path)
+        marker_dir = Path(tmp_dir) / pdf_path.stem
+        marker_md = marker_dir / f"{pdf_path.stem}.md"
+
+        if not success or not marker_md.exists():
+            logger.warning(f"marker_single не обработал страницы {pdf_path.name}, остается результат PyMuPDF")
+            return {}, command_output
+
+        wanted_pages = set(page_numbers)
+        pages = split_marker_pages(marker_md.read_text(encoding='utf-8'))
+        pages = {page_num: content for page_num, content in pages.items() if page_num in wanted_pages}
+
+        md_dir.mkdir(parents=True, exist_ok=True)
+        for extra_file in marker_dir.iterdir():
+            if extra_file != marker_md and not extra_file.name.endswith('_meta.json'):
+                shutil.move(str(extra_file), str(md_dir / extra_file.name))
+
+        return pages, command_output
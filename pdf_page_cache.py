@@ -0,0 +1,126 @@
+import os
+import hashlib
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+def _xref_digest(doc, xref, xref_digests):
+    """
+    Хэш содержимого объекта PDF (шрифта, изображения, формы) с запоминанием по xref
+
+    Номера объектов меняются при пересохранении документа, поэтому в ключ
+    попадает только содержимое потоков, а не ссылки на объекты.
+    """
+    if xref not in xref_digests:
+        digest = hashlib.sha256()
+        if doc.xref_is_stream(xref):
+            digest.update(doc.xref_stream_raw(xref))
+        else:
+            digest.update(doc.xref_object(xref, compressed=True).encode('utf-8'))
+        xref_digests[xref] = digest.hexdigest()
+    return xref_digests[xref]
+
+def page_cache_key(doc, page, xref_digests=None):
+    """
+    Вычисляет ключ кэша страницы по ее потоку содержимого и ресурсам
+
+    Одинаковые страницы разных редакций документа получают одинаковый ключ,
+    даже если остальные страницы изменились.
+
+    Args:
+        doc: Открытый документ fitz
+        page: Страница документа
+        xref_digests (dict): Кэш хэшей объектов, общий для страниц одного документа
+
+    Returns:
+        str: Шестнадцатеричный SHA-256 ключ
+    """
+    if xref_digests is None:
+        xref_digests = {}
+
+    key = hashlib.sha256()
+    key.update(f"{tuple(page.rect)}|{page.rotation}\n".encode('utf-8'))
+    key.update(page.read_contents())
+
+    # Имена ресурсов из потока содержимого (/F1, /Im0) и хэши объектов, на которые они указывают
+    resources = []
+    for font in page.get_fonts(full=True):
+        xref, _, font_type, basefont, name, encoding = font[:6]
+        # Файл шрифта определяет, как глифы превращаются в текст; у шрифтов без
+        # встроенного файла используем имя без префикса подмножества (ABCDEF+)
+        font_file_xref = _font_file_xref(doc, xref)
+        if font_file_xref:
+            font_digest = _xref_digest(doc, font_file_xref, xref_digests)
+        else:
+            font_digest = basefont.split('+', 1)[-1]
+        resources.append(f"font|{name}|{font_type}|{encoding}|{font_digest}")
+    for image in page.get_images(full=True):
+        xref, name = image[0], image[7]
+        resources.append(f"image|{name}|{_xref_digest(doc, xref, xref_digests)}")
+    for xobject in page.get_xobjects():
+        xref, name = xobject[0], xobject[1]
+        resources.append(f"form|{name}|{_xref_digest(doc, xref, xref_digests)}")
+
+    for resource in sorted(resources):
+        key.update(resource.encode('utf-8'))
+        key.update(b"\n")
+    return key.hexdigest()
+
+def _font_file_xref(doc, font_xref):
+    """Находит поток файла шрифта (FontFile/FontFile2/FontFile3) для объекта шрифта"""
+    if not font_xref:
+        return 0
+    descriptor_xref = font_xref
+    # У составных шрифтов дескриптор находится у потомка
+    value_type, value = doc.xref_get_key(font_xref, "DescendantFonts")
+    if value_type == "array":
+        refs = value.strip("[]").split()
+        if refs and refs[0].isdigit():
+            descriptor_xref = int(refs[0])
+    value_type, value = doc.xref_get_key(descriptor_xref, "FontDescriptor")
+    if value_type != "xref":
+        return 0
+    descriptor = int(value.split()[0])
+    for file_key in ("FontFile", "FontFile2", "FontFile3"):
+        value_type, value = doc.xref_get_key(descriptor, file_key)
+        if value_type == "xref":
+            return int(value.split()[0])
+    return 0
+
+def _entry_path(cache_dir, engine, key):
+    return Path(cache_dir) / engine / key[:2] / f"{key}.md"
+
+def load_page(cache_dir, engine, key):
+    """
+    Возвращает Markdown страницы из кэша или None, если записи нет
+
+    Args:
+        cache_dir (str или Path): Каталог кэша
+        engine (str): Обработчик, которым получен Markdown (версия извлечения PyMuPDF, marker)
+        key (str): Ключ страницы из page_cache_key()
+    """
+    if not cache_dir or not key:
+        return None
+    entry = _entry_path(cache_dir, engine, key)
+    try:
+        return entry.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать запись кэша страниц {entry}: {e}")
+        return None
+
+def store_page(cache_dir, engine, key, page_markdown):
+    """Сохраняет Markdown страницы в кэш (атомарно, через временный файл)"""
+    if not cache_dir or not key:
+        return
+    entry = _entry_path(cache_dir, engine, key)
+    tmp_entry = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+    try:
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_entry.write_text(page_markdown, encoding='utf-8')
+        os.replace(tmp_entry, entry)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить запись кэша страниц {entry}: {e}")
+        tmp_entry.unlink(missing_ok=True)
@@ -1,8 +1,11 @@
 import fitz  # PyMuPDF
 from pathlib import Path
+import os
 import sys
 import logging
 import re
+import unicodedata
+import pdf_page_cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -11,6 +14,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Версия алгоритма извлечения: входит в имя раздела кэша страниц, поэтому
+# изменение извлечения делает старые записи кэша недействительными
+EXTRACTOR_VERSION = 2
+CACHE_ENGINE = f"pymupdf-v{EXTRACTOR_VERSION}"
+
+# Правила нормализации и фильтрации текста, применяются к каждой странице
+PAGE_RULES = [
+    (re.compile(r'\n{3,}'), '\n\n'),  # Уменьшаем количество пустых строк
+    (re.compile(r' +'), ' '),  # Удаляем лишние пробелы
+    # Удаляем строки с информацией о классификации и подписями
+    (re.compile(r'Classified as Qarmet Internal Use.*'), ''),
+    (re.compile(r'.*подписал\(а\).*\d{4}\.\d{2}\.\d{2}.*'), ''),
+]
+
+# Флаги извлечения текста: без TEXT_PRESERVE_IMAGES блоки изображений
+# не создаются и изображения не декодируются
+TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+# Минимальный промежуток между словами (в пунктах), отделяющий столбцы таблицы
+COLUMN_GAP_MIN = 8
+
+# Параметры оценки качества извлеченного текста
+GARBLED_WEIGHT = 5  # 20% "битых" символов дают нулевую оценку
+IMAGE_PAGE_RATIO = 0.5  # Доля площади под изображениями, после которой страница считается сканом
+MIN_TEXT_CHARS_ON_IMAGE_PAGE = 200  # Сколько текста должно быть на такой странице
+
 def is_table_block(block):
     """
     Определяет, является ли блок таблицей на основе его структуры
@@ -169,47 +198,104 @@ def convert_table_to_markdown(table_rows):
     
     return "\n".join(md_lines)
 
+def find_table_candidates(words):
+    """
+    Дешевый проход: отмечает блоки, похожие на таблицы, по списку слов страницы
+    
+    Блок считается кандидатом, если в нем не меньше 3 строк и в большинстве
+    строк между словами есть широкие промежутки, разделяющие столбцы.
+    
+    Args:
+        words: Результат page.get_text("words")
+        
+    Returns:
+        set: Номера блоков-кандидатов
+    """
+    # Слова сгруппированы по (блок, строка) и идут в порядке чтения
+    lines = {}
+    for x0, y0, x1, y1, _, block_no, line_no, _ in words:
+        lines.setdefault((block_no, line_no), []).append((x0, x1, y1 - y0))
+    
+    block_lines = {}
+    block_column_lines = {}
+    for (block_no, _), line_words in lines.items():
+        block_lines[block_no] = block_lines.get(block_no, 0) + 1
+        line_words.sort()
+        # Промежуток шире высоты строки (3-4 пробела) считаем границей столбца
+        has_column_gap = any(
+            next_word[0] - word[1] > max(word[2], COLUMN_GAP_MIN)
+            for word, next_word in zip(line_words, line_words[1:])
+        )
+        if has_column_gap:
+            block_column_lines[block_no] = block_column_lines.get(block_no, 0) + 1
+    
+    return {
+        block_no for block_no, line_count in block_lines.items()
+        if line_count >= 3 and block_column_lines.get(block_no, 0) / line_count >= 0.5
+    }
+
+def extract_dict_block_text(block):
+    """Собирает текст блока из get_text("dict") с сохранением строк"""
+    block_text = []
+    for line in block.get("lines", []):
+        line_text = " ".join(span.get("text", "") for span in line.get("spans", []))
+        if line_text.strip():
+            block_text.append(line_text.strip())
+    return "\n".join(block_text)
+
 def extract_text_and_tables(page):
     """
     Извлекает текст и таблицы со страницы PDF с сохранением их взаимного расположения
     
+    Извлечение двухпроходное: обычный текст берется из дешевых проходов
+    "blocks"/"words", а полная структура "dict" (спаны, шрифты, координаты)
+    строится только для областей, похожих на таблицы. Изображения не извлекаются
+    и не декодируются.
+    
     Args:
         page: Объект страницы PDF
         
     Returns:
         str: Markdown-текст со встроенными таблицами
     """
-    # Получаем словарь с информацией о блоках текста
-    page_dict = page.get_text("dict")
-    blocks = page_dict["blocks"]
+    # Один текстовый слой страницы для обоих дешевых проходов
+    textpage = page.get_textpage(flags=TEXT_FLAGS)
+    blocks = page.get_text("blocks", textpage=textpage)
+    table_candidates = find_table_candidates(page.get_text("words", textpage=textpage))
     
     # Сортируем блоки по их положению сверху вниз
-    blocks.sort(key=lambda b: b["bbox"][1])
+    blocks.sort(key=lambda b: b[1])
     
     # Результирующий текст
     result_parts = []
     
-    for block in blocks:
+    for x0, y0, x1, y1, text, block_no, block_type in blocks:
         # Пропускаем изображения и пустые блоки
-        if block.get("type") != 0 or "lines" not in block:
+        if block_type != 0 or not text.strip():
             continue
         
-        # Проверяем, является ли блок таблицей
-        if is_table_block(block):
-            table_rows = extract_table_data(block)
-            if table_rows:
-                md_table = convert_table_to_markdown(table_rows)
+        if block_no in table_candidates:
+            # Полная структура только для области блока-кандидата
+            clip = fitz.Rect(x0, y0, x1, y1)
+            for block in page.get_text("dict", clip=clip, flags=TEXT_FLAGS)["blocks"]:
+                if block.get("type") != 0 or "lines" not in block:
+                    continue
+                
+                # Проверяем, является ли блок таблицей
+                md_table = ""
+                if is_table_block(block):
+                    table_rows = extract_table_data(block)
+                    if table_rows:
+                        md_table = convert_table_to_markdown(table_rows)
                 if md_table:
                     result_parts.append("\n" + md_table + "\n")
+                else:
+                    paragraph = extract_dict_block_text(block)
+                    if paragraph:
+                        result_parts.append(paragraph)
         else:
             # Обычный текст - собираем его с сохранением структуры абзацев
-            block_text = []
-            
-            for line in block.get("lines", []):
-                line_text = " ".join(span.get("text", "") for span in line.get("spans", []))
-                if line_text.strip():
-                    block_text.append(line_text.strip())
-            
+            block_text = [line.strip() for line in text.splitlines() if line.strip()]
             if block_text:
                 paragraph = "\n".join(block_text)
                 result_parts.append(paragraph)
@@ -227,13 +313,133 @@ def extract_text_and_tables(page):
     
     return result
 
-def pdf_to_markdown(pdf_path, md_path):
+def normalize_page_markdown(page_content):
+    """
+    Нормализует и фильтрует Markdown-текст одной страницы
+    
+    Все правила построчные, поэтому применение их к каждой странице отдельно
+    дает тот же результат, что и обработка всего документа целиком.
+    
+    Args:
+        page_content (str): Markdown-текст страницы
+        
+    Returns:
+        str: Текст страницы без лишних пробелов, пустых строк и служебных подписей
+    """
+    for pattern, replacement in PAGE_RULES:
+        page_content = pattern.sub(replacement, page_content)
+    return page_content.strip("\n")
+
+def extract_page_markdown(page):
+    """
+    Извлекает нормализованный Markdown-текст одной страницы
+    
+    Args:
+        page: Объект страницы PDF
+        
+    Returns:
+        str: Нормализованный Markdown-текст страницы
+    """
+    return normalize_page_markdown(extract_text_and_tables(page))
+
+def is_garbled_char(ch):
+    """Символ замены, символ из области частного использования или управляющий символ"""
+    if ch in "\n\t":
+        return False
+    return ch == "\ufffd" or unicodedata.category(ch) in ("Co", "Cn", "Cc")
+
+def score_page_quality(page, page_content):
+    """
+    Оценивает качество текста, извлеченного PyMuPDF со страницы
+    
+    Учитывает покрытие страницы текстом, страницы из одних изображений (сканы)
+    и долю "битых" глифов, которые появляются при отсутствии ToUnicode в шрифтах.
+    
+    Args:
+        page: Объект страницы PDF
+        page_content (str): Markdown-текст, извлеченный со страницы
+        
+    Returns:
+        float: Оценка от 0 (нужно распознавание) до 1 (текст извлечен полностью)
+    """
+    text = "".join(page_content.split())
+    
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    image_ratio = min(1.0, image_area / page_area)
+    
+    if not text:
+        # Пустая страница без изображений распознавать нечего, а страница
+        # с изображениями и без текста - скан
+        return 0.0 if image_ratio > 0.1 else 1.0
+    
+    garbled_ratio = sum(1 for ch in text if is_garbled_char(ch)) / len(text)
+    score = 1.0 - min(1.0, garbled_ratio * GARBLED_WEIGHT)
+    
+    # Страница почти целиком занята изображением, а текста мало - вероятно,
+    # это скан с колонтитулами или частичным текстовым слоем
+    if image_ratio >= IMAGE_PAGE_RATIO and len(text) < MIN_TEXT_CHARS_ON_IMAGE_PAGE:
+        score *= len(text) / MIN_TEXT_CHARS_ON_IMAGE_PAGE
+    
+    return score
+
+def iter_page_markdown(doc, cache_dir=None):
+    """
+    Постранично извлекает Markdown из открытого PDF документа
+    
+    Args:
+        doc: Открытый документ fitz
+        cache_dir (str или Path): Каталог кэша страниц; неизмененные страницы
+            берутся из кэша без повторного извлечения
+        
+    Yields:
+        str: Нормализованный Markdown-текст очередной страницы
+    """
+    page_count = len(doc)
+    xref_digests = {}
+    for page_num in range(page_count):
+        page = doc.load_page(page_num)
+        key = pdf_page_cache.page_cache_key(doc, page, xref_digests) if cache_dir else None
+        page_content = pdf_page_cache.load_page(cache_dir, CACHE_ENGINE, key)
+        if page_content is None:
+            logger.info(f"Обработка страницы {page_num + 1}/{page_count}")
+            page_content = extract_page_markdown(page)
+            pdf_page_cache.store_page(cache_dir, CACHE_ENGINE, key, page_content)
+        else:
+            logger.info(f"Страница {page_num + 1}/{page_count} взята из кэша")
+        yield page_content
+
+def write_markdown_pages(pages, out):
+    """
+    Записывает страницы в файл по мере поступления, разделяя их линией "---"
+    
+    Args:
+        pages: Итерируемый объект с Markdown-текстом страниц
+        out: Открытый текстовый файл для записи
+    """
+    first_piece = True
+    for page_num, page_content in enumerate(pages, 1):
+        pieces = ["---"] if page_num > 1 else []
+        # Пустые страницы не пишем, но разделитель для них сохраняем
+        if page_content:
+            pieces.append(page_content)
+        for piece in pieces:
+            if not first_piece:
+                out.write("\n\n")
+            out.write(piece)
+            first_piece = False
+
+def pdf_to_markdown(pdf_path, md_path, cache_dir=None):
     """
     Конвертирует PDF файл в Markdown формат с распознаванием таблиц.
     
+    Страницы обрабатываются и записываются по одной, поэтому потребление памяти
+    пропорционально размеру одной страницы, а не всего документа.
+    
     Args:
         pdf_path (str или Path): Путь к входному PDF файлу
         md_path (str или Path): Путь к выходному Markdown файлу
+        cache_dir (str или Path): Каталог кэша страниц (необязательно)
     """
     pdf_path = Path(pdf_path)
     md_path = Path(md_path)
@@ -241,41 +447,19 @@ def pdf_to_markdown(pdf_path, md_path):
     if not pdf_path.exists():
         raise FileNotFoundError(f"PDF файл не найден: {pdf_path}")
 
-    try:
-        doc = fitz.open(pdf_path)
-        markdown_content = []
+    # Пишем во временный файл, чтобы при ошибке не оставить обрезанный результат
+    part_path = md_path.with_name(md_path.name + ".part")
 
-        for page_num, page in enumerate(doc, 1):
-            logger.info(f"Обработка страницы {page_num}/{len(doc)}")
-            
-            # Извлекаем текст и таблицы со страницы
-            page_content = extract_text_and_tables(page)
-            
-            # Добавляем обработанный контент
-            if page_content:
-                markdown_content.append(page_content)
-            
-            # Добавляем разделитель страниц, если это не последняя страница
-            if page_num < len(doc):
-                markdown_content.append("\n---\n")
+    try:
+        with fitz.open(pdf_path) as doc, part_path.open("w", encoding="utf-8") as out:
+            write_markdown_pages(iter_page_markdown(doc, cache_dir), out)
 
-        # Объединяем все страницы в один документ
-        result_md = "\n".join(markdown_content)
-        
-        # Нормализуем пробелы и переводы строк
-        result_md = re.sub(r'\n{3,}', '\n\n', result_md)  # Уменьшаем количество пустых строк
-        result_md = re.sub(r' +', ' ', result_md)  # Удаляем лишние пробелы
-        
-        # Удаляем строки с информацией о классификации и подписями
-        result_md = re.sub(r'Classified as Qarmet Internal Use.*', '', result_md)
-        result_md = re.sub(r'.*подписал\(а\).*\d{4}\.\d{2}\.\d{2}.*', '', result_md)
-        
-        # Записываем результат в файл
-        md_path.write_text(result_md, encoding="utf-8")
+        os.replace(part_path, md_path)
         logger.info(f"✅ Успешно конвертирован: {pdf_path.name} -> {md_path.name}")
 
     except Exception as e:
         logger.error(f"❌ Ошибка при конвертации: {str(e)}")
+        part_path.unlink(missing_ok=True)
         raise
 
 def main():
@@ -284,7 +468,7 @@ def main():
         sys.exit(1)
 
     try:
-        pdf_to_markdown(sys.argv[1], sys.argv[2])
+        pdf_to_markdown(sys.argv[1], sys.argv[2], cache_dir=os.getenv("PDF_PAGE_CACHE_DIR"))
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         sys.exit(1)
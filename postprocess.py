@@ -1,109 +1,103 @@
-import os
-import re
-import json
-import subprocess
-from pathlib import Path
-from datetime import timedelta
-
-# === CONFIG ===
-AUDIO_NAME = "output2.wav"
-INPUT_DIR = Path("input")  # directory with input .wav file
-OUTPUT_DIR = Path("output")  # all outputs (.json, .txt, .md) will go here
-RAW_JSON = OUTPUT_DIR / "output2.json"
-RAW_TXT = OUTPUT_DIR / "output2.txt"
-FORMATTED_JSON_TXT = OUTPUT_DIR / f"{AUDIO_NAME}.formatted_dialog.txt"
-MERGED_MD = OUTPUT_DIR / f"{AUDIO_NAME}.merged.md"
-RUN_BAT = "run.bat"
-
-
-def format_timestamp(seconds):
-    return str(timedelta(seconds=round(seconds, 2)))
-
-
-def run_whisper_bat():
-    print(f"[INFO] Running: {RUN_BAT}")
-    audio_path = INPUT_DIR / AUDIO_NAME
-    result = subprocess.run([RUN_BAT, str(audio_path)], shell=True)
-    if result.returncode != 0:
-        print(f"[ERROR] Failed to run {RUN_BAT}")
-        exit(1)
-    print("[INFO] Transcription completed.")
-
-
-def extract_segments_to_txt():
-    if not RAW_JSON.exists():
-        print(f"[ERROR] JSON not found: {RAW_JSON}")
-        return
-
-    with open(RAW_JSON, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    segments = data.get("segments", [])
-    if not segments:
-        print("[INFO] No segments found in JSON.")
-        return
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
 
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    with open(FORMATTED_JSON_TXT, "w", encoding="utf-8") as out:
-        for seg in segments:
-            start = format_timestamp(seg["start"])
-            end = format_timestamp(seg["end"])
-            speaker = seg.get("speaker", "SPEAKER_??")
-            text = seg.get("text", "").strip()
-            out.write(f"[{start} - {end}] {speaker}: {text}\n")
-    print(f"[INFO] Saved timestamped segments to: {FORMATTED_JSON_TXT}")
+"""
+Повторный рендеринг заметок из сохраненных сегментов WhisperX
 
+file_processor_service сохраняет сегменты записи рядом с заметкой
+({prefix}_transcript.segments рядом с {prefix}_transcript.md, формат segment_store;
+более ранние записи могут иметь {prefix}_transcript.json). После изменения
+разметки в transcript_model.render_dialog_markdown() заметки можно пересобрать без повторной транскрибации:
+скрипт находит сегменты во всем хранилище и пересобирает заметки в пуле процессов.
+Frontmatter заметки (в том числе поля обогащения метаданных) сохраняется, заметки,
+тело которых не изменилось бы, не перезаписываются.
 
-def group_and_format_dialog(input_file, output_md):
-    print(f"[INFO] Reading: {input_file}")
-    if not input_file.exists():
-        print(f"[ERROR] File not found: {input_file}")
-        return
-
-    with input_file.open("r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    dialog = []
-    current_speaker = None
-    current_block = []
-
-    for idx, line in enumerate(lines):
-        line = line.strip()
-        match = re.match(r"\[(.+?) - (.+?)\] (SPEAKER_\d{2}|Speaker \d+): (.+)", line)
-        if not match:
-            print(f"[WARNING] Line {idx + 1} did not match format: {line}")
-            continue
-
-        start, end, speaker, text = match.groups()
-        if speaker != current_speaker:
-            if current_block:
-                dialog.append((current_speaker, current_block))
-            current_speaker = speaker
-            current_block = [(start, end, text)]
-        else:
-            current_block.append((start, end, text))
-
-    if current_block:
-        dialog.append((current_speaker, current_block))
-
-    speaker_map = {}
-    speaker_counter = 1
-
-    with output_md.open("w", encoding="utf-8") as out:
-        for raw_speaker, blocks in dialog:
-            if raw_speaker not in speaker_map:
-                speaker_map[raw_speaker] = f"Speaker {speaker_counter}"
-                speaker_counter += 1
-            name = speaker_map[raw_speaker]
-            out.write(f"### {name}\n\n")
-            for start, end, text in blocks:
-                out.write(f"- **[{start} - {end}]** {text}\n")
-            out.write("\n")
-
-    print(f"[DONE] Merged Markdown saved to: {output_md}")
+Использование:
+    python postprocess.py [каталог ...] [--jobs 4] [--dry-run]
+"""
 
+import os
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+import file_processor_service as service
+import segment_store
+from transcript_model import Transcript, render_dialog_markdown
+
+LEGACY_SEGMENTS_SUFFIX = '.json'
+
+def find_segment_files(roots):
+    """Retained segment files that have a note next to them (the compact store wins over legacy JSON)"""
+    for root in roots:
+        for md_file in Path(root).rglob('*_transcript.md'):
+            for suffix in (segment_store.SEGMENTS_SUFFIX, LEGACY_SEGMENTS_SUFFIX):
+                segments_file = md_file.with_suffix(suffix)
+                if segments_file.is_file():
+                    yield segments_file
+                    break
+
+def note_body(content):
+    """Body of a note after its frontmatter, split the same way as replace_note_body()"""
+    if content.startswith('---'):
+        parts = content.split('---', 2)
+        if len(parts) >= 3:
+            return parts[2]
+    return content
+
+def render_note(segments_file, dry_run=False):
+    """
+    Пересобирает тело заметки из сегментов
+
+    Returns:
+        tuple: (путь к заметке, 'updated' | 'unchanged' | 'empty' | 'error: ...')
+    """
+    md_file = segments_file.with_suffix('.md')
+    try:
+        transcript = Transcript.load(segments_file)
+        if not len(transcript):
+            return md_file, 'empty'
+        # Тело в том же виде, в каком его пишет group_and_format_dialog()
+        new_body = "\n\n" + render_dialog_markdown(transcript)
+        # Обогащение метаданных может добавить пустые строки после frontmatter
+        if note_body(md_file.read_text(encoding='utf-8')).strip() == new_body.strip():
+            return md_file, 'unchanged'
+        if not dry_run:
+            service.replace_note_body(md_file, new_body, {})
+        return md_file, 'updated'
+    except Exception as e:
+        return md_file, f"error: {e}"
+
+def rerender(roots, jobs=None, dry_run=False):
+    """Re-render all notes with retained segments under roots; returns counts per status"""
+    segment_files = list(find_segment_files(roots))
+    print(f"[INFO] Найдено заметок с сохраненными сегментами: {len(segment_files)}")
+    counts = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(render_note, segment_files, [dry_run] * len(segment_files), chunksize=16)
+        for md_file, status in results:
+            key = 'error' if status.startswith('error') else status
+            counts[key] = counts.get(key, 0) + 1
+            if key == 'updated':
+                print(f"[{'DRY-RUN' if dry_run else 'UPDATED'}] {md_file}")
+            elif key == 'error':
+                print(f"[ERROR] {md_file}: {status[len('error: '):]}")
+    print(f"[DONE] Обновлено: {counts.get('updated', 0)}, без изменений: {counts.get('unchanged', 0)}, "
+          f"пустых: {counts.get('empty', 0)}, ошибок: {counts.get('error', 0)}")
+    return counts
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Re-render transcript notes from retained WhisperX segments")
+    parser.add_argument("roots", nargs="*", help="Directories to search (default: OBSIDIAN_VAULT_ROOT)")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Only list notes that would change")
+    args = parser.parse_args()
+
+    roots = args.roots or [os.getenv('OBSIDIAN_VAULT_ROOT') or '.']
+    counts = rerender(roots, args.jobs, args.dry_run)
+    return 1 if counts.get('error') else 0
 
 if __name__ == "__main__":
-    run_whisper_bat()
-    extract_segments_to_txt()
-    group_and_format_dialog(FORMATTED_JSON_TXT, MERGED_MD)
\ No newline at end of file
+    raise SystemExit(main())
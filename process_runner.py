@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Запуск внешних команд (WhisperX, marker, ffmpeg) с жестким таймаутом
+
+Команда запускается в отдельной группе процессов. По истечении таймаута завершается
+вся группа, включая дочерние процессы (python из run.bat, воркеры marker),
+поэтому зависший вызов CUDA или запрос к LLM не блокирует сервис.
+
+Вывод читается построчно по мере появления: строки пишутся в журнал задания,
+в памяти остаются только последние OUTPUT_TAIL_LINES строк каждого потока.
+Строки проверяются шаблонами (нехватка памяти CUDA, ошибка загрузки модели и т.п.),
+и при совпадении процесс останавливается сразу, не дожидаясь его завершения.
+"""
+
+import os
+import re
+import time
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать завершения группы после SIGTERM, прежде чем послать SIGKILL
+TERMINATE_GRACE_SECONDS = 10
+# Сколько ждать, пока потоки чтения дочитают вывод после завершения процесса
+READER_JOIN_TIMEOUT = 5
+# Как часто проверять таймаут и сигнал остановки
+POLL_INTERVAL = 0.5
+# Сколько последних строк stdout и stderr сохраняется для заметок об ошибках
+OUTPUT_TAIL_LINES = 200
+
+# Команды, занимающие GPU (WhisperX и marker), выполняются по одной: в reprocess.py PDF
+# обрабатываются в несколько потоков, и параллельные marker вытеснили бы друг друга и
+# транскрибацию из памяти видеокарты
+gpu_lock = threading.Lock()
+
+# Причины досрочной остановки, общие для WhisperX и marker
+CUDA_OOM = 'cuda_oom'
+# Процесс остановлен по запросу вызывающего (should_stop), например ради более срочной работы
+PREEMPTED = 'preempted'
+# Не удалось подготовить данные для stdin процесса (например, ffmpeg не декодировал запись)
+INPUT_FAILED = 'input_failed'
+MODEL_DOWNLOAD_FAILED = 'model_download_failed'
+FAILURE_PATTERNS = {
+    CUDA_OOM: re.compile(
+        r'CUDA out of memory|OutOfMemoryError|CUBLAS_STATUS_ALLOC_FAILED|cudaErrorMemoryAllocation'),
+    MODEL_DOWNLOAD_FAILED: re.compile(
+        r"LocalEntryNotFoundError|couldn't connect to 'https://huggingface\.co'"
+        r"|Cannot find an appropriate cached snapshot"
+        r"|HTTPSConnectionPool\(host='(huggingface\.co|[\w.-]+\.hf\.co|models\.datalab\.to)'"),
+}
+
+class CommandResult:
+    """Result of run_command(): like subprocess.CompletedProcess plus timeout/abort details"""
+    def __init__(self, command, returncode, stdout, stderr, timed_out=False, aborted=None, log_path=None):
+        self.args = command
+        self.returncode = returncode
+        # Только последние OUTPUT_TAIL_LINES строк; полный вывод - в журнале log_path
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        # Ключ сработавшего шаблона из abort_patterns или None
+        self.aborted = aborted
+        self.log_path = log_path
+
+class InputAborted(Exception):
+    """Raised by a stdin_chunks iterable to stop the process with the given abort reason"""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+def popen_group_kwargs():
+    """Popen arguments that put the child into its own process group"""
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+def process_group_alive(process):
+    """Check if any process of the child's group is still running (POSIX)"""
+    # Завершившийся лидер группы собирается, иначе зомби продолжает числиться в группе
+    process.poll()
+    try:
+        os.killpg(process.pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+def kill_process_group(process):
+    """Terminate the process and all of its children.
+       On POSIX the whole group gets SIGTERM and, if anything in it is still running after
+       the grace period, SIGKILL - even when the leader itself has already exited, since
+       a child that ignores SIGTERM keeps the output pipes open.
+    """
+    if os.name == 'nt':
+        # taskkill находит дерево процессов только по живому родителю
+        if process.poll() is None:
+            subprocess.run(['taskkill', '/PID', str(process.pid), '/T', '/F'], capture_output=True)
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + TERMINATE_GRACE_SECONDS
+        while time.monotonic() < deadline:
+            if not process_group_alive(process):
+                return
+            time.sleep(0.1)
+        logger.warning(f"Группа процессов {process.pid} не завершилась за {TERMINATE_GRACE_SECONDS} с, SIGKILL")
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Группа уже пуста
+        pass
+    except PermissionError as e:
+        logger.warning(f"Не удалось завершить группу процессов {process.pid}: {e}")
+        if process.poll() is None:
+            process.kill()
+
+def pump_lines(stream, tail, log_file, log_lock, abort_patterns, on_abort):
+    """Read a pipe line by line: keep the tail, write the log and check abort patterns"""
+    for line in stream:
+        tail.append(line)
+        if log_file is not None:
+            with log_lock:
+                # Журнал закрывается, если поток не дочитал вывод за READER_JOIN_TIMEOUT
+                if not log_file.closed:
+                    log_file.write(line)
+        for reason, pattern in abort_patterns.items():
+            if pattern.search(line):
+                on_abort(reason, line.strip())
+                break
+
+def feed_stdin(stream, chunks, on_abort):
+    """Write chunks to the process stdin, closing it after the last one.
+       If producing the chunks fails, the process is stopped instead and stdin stays open,
+       so the process does not start working on incomplete input.
+    """
+    try:
+        for chunk in chunks:
+            stream.write(chunk)
+    except BrokenPipeError:
+        # Процесс завершился, не дочитав вход; причину покажет его код возврата
+        return
+    except InputAborted as e:
+        on_abort(e.reason, str(e))
+        return
+    except Exception as e:
+        on_abort(INPUT_FAILED, f"ошибка подготовки входных данных: {e}")
+        return
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+    try:
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+def join_readers(readers, timeout):
+    """Join the output reader threads, waiting at most timeout seconds in total"""
+    deadline = time.monotonic() + timeout
+    for reader in readers:
+        reader.join(max(0.0, deadline - time.monotonic()))
+
+def close_pipes(process, readers, command):
+    """Close the pipes of a finished command.
+       A pipe whose reader is still blocked (held open by a process outside the group)
+       is left to its daemon thread: closing it would wait for the reader's buffer lock.
+    """
+    if process.stdin is not None:
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+    for stream, reader in zip((process.stdout, process.stderr), readers):
+        if reader.is_alive():
+            logger.warning(f"{command[0]}: вывод процесса {process.pid} не закрыт, чтение брошено")
+            continue
+        stream.close()
+
+def run_command(command, timeout=None, env=None, log_path=None, abort_patterns=None, stdin_chunks=None,
+                should_stop=None):
+    """
+    Выполняет команду, потоково читая ее вывод, и завершает группу процессов
+    по таймауту или при появлении в выводе строки, совпавшей с abort_patterns
+
+    Args:
+        command (list): Команда и аргументы
+        timeout (float): Максимальное время выполнения в секундах (None - без ограничения)
+        env (dict): Окружение процесса
+        log_path (str или Path): Журнал, в который построчно пишется весь вывод
+        abort_patterns (dict): Причина -> регулярное выражение; первая совпавшая строка
+            останавливает процесс
+        stdin_chunks (iterable): Блоки bytes, которые пишутся в stdin процесса из отдельного потока;
+            InputAborted или другая ошибка при их получении останавливает процесс
+        should_stop (callable): Проверяется каждые POLL_INTERVAL секунд; если вернул True,
+            группа процессов завершается, а aborted = PREEMPTED
+
+    Returns:
+        CommandResult: Код возврата, последние строки stdout и stderr, признаки таймаута и остановки
+    """
+    abort_patterns = abort_patterns or {}
+    log_file = None
+    if log_path is not None:
+        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+        log_file = open(log_path, 'a', encoding='utf-8', buffering=1)
+        log_file.write(f"$ {' '.join(str(part) for part in command)}\n")
+    log_lock = threading.Lock()
+    abort_event = threading.Event()
+    aborted = []
+
+    def on_abort(reason, line):
+        if not abort_event.is_set():
+            aborted.append(reason)
+            logger.error(f"{command[0]}: {line} - процесс останавливается ({reason})")
+            abort_event.set()
+
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if stdin_chunks is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        errors='replace',
+        env=env,
+        **popen_group_kwargs()
+    )
+    stdout_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    stderr_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    readers = [
+        threading.Thread(target=pump_lines, daemon=True,
+                         args=(stream, tail, log_file, log_lock, abort_patterns, on_abort))
+        for stream, tail in ((process.stdout, stdout_tail), (process.stderr, stderr_tail))
+    ]
+    for reader in readers:
+        reader.start()
+    if stdin_chunks is not None:
+        threading.Thread(target=feed_stdin, daemon=True,
+                         args=(process.stdin.buffer, stdin_chunks, on_abort)).start()
+
+    timed_out = False
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while process.poll() is None:
+            if abort_event.wait(POLL_INTERVAL):
+                kill_process_group(process)
+                break
+            if should_stop is not None and should_stop():
+                logger.info(f"{command[0]}: процесс {process.pid} вытеснен, группа завершается")
+                if not abort_event.is_set():
+                    aborted.append(PREEMPTED)
+                    abort_event.set()
+                kill_process_group(process)
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.error(f"{command[0]}: превышен таймаут {timeout:.0f} с, процесс {process.pid} завершается")
+                timed_out = True
+                kill_process_group(process)
+                break
+        process.wait()
+        join_readers(readers, READER_JOIN_TIMEOUT)
+        if any(reader.is_alive() for reader in readers):
+            # Вывод держит открытым дочерний процесс, переживший лидера группы
+            logger.warning(f"{command[0]}: дочерние процессы {process.pid} держат вывод открытым, группа завершается")
+            kill_process_group(process)
+            join_readers(readers, READER_JOIN_TIMEOUT)
+    except BaseException:
+        # KeyboardInterrupt и т.п.: не оставляем дочерние процессы работать
+        kill_process_group(process)
+        raise
+    finally:
+        close_pipes(process, readers, command)
+        if log_file is not None:
+            with log_lock:
+                log_file.close()
+
+    stderr = ''.join(stderr_tail)
+    if timed_out:
+        stderr += f"\n[TIMEOUT] Процесс завершен после {timeout:.0f} с"
+    return CommandResult(command, process.returncode, ''.join(stdout_tail), stderr,
+                         timed_out=timed_out, aborted=aborted[0] if aborted else None, log_path=log_path)
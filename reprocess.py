@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Пакетная обработка накопившихся файлов (например, после простоя сервиса)
+
+Файлы из каталога или по шаблону glob проходят тот же конвейер, что и в
+file_processor_service. PDF обрабатываются в несколько потоков, но параллельно идет только
+извлечение текста PyMuPDF: запуски marker (surya, GPU) и транскрибации выполняются по одному
+под общей блокировкой GPU (process_runner.gpu_lock). Аудио обрабатывается по одному файлу
+под блокировкой конвейера сервиса, так как путь аудио меняет общее состояние сервиса.
+Короткие задания запускаются первыми;
+после каждого файла выводятся прогресс и оценка оставшегося времени по суммарной
+длительности записей. Итог каждого файла записывается в файл состояния, поэтому
+прерванный запуск можно продолжить той же командой: готовые файлы пропускаются,
+неудачные - тоже, если не указан --retry-failed.
+
+Использование:
+    python reprocess.py путь/к/каталогу [--jobs 2]
+    python reprocess.py "архив/2024-*/*.pdf" --jobs 4 --retry-failed
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import file_processor_service as service
+
+STATE_FILE_NAME = '.reprocess_state.json'
+
+class ReprocessState:
+    """Outcome of every processed file, persisted after each job so an interrupted run can resume"""
+    def __init__(self, state_path):
+        self.state_path = Path(state_path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.state_path.exists():
+            try:
+                self.entries = json.loads(self.state_path.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as e:
+                print(f"[WARNING] Не удалось прочитать файл состояния {self.state_path}: {e}")
+
+    def status(self, file_path):
+        return self.entries.get(str(file_path), {}).get('status')
+
+    def record(self, file_path, status):
+        with self.lock:
+            self.entries[str(file_path)] = {'status': status, 'finished': datetime.now().isoformat(timespec='seconds')}
+            tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+            tmp_path.write_text(json.dumps(self.entries, ensure_ascii=False, indent=1), encoding='utf-8')
+            os.replace(tmp_path, self.state_path)
+
+def collect_files(source):
+    """Files matching a directory or glob pattern that the pipeline can process"""
+    if os.path.isdir(source):
+        candidates = Path(source).glob('*')
+    else:
+        candidates = (Path(path) for path in glob.glob(source, recursive=True))
+    files = []
+    for file_path in candidates:
+        if not file_path.is_file() or service.is_syncthing_temp_file(file_path):
+            continue
+        if file_path.suffix.lower() not in service.SUPPORTED_EXTENSIONS:
+            continue
+        if file_path.stat().st_size < service.config['min_file_size']:
+            print(f"[INFO] File {file_path.name} is too small, skipping.")
+            continue
+        files.append(file_path.resolve())
+    return files
+
+class Progress:
+    """Progress and ETA by estimated job cost (seconds of audio, pages for PDF)"""
+    def __init__(self, total_files, total_cost):
+        self.total_files = total_files
+        self.total_cost = total_cost
+        self.done_files = 0
+        self.done_cost = 0.0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def finish(self, file_path, cost, ok):
+        with self.lock:
+            self.done_files += 1
+            self.done_cost += cost
+            if not ok:
+                self.failed += 1
+            elapsed = time.monotonic() - self.started_at
+            percent = 100.0 * self.done_cost / self.total_cost if self.total_cost else 100.0
+            if self.done_cost > 0:
+                eta = timedelta(seconds=round(elapsed * (self.total_cost - self.done_cost) / self.done_cost))
+            else:
+                eta = "?"
+            status = "OK" if ok else "FAILED"
+            print(f"[PROGRESS] {self.done_files}/{self.total_files} ({percent:.1f}%) {file_path.name}: {status}. "
+                  f"Прошло {timedelta(seconds=round(elapsed))}, осталось ~{eta}")
+
+def run_job(file_path):
+    """Process one file; returns 'done', 'retry' (requeued after a transient error) or 'failed'"""
+    if file_path.suffix.lower() == '.pdf':
+        # PDF не трогают общее состояние аудио; запуски marker на GPU ждут process_runner.gpu_lock,
+        # пакет marker защищен своей блокировкой
+        return 'done' if service.process_file(file_path) else 'failed'
+    # Одна транскрибация за раз
+    with service.pipeline_lock:
+        if service.process_file(file_path):
+            return 'done'
+        if str(file_path) in service.pending_retries:
+            return 'retry'
+        return 'failed'
+
+def reprocess(files, jobs, state):
+    """Process files shortest job first: PDFs with `jobs` workers, audio one file at a time"""
+    costs = {file_path: service.estimate_job_cost(file_path) for file_path in files}
+    progress = Progress(len(files), sum(costs.values()))
+    print(f"[INFO] Файлов к обработке: {len(files)}, оценка объема: {timedelta(seconds=round(progress.total_cost))}, "
+          f"потоков: {jobs}")
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='reprocess-pdf') as pdf_pool, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='reprocess-audio') as audio_pool:
+        def submit(file_path):
+            pool = pdf_pool if file_path.suffix.lower() == '.pdf' else audio_pool
+            return pool.submit(run_job, file_path)
+
+        futures = {submit(file_path): file_path for file_path in sorted(files, key=costs.get)}
+        try:
+            while futures or service.pending_retries:
+                if not futures:
+                    time.sleep(1)
+                done, _ = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"[ERROR] Ошибка обработки {file_path.name}: {e}")
+                        result = 'failed'
+                    if result == 'retry':
+                        continue
+                    state.record(file_path, result)
+                    progress.finish(file_path, costs[file_path], result == 'done')
+
+                # Файлы после временной ошибки транскрибации возвращаются в пул по истечении паузы
+                for _, file_path in service.pop_due_retries():
+                    futures[submit(file_path)] = file_path
+
+                service.flush_pdf_batch()
+        except KeyboardInterrupt:
+            print("\n[INFO] Прерывание: дожидаемся файлов в работе, остальные будут обработаны при следующем запуске")
+            for future in futures:
+                future.cancel()
+            raise
+    # Оставшийся пакет PDF обрабатывается сразу; при прерывании он сохранен
+    # и будет восстановлен следующим запуском (restore_pdf_batch)
+    service.flush_pdf_batch(force=True)
+
+    print(f"[INFO] Обработано файлов: {progress.done_files}, с ошибками: {progress.failed}, "
+          f"время: {timedelta(seconds=round(time.monotonic() - progress.started_at))}")
+    return progress.failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess a backlog of audio and PDF files through the EchoFlow pipeline")
+    parser.add_argument("source", help="Directory or glob pattern (quote it) with files to process")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of PDFs processed in parallel (PyMuPDF extraction only; marker and audio use the GPU one job at a time)")
+    parser.add_argument("--state", help=f"State file for resuming (default: OUTPUT_DIR/{STATE_FILE_NAME})")
+    parser.add_argument("--retry-failed", action="store_true", help="Process files that failed in a previous run again")
+    parser.add_argument("--skip-metadata", action="store_true", help="Do not run metadata enrichment for new notes")
+    args = parser.parse_args()
+
+    config = service.configure()
+    service.ensure_directories()
+    service.restore_pdf_batch()
+    if args.skip_metadata:
+        # Без ключа check_single_md_metadata пропускает обогащение
+        config['openrouter_api_key'] = None
+
+    state = ReprocessState(args.state or Path(config['output_dir']) / STATE_FILE_NAME)
+    files = []
+    for file_path in collect_files(args.source):
+        status = state.status(file_path)
+        if status == 'done' or (status == 'failed' and not args.retry_failed):
+            continue
+        files.append(file_path)
+    if state.entries:
+        print(f"[INFO] Файл состояния {state.state_path}: записей о прошлых запусках {len(state.entries)}")
+    if not files:
+        print("[INFO] Нет файлов для обработки.")
+        return 0
+
+    try:
+        return 0 if reprocess(files, max(1, args.jobs), state) else 1
+    except KeyboardInterrupt:
+        return 130
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,11 +35,13 @@ if not "%ARG_OUTPUT_DIR%"=="" (
 )
 
 :: Model and other parameters
-set MODEL=large-v2
+:: file_processor_service passes the model and compute type chosen for the job
+if "%WHISPER_JOB_MODEL%"=="" (set MODEL=large-v2) else (set MODEL=%WHISPER_JOB_MODEL%)
+if "%WHISPER_JOB_COMPUTE_TYPE%"=="" (set COMPUTE_TYPE=float16) else (set COMPUTE_TYPE=%WHISPER_JOB_COMPUTE_TYPE%)
 set DEVICE=cuda
 set LANGUAGE=Russian
 
-echo [INFO] Model: %MODEL%, Device: %DEVICE%, Language: %LANGUAGE%
+echo [INFO] Model: %MODEL%, Compute type: %COMPUTE_TYPE%, Device: %DEVICE%, Language: %LANGUAGE%
 echo [INFO] Saving results to: %OUTPUT_DIR%
 
 :: Create output directory if it doesn't exist
@@ -94,6 +96,7 @@ python -m whisperx "%AUDIO_FILE%" ^
 --model %MODEL% ^
 --language %LANGUAGE% ^
 --device %DEVICE% ^
+--compute_type %COMPUTE_TYPE% ^
 --output_dir "%OUTPUT_DIR%" ^
 --output_format json ^
 --diarize ^
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Компактное хранилище сегментов транскрипции ({prefix}_transcript.segments)
+
+Сегменты хранятся столбцами: начало и конец - массивы float64, говорящий - код int16
+в таблице имен, текст - одна сжатая zlib строка UTF-8 с массивом смещений.
+Числовые столбцы хранятся без сжатия, поэтому load_segments() отображает их
+в память (np.memmap) без разбора; распаковывается только таблица текстов.
+
+Формат файла (little-endian):
+    заголовок '<8sIIQQ': MAGIC, число сегментов n, длина метаданных,
+                         длина текста до сжатия, длина сжатого текста
+    start   float64[n]
+    end     float64[n]
+    offsets uint32[n + 1]   - границы текстов в распакованной таблице
+    speaker int16[n]        - индекс в списке говорящих, -1 если говорящий неизвестен
+    метаданные JSON: {"speakers": [...], "language": "ru"}
+    таблица текстов, сжатая zlib
+"""
+
+import os
+import json
+import zlib
+import struct
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'EFSEG\x00\x01\x00'
+HEADER = struct.Struct('<8sIIQQ')
+SEGMENTS_SUFFIX = '.segments'
+UNKNOWN_SPEAKER = -1
+# Размер блока сжатых текстов при потоковом чтении
+TEXT_CHUNK_SIZE = 64 * 1024
+
+class SegmentTable:
+    """Column-oriented transcript segments; start/end/speaker may be memory-mapped"""
+    __slots__ = ('start', 'end', 'speaker', 'speakers', 'language', 'offsets', 'text_table')
+
+    def __init__(self, start, end, speaker, speakers, language, offsets, text_table):
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.speakers = speakers
+        self.language = language
+        self.offsets = offsets
+        self.text_table = text_table
+
+    def __len__(self):
+        return len(self.start)
+
+    def text(self, index):
+        return self.text_table[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    def speaker_label(self, index):
+        code = self.speaker[index]
+        return self.speakers[code] if code != UNKNOWN_SPEAKER else None
+
+    def iter_segments(self):
+        """Yield segments as dicts in the WhisperX layout (start, end, speaker, text)"""
+        for index in range(len(self)):
+            segment = {'start': float(self.start[index]), 'end': float(self.end[index]), 'text': self.text(index)}
+            label = self.speaker_label(index)
+            if label is not None:
+                segment['speaker'] = label
+            yield segment
+
+def save_segments(path, segments, language=None):
+    """
+    Сохраняет сегменты WhisperX (словари start/end/speaker/text) в компактном формате
+
+    Файл записывается через временный и заменяется атомарно.
+    """
+    path = Path(path)
+    count = len(segments)
+    start = np.fromiter((seg['start'] for seg in segments), dtype='<f8', count=count)
+    end = np.fromiter((seg['end'] for seg in segments), dtype='<f8', count=count)
+
+    speakers = []
+    speaker_codes = {}
+    speaker = np.full(count, UNKNOWN_SPEAKER, dtype='<i2')
+    texts = []
+    for index, seg in enumerate(segments):
+        label = seg.get('speaker')
+        if label is not None:
+            if label not in speaker_codes:
+                speaker_codes[label] = len(speakers)
+                speakers.append(label)
+            speaker[index] = speaker_codes[label]
+        texts.append(seg.get('text', '').encode('utf-8'))
+
+    offsets = np.zeros(count + 1, dtype='<u4')
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    text_raw = b''.join(texts)
+    text_compressed = zlib.compress(text_raw, 6)
+    meta = json.dumps({'speakers': speakers, 'language': language}, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, len(meta), len(text_raw), len(text_compressed)))
+        for column in (start, end, offsets, speaker):
+            f.write(column.tobytes())
+        f.write(meta)
+        f.write(text_compressed)
+    os.replace(tmp_path, path)
+
+def read_layout(path, mmap=True):
+    """
+    Разбирает заголовок и возвращает представления столбцов без копирования
+
+    Returns:
+        tuple: (start, end, offsets, speaker, метаданные, сжатая таблица текстов, длина текста до сжатия)
+
+    Raises:
+        ValueError: если файл не в формате хранилища сегментов
+    """
+    path = Path(path)
+    data = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path.name}: файл сегментов поврежден")
+    magic, count, meta_len, text_raw_len, text_comp_len = HEADER.unpack(data[:HEADER.size].tobytes())
+    if magic != MAGIC:
+        raise ValueError(f"{path.name}: неизвестный формат файла сегментов")
+
+    # Столбцы - представления данных файла без копирования
+    columns = []
+    offset = HEADER.size
+    for dtype, length in (('<f8', count), ('<f8', count), ('<u4', count + 1), ('<i2', count)):
+        size = np.dtype(dtype).itemsize * length
+        columns.append(data[offset:offset + size].view(dtype))
+        offset += size
+
+    meta = json.loads(data[offset:offset + meta_len].tobytes().decode('utf-8'))
+    offset += meta_len
+    return (*columns, meta, data[offset:offset + text_comp_len], text_raw_len)
+
+def load_segments(path, mmap=True):
+    """
+    Загружает сегменты; числовые столбцы по умолчанию отображаются в память
+
+    Returns:
+        SegmentTable
+
+    Raises:
+        ValueError: если файл не в формате хранилища сегментов
+    """
+    start, end, offsets, speaker, meta, text_compressed, text_raw_len = read_layout(path, mmap)
+    text_table = zlib.decompress(text_compressed)
+    if len(text_table) != text_raw_len:
+        raise ValueError(f"{Path(path).name}: таблица текстов повреждена")
+    return SegmentTable(start, end, speaker, meta.get('speakers', []), meta.get('language'), offsets, text_table)
+
+def iter_segments(path, chunk_size=TEXT_CHUNK_SIZE):
+    """
+    Потоково читает сегменты файла, не распаковывая таблицу текстов целиком
+
+    Yields:
+        dict: Сегмент в формате WhisperX (start, end, speaker, text)
+    """
+    start, end, offsets, speaker, meta, text_compressed, _ = read_layout(path)
+    speakers = meta.get('speakers', [])
+    decompressor = zlib.decompressobj()
+    pending = b''
+    # Смещение pending[0] в распакованной таблице и позиция в сжатых данных
+    consumed = 0
+    position = 0
+    for index in range(len(start)):
+        text_start, text_end = int(offsets[index]), int(offsets[index + 1])
+        while consumed + len(pending) < text_end:
+            chunk = text_compressed[position:position + chunk_size].tobytes()
+            if not chunk:
+                raise ValueError(f"{Path(path).name}: таблица текстов повреждена")
+            position += chunk_size
+            pending += decompressor.decompress(chunk)
+        segment = {
+            'start': float(start[index]),
+            'end': float(end[index]),
+            'text': pending[text_start - consumed:text_end - consumed].decode('utf-8'),
+        }
+        if speaker[index] != UNKNOWN_SPEAKER:
+            segment['speaker'] = speakers[speaker[index]]
+        yield segment
+        if text_end - consumed > chunk_size:
+            pending = pending[text_end - consumed:]
+            consumed = text_end
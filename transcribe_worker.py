@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Воркер транскрибации: WhisperX с диаризацией для одного аудиофайла
+
+Замена run.bat, работающая на любой платформе. Аудио декодируется один раз в PCM 16 кГц моно
+(audio_pipeline) и передается в whisperx массивом, поэтому распознавание и диаризация
+не декодируют файл повторно. С --pcm - уже декодированный сервисом PCM читается из stdin,
+а путь к аудио служит только для имени результата. Результат сохраняется как JSON в формате
+whisperx под именем {имя_файла}_{WHISPER_TIMESTAMP}.json.
+
+Использование:
+    python transcribe_worker.py путь/к/аудио [каталог_вывода]
+    ffmpeg ... -f s16le -ac 1 -ar 16000 - | python transcribe_worker.py путь/к/аудио [каталог_вывода] --pcm -
+"""
+
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+from pathlib import Path
+from dotenv import load_dotenv
+
+import audio_pipeline
+
+# Сообщение, по которому file_processor_service определяет отсутствие речи
+NO_SPEECH_MESSAGE = "No active speech found in audio"
+
+def apply_proxy_env():
+    """Set proxy for model downloads from PROXY_* variables, like run.bat does"""
+    proxy_host = os.getenv('PROXY_HOST')
+    proxy_port = os.getenv('PROXY_PORT')
+    if not proxy_host:
+        print("[INFO] No proxy settings found in .env for whisperx.")
+        return
+    if not proxy_port:
+        print("[WARNING] PROXY_HOST is set but PROXY_PORT is missing. Proxy not configured.")
+        return
+
+    proxy_user = os.getenv('PROXY_USER')
+    proxy_pass = os.getenv('PROXY_PASS')
+    if proxy_user and proxy_pass:
+        proxy_url = f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}"
+    else:
+        proxy_url = f"http://{proxy_host}:{proxy_port}"
+    print(f"[INFO] Setting proxy for whisperx download: {proxy_url}")
+    os.environ['HTTPS_PROXY'] = proxy_url
+    os.environ['HTTP_PROXY'] = proxy_url
+
+def transcribe(audio, model_name, device, compute_type, language, batch_size, hf_token, diarize=True):
+    """Run WhisperX transcription, alignment and diarization on a decoded 16 kHz mono array"""
+    import whisperx
+    from whisperx.diarize import DiarizationPipeline
+
+    model = whisperx.load_model(model_name, device, compute_type=compute_type, language=language)
+    result = model.transcribe(audio, batch_size=batch_size)
+    language = result.get("language", language)
+    if not result["segments"]:
+        return {"segments": [], "word_segments": [], "language": language}
+
+    align_model, metadata = whisperx.load_align_model(language_code=language, device=device)
+    result = whisperx.align(result["segments"], align_model, metadata, audio, device, return_char_alignments=False)
+
+    if diarize:
+        diarize_model = DiarizationPipeline(use_auth_token=hf_token, device=device)
+        diarize_segments = diarize_model(audio)
+        result = whisperx.assign_word_speakers(diarize_segments, result)
+    else:
+        # Черновик без диаризации: весь текст от одного говорящего
+        for segment in result["segments"]:
+            segment["speaker"] = "SPEAKER_00"
+
+    return {
+        "segments": result["segments"],
+        "word_segments": result.get("word_segments", []),
+        "language": language
+    }
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Transcribe an audio file with WhisperX and speaker diarization")
+    parser.add_argument("audio_file", help="Path to the audio file (any format supported by ffmpeg)")
+    parser.add_argument("output_dir", nargs="?", default=os.getenv("OUTPUT_DIR") or str(Path(__file__).parent / "output"),
+                        help="Directory for the JSON result")
+    parser.add_argument("--model", default=os.getenv("WHISPER_MODEL", "large-v2"))
+    parser.add_argument("--device", default=os.getenv("WHISPER_DEVICE", "cuda"))
+    parser.add_argument("--compute_type", default=os.getenv("WHISPER_COMPUTE_TYPE"))
+    parser.add_argument("--language", default=os.getenv("WHISPER_LANGUAGE", "ru"))
+    parser.add_argument("--batch_size", type=int, default=int(os.getenv("WHISPER_BATCH_SIZE", "16")))
+    parser.add_argument("--no_diarize", action="store_true", help="Skip speaker diarization (fast draft)")
+    parser.add_argument("--pcm", help="Read 16 kHz mono s16le PCM from this file ('-' for stdin) instead of decoding audio_file")
+    args = parser.parse_args()
+
+    audio_file = Path(args.audio_file)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    compute_type = args.compute_type or ("float16" if args.device == "cuda" else "int8")
+    print(f"[INFO] Processing audio file: {audio_file}")
+    print(f"[INFO] Model: {args.model}, Device: {args.device}, Compute type: {compute_type}, Language: {args.language}")
+
+    # Метка времени передается сервисом через окружение, как для run.bat
+    timestamp = os.getenv("WHISPER_TIMESTAMP") or datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_json = output_dir / f"{audio_file.stem}_{timestamp}.json"
+    print(f"[INFO] Saving results to: {output_json}")
+
+    apply_proxy_env()
+
+    if args.pcm == "-":
+        audio = audio_pipeline.read_pcm_stream(sys.stdin.buffer)
+    elif args.pcm:
+        with open(args.pcm, "rb") as f:
+            audio = audio_pipeline.read_pcm_stream(f)
+    else:
+        audio = audio_pipeline.load_audio(audio_file)
+    result = transcribe(audio, args.model, args.device, compute_type, args.language,
+                        args.batch_size, os.getenv("HF_TOKEN"), diarize=not args.no_diarize)
+
+    if not result["segments"]:
+        print(NO_SPEECH_MESSAGE)
+
+    with open(output_json, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+    print(f"[INFO] Transcription completed for file: {audio_file.stem}")
+    print(f"[DONE] Check results in: {output_dir}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"[ERROR] Transcription failed: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Экспорт транскрипций в SRT, VTT и TSV по запросу
+
+Транскрибатор создает только JSON; субтитры строятся из сегментов, сохраненных рядом
+с заметкой ({prefix}_transcript.segments), когда они действительно нужны:
+- вручную: python transcript_export.py заметка.md --format srt,vtt
+- флагом во frontmatter заметки: subtitles: srt, vtt - сервис создаст файлы
+  {prefix}_transcript.srt/.vtt рядом с заметкой при периодической проверке.
+
+Сегменты читаются и записываются потоково, транскрипция целиком в память не загружается.
+
+Использование:
+    python transcript_export.py путь [путь ...] [--format srt,vtt,tsv] [--output-dir каталог]
+"""
+
+import os
+import argparse
+import logging
+from pathlib import Path
+
+import yaml
+
+import segment_store
+from transcript_model import Transcript
+
+logger = logging.getLogger(__name__)
+
+# Ключ frontmatter со списком форматов для экспорта
+FRONTMATTER_KEY = 'subtitles'
+
+def format_clock(seconds, separator):
+    """HH:MM:SS<separator>mmm"""
+    millis = max(0, round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+class SpeakerNames:
+    """Maps raw diarization labels to "Speaker N" in order of first appearance, like the notes do"""
+    def __init__(self):
+        self.names = {}
+
+    def __call__(self, label):
+        if label is None:
+            return None
+        if label not in self.names:
+            self.names[label] = f"Speaker {len(self.names) + 1}"
+        return self.names[label]
+
+def write_srt(segments, out):
+    speaker_name = SpeakerNames()
+    for number, seg in enumerate(segments, 1):
+        name = speaker_name(seg.get('speaker'))
+        text = seg['text'].strip()
+        out.write(f"{number}\n{format_clock(seg['start'], ',')} --> {format_clock(seg['end'], ',')}\n")
+        out.write(f"[{name}] {text}\n\n" if name else f"{text}\n\n")
+
+def write_vtt(segments, out):
+    speaker_name = SpeakerNames()
+    out.write("WEBVTT\n\n")
+    for seg in segments:
+        name = speaker_name(seg.get('speaker'))
+        text = seg['text'].strip()
+        out.write(f"{format_clock(seg['start'], '.')} --> {format_clock(seg['end'], '.')}\n")
+        out.write(f"<v {name}>{text}\n\n" if name else f"{text}\n\n")
+
+def write_tsv(segments, out):
+    # Как TSV WhisperX (время в миллисекундах) с колонкой говорящего
+    speaker_name = SpeakerNames()
+    out.write("start\tend\tspeaker\ttext\n")
+    for seg in segments:
+        text = seg['text'].strip().replace('\t', ' ').replace('\n', ' ')
+        out.write(f"{round(seg['start'] * 1000)}\t{round(seg['end'] * 1000)}\t"
+                  f"{speaker_name(seg.get('speaker')) or ''}\t{text}\n")
+
+EXPORTERS = {
+    'srt': write_srt,
+    'vtt': write_vtt,
+    'tsv': write_tsv,
+}
+
+def find_segments_file(path):
+    """Segments file for a note, a .segments file or a WhisperX JSON; None if there is none"""
+    path = Path(path)
+    if path.suffix in (segment_store.SEGMENTS_SUFFIX, '.json'):
+        return path if path.exists() else None
+    for suffix in (segment_store.SEGMENTS_SUFFIX, '.json'):
+        candidate = path.with_suffix(suffix)
+        if candidate.exists():
+            return candidate
+    return None
+
+def iter_file_segments(segments_file):
+    """Stream segments from a .segments file; WhisperX JSON has to be parsed whole"""
+    if segments_file.suffix == segment_store.SEGMENTS_SUFFIX:
+        return segment_store.iter_segments(segments_file)
+    return Transcript.load(segments_file).iter_segments()
+
+def export_transcript(path, formats, output_dir=None):
+    """
+    Экспортирует транскрипцию заметки в указанные форматы
+
+    Args:
+        path (str или Path): Заметка, файл .segments или JSON WhisperX
+        formats (list): Форматы из EXPORTERS
+        output_dir (str или Path): Каталог результата (по умолчанию - рядом с сегментами)
+
+    Returns:
+        list: Пути созданных файлов
+    """
+    segments_file = find_segments_file(path)
+    if segments_file is None:
+        raise FileNotFoundError(f"Сегменты для {Path(path).name} не найдены")
+    target_dir = Path(output_dir) if output_dir else segments_file.parent
+
+    written = []
+    for fmt in formats:
+        exporter = EXPORTERS.get(fmt)
+        if exporter is None:
+            raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+        target = target_dir / f"{segments_file.stem}.{fmt}"
+        tmp_target = target.with_name(f".{target.name}.tmp")
+        with open(tmp_target, 'w', encoding='utf-8') as out:
+            exporter(iter_file_segments(segments_file), out)
+        os.replace(tmp_target, target)
+        written.append(target)
+    return written
+
+def read_frontmatter(md_file):
+    """Parse only the frontmatter block of a note, without reading its body"""
+    with open(md_file, 'r', encoding='utf-8') as f:
+        if f.readline().strip() != '---':
+            return {}
+        lines = []
+        for line in f:
+            if line.strip() == '---':
+                break
+            lines.append(line)
+    try:
+        metadata = yaml.safe_load(''.join(lines))
+    except yaml.YAMLError:
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+def requested_formats(metadata):
+    """Formats from the subtitles frontmatter flag: 'srt, vtt' or a YAML list"""
+    value = metadata.get(FRONTMATTER_KEY)
+    if not value:
+        return []
+    items = value if isinstance(value, list) else str(value).split(',')
+    return [str(item).strip().lower() for item in items if str(item).strip().lower() in EXPORTERS]
+
+def export_requested(output_dir):
+    """
+    Создает субтитры для заметок с флагом subtitles во frontmatter
+
+    Файл создается заново, только если его нет или сегменты новее (например, после
+    уточнения черновика).
+
+    Returns:
+        int: Количество созданных файлов
+    """
+    exported = 0
+    for md_file in Path(output_dir).glob('*_transcript.md'):
+        try:
+            formats = requested_formats(read_frontmatter(md_file))
+            if not formats:
+                continue
+            segments_file = find_segments_file(md_file)
+            if segments_file is None:
+                continue
+            segments_mtime = segments_file.stat().st_mtime
+            stale = [
+                fmt for fmt in formats
+                if not (target := segments_file.with_suffix(f".{fmt}")).exists()
+                or target.stat().st_mtime < segments_mtime
+            ]
+            if stale:
+                written = export_transcript(segments_file, stale)
+                exported += len(written)
+                logger.info(f"{md_file.name}: экспортировано {', '.join(path.name for path in written)}")
+        except Exception as e:
+            logger.error(f"Ошибка экспорта субтитров для {md_file.name}: {e}")
+    return exported
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Export retained transcripts to SRT, VTT or TSV")
+    parser.add_argument("paths", nargs="+", help="Notes, .segments files or WhisperX JSON files")
+    parser.add_argument("--format", default="srt", help="Comma-separated formats: " + ", ".join(EXPORTERS))
+    parser.add_argument("--output-dir", help="Directory for the exported files (default: next to the segments)")
+    args = parser.parse_args()
+
+    formats = [fmt.strip().lower() for fmt in args.format.split(',') if fmt.strip()]
+    for path in args.paths:
+        for written in export_transcript(path, formats, args.output_dir):
+            print(written)
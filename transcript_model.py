@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Общая модель транскрипции для сервиса, повторного рендеринга и экспорта
+
+Сегменты хранятся столбцами (начало/конец - float64, говорящий - код int16 в таблице
+имен, тексты - список строк), как и в segment_store. Группировка реплик по говорящим
+и переименование говорящих в "Speaker N" выполняются векторно над массивами кодов,
+без промежуточного текстового файла и разбора строк регулярными выражениями.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+import segment_store
+
+UNKNOWN_SPEAKER = segment_store.UNKNOWN_SPEAKER
+
+def format_timestamp(seconds):
+    """Format time in MM:SS format or HH:MM:SS if over an hour"""
+    total_seconds = round(seconds)
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    seconds = total_seconds % 60
+
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    else:
+        return f"{minutes}:{seconds:02d}"
+
+def format_timestamps(seconds):
+    """Vectorized format_timestamp() for an array of times"""
+    # np.rint, как и round(), округляет половины к четному
+    total = np.rint(np.asarray(seconds, dtype=np.float64)).astype(np.int64)
+    hours, rest = np.divmod(total, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    return [
+        f"{h}:{m:02d}:{s:02d}" if h > 0 else f"{m}:{s:02d}"
+        for h, m, s in zip(hours.tolist(), minutes.tolist(), secs.tolist())
+    ]
+
+class Transcript:
+    """Column-oriented transcript: start/end arrays, speaker codes into a name table, texts"""
+    __slots__ = ('start', 'end', 'speaker', 'speakers', 'texts', 'language')
+
+    def __init__(self, start, end, speaker, speakers, texts, language=None):
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.speakers = speakers
+        self.texts = texts
+        self.language = language
+
+    def __len__(self):
+        return len(self.texts)
+
+    @classmethod
+    def from_segments(cls, segments, language=None):
+        """Build from WhisperX segment dicts (start, end, speaker, text)"""
+        count = len(segments)
+        start = np.fromiter((seg['start'] for seg in segments), dtype=np.float64, count=count)
+        end = np.fromiter((seg['end'] for seg in segments), dtype=np.float64, count=count)
+        speaker = np.full(count, UNKNOWN_SPEAKER, dtype=np.int16)
+        speakers = []
+        codes = {}
+        texts = []
+        for index, seg in enumerate(segments):
+            label = seg.get('speaker')
+            if label is not None:
+                if label not in codes:
+                    codes[label] = len(speakers)
+                    speakers.append(label)
+                speaker[index] = codes[label]
+            texts.append(seg.get('text', '').strip())
+        return cls(start, end, speaker, speakers, texts, language)
+
+    @classmethod
+    def from_segment_table(cls, table):
+        """Build from a segment_store.SegmentTable (numeric columns stay memory-mapped)"""
+        texts = [table.text(index).strip() for index in range(len(table))]
+        return cls(table.start, table.end, table.speaker, list(table.speakers), texts, table.language)
+
+    @classmethod
+    def load(cls, path):
+        """Load a retained .segments file or a WhisperX JSON file"""
+        path = Path(path)
+        if path.suffix == segment_store.SEGMENTS_SUFFIX:
+            return cls.from_segment_table(segment_store.load_segments(path))
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls.from_segments(data.get('segments', []), data.get('language'))
+
+    def save(self, path):
+        """Save in the compact segment_store format"""
+        segment_store.save_segments(path, list(self.iter_segments()), self.language)
+
+    def iter_segments(self):
+        """Yield segments as WhisperX-style dicts"""
+        for index, text in enumerate(self.texts):
+            segment = {'start': float(self.start[index]), 'end': float(self.end[index]), 'text': text}
+            code = self.speaker[index]
+            if code != UNKNOWN_SPEAKER:
+                segment['speaker'] = self.speakers[code]
+            yield segment
+
+    def dialog_mask(self):
+        """Segments that go into the note: with a known speaker and non-empty text"""
+        has_text = np.fromiter((bool(text) for text in self.texts), dtype=bool, count=len(self.texts))
+        return (np.asarray(self.speaker) != UNKNOWN_SPEAKER) & has_text
+
+    def speaker_blocks(self):
+        """
+        Группирует подряд идущие реплики одного говорящего
+
+        Returns:
+            tuple: (индексы сегментов диалога, границы блоков [начало, конец) в этих индексах,
+                    номер говорящего "Speaker N" для каждого блока)
+        """
+        indices = np.flatnonzero(self.dialog_mask())
+        codes = np.asarray(self.speaker)[indices]
+        if len(indices) == 0:
+            return indices, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # Блок начинается там, где говорящий сменился
+        starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+        bounds = np.append(starts, len(indices))
+        block_codes = codes[starts]
+        # Говорящие нумеруются в порядке первого появления в диалоге
+        unique_codes, first_seen = np.unique(block_codes, return_index=True)
+        order = np.empty(len(unique_codes), dtype=np.int64)
+        order[np.argsort(first_seen)] = np.arange(1, len(unique_codes) + 1)
+        speaker_numbers = order[np.searchsorted(unique_codes, block_codes)]
+        return indices, bounds, speaker_numbers
+
+def render_dialog_markdown(transcript):
+    """Markdown speaker blocks of a transcript (the note body after the frontmatter)"""
+    indices, bounds, speaker_numbers = transcript.speaker_blocks()
+    if len(speaker_numbers) == 0:
+        return ""
+    block_starts = format_timestamps(transcript.start[indices[bounds[:-1]]])
+    block_ends = format_timestamps(transcript.end[indices[bounds[1:] - 1]])
+    texts = transcript.texts
+    parts = []
+    for block, number in enumerate(speaker_numbers.tolist()):
+        parts.append(f"### Speaker {number} *[{block_starts[block]} - {block_ends[block]}]*\n\n")
+        parts.extend(f"- {texts[index]}\n" for index in indices[bounds[block]:bounds[block + 1]].tolist())
+        parts.append("\n")
+    return "".join(parts)